@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+An asyncio NBD client.
+
+It implements the parts of the NBD protocol that python_nbd_client supports
+for the fixed-newstyle negotiation: TLS upgrade, structured replies, and
+metadata contexts with the BLOCK_STATUS extension:
+https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+
+Any number of requests can be in flight: the replies are received by a
+task of the client, which completes the requests in the order of their
+replies, so one process can transfer data to and from many exports without
+a thread for each:
+
+    client = await open_nbd_client(path, "export", unix=True, use_tls=False)
+    async with client:
+        blocks = await asyncio.gather(*(client.read(offset, 65536)
+                                        for offset in range(0, 1 << 24, 65536)))
+
+TLS needs Python 3.7 or later (see TLS_SUPPORTED): on Python 3.6, only
+connections with use_tls=False can be made.
+"""
+
+import asyncio
+import logging
+import struct
+import sys
+
+import python_nbd_client
+from python_nbd_client import (
+    NBD_CMD_BLOCK_STATUS,
+    NBD_CMD_DISC,
+    NBD_CMD_FLUSH,
+    NBD_CMD_READ,
+    NBD_CMD_WRITE,
+    NBD_REP_ACK,
+    NBD_REP_ERROR_BIT,
+    NBD_REP_META_CONTEXT,
+    NBD_REPLY_TYPE_BLOCK_STATUS,
+    NBD_REPLY_TYPE_NONE,
+    NBD_REPLY_TYPE_OFFSET_DATA,
+    NBD_REPLY_TYPE_OFFSET_HOLE,
+    NBDOptionError,
+    NBDProtocolError,
+    NBDTransmissionError,
+    NBDUnexpectedOptionResponseError,
+    NBDUnexpectedReplyHandleError,
+    NBDUnexpectedStructuredReplyType,
+    _check_alignment,
+    _parse_block_status_descriptors,
+    assert_protocol,
+    is_error_chunk,
+)
+
+LOGGER = logging.getLogger("async_nbd_client")
+
+# Upgrading a connection to TLS needs loop.start_tls(), new in Python 3.7
+TLS_SUPPORTED = sys.version_info >= (3, 7)
+
+
+class _Request:
+    """A request waiting for its reply"""
+
+    __slots__ = ("request_type", "offset", "buffer", "chunks", "future")
+
+    def __init__(self, request_type, offset, length, future):
+        self.request_type = request_type
+        self.offset = offset
+        # The data of reads, assembled from the structured reply chunks
+        self.buffer = bytearray(length) if request_type == NBD_CMD_READ else None
+        # The structured reply chunks other than data and holes
+        self.chunks = []
+        self.future = future
+
+
+class AsyncNbdClient:
+    """
+    An asyncio NBD client for the fixed-newstyle negotiation, with TLS,
+    structured replies and the BLOCK_STATUS extension.
+
+    Use open_nbd_client() to create one, or open_connection() followed by
+    the options of the handshake phase and connect().
+    """
+
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._plain_writer = None
+        self._handle = 0
+        self._last_sent_option = None
+        self._structured_reply = False
+        self._transmission_phase = False
+        self._flushed = True
+        self._size = None
+        self._transmission_flags = 0
+        # handle -> _Request of the requests in flight
+        self._requests = {}
+        self._receiver = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open_connection(
+        self, address, port=10809, unix=False, use_tls=True, cert=None, subject=None
+    ):
+        """
+        Connect to the server and negotiate the fixed-newstyle handshake,
+        upgrading the connection to TLS if use_tls, which needs
+        TLS_SUPPORTED.
+        """
+        if use_tls and not TLS_SUPPORTED:
+            raise NotImplementedError("TLS needs Python 3.7 or later")
+        LOGGER.info("Creating connection to address '%s' and port '%s'", address, port)
+        if unix:
+            self._reader, self._writer = await asyncio.open_unix_connection(address)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(address, int(port))
+        assert_protocol(await self._recvall(8) == b"NBDMAGIC")
+        assert_protocol(await self._recvall(8) == b"IHAVEOPT")
+        (handshake_flags,) = struct.unpack(">H", await self._recvall(2))
+        assert_protocol(handshake_flags & python_nbd_client.NBD_FLAG_HAS_FLAGS != 0)
+        self._writer.write(struct.pack(">L", python_nbd_client.NBD_FLAG_C_FIXED_NEWSTYLE))
+        if use_tls:
+            self._send_option(python_nbd_client.NBD_OPT_STARTTLS)
+            assert_protocol(len(await self._parse_option_reply_ack()) == 0)
+            await self._upgrade_to_tls(cert, subject)
+
+    async def _upgrade_to_tls(self, cert, subject):
+        context = python_nbd_client.tls_context(cert, subject)
+        if hasattr(self._writer, "start_tls"):  # Python >= 3.11
+            await self._writer.start_tls(context, server_hostname=subject)
+            return
+        # Before Python 3.11, open new streams over the TLS transport
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport = await loop.start_tls(
+            self._writer.transport, protocol, context, server_hostname=subject
+        )
+        # start_tls() does not pass the new transport to the protocol
+        protocol.connection_made(transport)
+        # Keep the plain streams, some versions close their transport when
+        # they are collected, which is the one under the TLS transport
+        self._plain_writer = self._writer
+        self._reader = reader
+        self._writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def _recvall(self, length):
+        try:
+            return await self._reader.readexactly(length)
+        except asyncio.IncompleteReadError as exc:
+            raise python_nbd_client.NBDEOFError from exc
+
+    # Handshake phase
+
+    def _send_option(self, option, data=b""):
+        LOGGER.debug("option='%d' data_length='%d'", option, len(data))
+        self._writer.write(b"IHAVEOPT" + struct.pack(">LL", option, len(data)) + data)
+        self._last_sent_option = option
+
+    async def _parse_option_reply(self):
+        reply = await self._recvall(8 + 4 + 4 + 4)
+        (magic, option, reply_type, data_length) = struct.unpack(">QLLL", reply)
+        assert_protocol(magic == python_nbd_client.OPTION_REPLY_MAGIC)
+        if option != self._last_sent_option:
+            raise NBDUnexpectedOptionResponseError(
+                expected=self._last_sent_option, received=option
+            )
+        data = await self._recvall(data_length)
+        if reply_type & NBD_REP_ERROR_BIT != 0:
+            # The data of errors, if any, is a message for humans
+            LOGGER.debug("NBD option error: %s", data)
+            raise NBDOptionError(reply=reply_type)
+        return (reply_type, data)
+
+    async def _parse_option_reply_ack(self):
+        (reply_type, data) = await self._parse_option_reply()
+        if reply_type != NBD_REP_ACK:
+            raise NBDProtocolError()
+        return data
+
+    async def negotiate_structured_reply(self):
+        """
+        Negotiate use of the structured reply extension, fail if unsupported.
+        Only valid during the handshake phase.
+        """
+        self._send_option(python_nbd_client.NBD_OPT_STRUCTURED_REPLY)
+        await self._parse_option_reply_ack()
+        self._structured_reply = True
+
+    async def _send_meta_context_option(self, option, export_name, queries):
+        data = struct.pack(">L", len(export_name)) + export_name.encode("utf-8")
+        data += struct.pack(">L", len(queries))
+        for query in queries:
+            data += struct.pack(">L", len(query)) + query.encode("utf-8")
+        self._send_option(option, data)
+        contexts = []
+        while True:
+            (reply_type, data) = await self._parse_option_reply()
+            if reply_type == NBD_REP_ACK:
+                return contexts
+            assert_protocol(reply_type == NBD_REP_META_CONTEXT)
+            contexts.append((struct.unpack(">L", data[:4])[0], data[4:].decode("utf-8")))
+
+    async def set_meta_contexts(self, export_name, queries):
+        """
+        Change the set of active metadata contexts. Only valid during the
+        handshake phase, after negotiate_structured_reply. Returns the list of
+        selected metadata contexts as (metadata context ID, name) pairs.
+        """
+        return await self._send_meta_context_option(
+            python_nbd_client.NBD_OPT_SET_META_CONTEXT, export_name, queries
+        )
+
+    async def list_meta_contexts(self, export_name, queries):
+        """
+        Return the metadata contexts available on the export matching one or
+        more of the queries as (metadata context ID, name) pairs.
+        """
+        return await self._send_meta_context_option(
+            python_nbd_client.NBD_OPT_LIST_META_CONTEXT, export_name, queries
+        )
+
+    async def connect(self, exportname):
+        """
+        Valid only during the handshake phase. Requests the given
+        export and enters the transmission phase.
+        """
+        LOGGER.info("Connecting to export '%s' using newstyle negotiation", exportname)
+        self._send_option(python_nbd_client.NBD_OPT_EXPORT_NAME, exportname.encode("utf-8"))
+        (self._size, self._transmission_flags) = struct.unpack(">QH", await self._recvall(10))
+        await self._recvall(124)
+        self._transmission_phase = True
+        self._receiver = asyncio.ensure_future(self._receive_replies())
+
+    # Transmission phase
+
+    def _send_request(self, request_type, offset, length, data=b""):
+        """Send the request and return the future of its reply"""
+        self._handle += 1
+        header = struct.pack(
+            ">LHHQQL",
+            python_nbd_client.NBD_REQUEST_MAGIC,
+            0,
+            request_type,
+            self._handle,
+            offset,
+            length,
+        )
+        self._writer.write(header)
+        if data:
+            self._writer.write(data)
+        if request_type == NBD_CMD_DISC:
+            return None
+        if self._receiver.done():
+            # Let the request fail with the error which stopped the receiver
+            self._receiver.result()
+            raise python_nbd_client.NBDEOFError
+        future = asyncio.get_event_loop().create_future()
+        self._requests[self._handle] = _Request(request_type, offset, length, future)
+        return future
+
+    async def _request(self, request_type, offset, length, data=b""):
+        future = self._send_request(request_type, offset, length, data)
+        await self._writer.drain()
+        return await future
+
+    async def _receive_replies(self):
+        """Receive the replies and complete their requests until closed"""
+        try:
+            while True:
+                (magic,) = struct.unpack(">L", await self._recvall(4))
+                if magic == python_nbd_client.NBD_STRUCTURED_REPLY_MAGIC:
+                    await self._receive_structured_reply_chunk()
+                else:
+                    assert_protocol(magic == python_nbd_client.NBD_SIMPLE_REPLY_MAGIC)
+                    await self._receive_simple_reply()
+        except Exception as exc:  # pylint: disable=broad-except
+            for request in self._requests.values():
+                if not request.future.done():
+                    request.future.set_exception(exc)
+            self._requests.clear()
+            if not isinstance(exc, python_nbd_client.NBDEOFError):
+                raise
+
+    def _request_of(self, handle):
+        if handle not in self._requests:
+            raise NBDUnexpectedReplyHandleError(expected=self._handle, received=handle)
+        return self._requests[handle]
+
+    def _complete(self, handle, error=None):
+        request = self._requests.pop(handle)
+        if request.future.done():  # Cancelled
+            return
+        if error:
+            request.future.set_exception(NBDTransmissionError(error))
+        elif request.request_type == NBD_CMD_READ:
+            request.future.set_result(request.buffer)
+        elif request.request_type == NBD_CMD_BLOCK_STATUS:
+            request.future.set_result(request.chunks)
+        else:
+            request.future.set_result(None)
+
+    async def _receive_simple_reply(self):
+        (errno, handle) = struct.unpack(">LQ", await self._recvall(4 + 8))
+        request = self._request_of(handle)
+        if not errno and request.request_type == NBD_CMD_READ:
+            request.buffer[:] = await self._recvall(len(request.buffer))
+        self._complete(handle, errno)
+
+    async def _receive_structured_reply_chunk(self):
+        header = await self._recvall(2 + 2 + 8 + 4)
+        (flags, reply_type, handle, data_length) = struct.unpack(">HHQL", header)
+        request = self._request_of(handle)
+        data = await self._recvall(data_length)
+        error = None
+        if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+            assert_protocol(data_length >= 9)
+            start = struct.unpack(">Q", data[:8])[0] - request.offset
+            assert_protocol(0 <= start and start + data_length - 8 <= len(request.buffer))
+            request.buffer[start : start + data_length - 8] = data[8:]
+        elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+            assert_protocol(data_length == 12)
+            (offset, hole_size) = struct.unpack(">QL", data)
+            start = offset - request.offset
+            assert_protocol(0 <= start and start + hole_size <= len(request.buffer))
+            request.buffer[start : start + hole_size] = bytes(hole_size)
+        elif reply_type == NBD_REPLY_TYPE_BLOCK_STATUS:
+            assert_protocol((data_length >= 12) and (data_length % 8 == 4))
+            descriptors = list(_parse_block_status_descriptors(data[4:]))
+            request.chunks.append(
+                {
+                    "flags": flags,
+                    "reply_type": reply_type,
+                    "context_id": struct.unpack(">L", data[:4])[0],
+                    "descriptors": descriptors,
+                }
+            )
+        elif is_error_chunk(reply_type):
+            assert_protocol(data_length >= 6)
+            (error, message_length) = struct.unpack(">LH", data[:6])
+            LOGGER.debug("NBD error chunk: %s", data[6 : 6 + message_length])
+        elif reply_type != NBD_REPLY_TYPE_NONE:
+            raise NBDUnexpectedStructuredReplyType(reply_type)
+        if python_nbd_client.NBD_REPLY_FLAG_DONE & flags:
+            self._complete(handle, error)
+        elif error:
+            # Fail the request, but keep receiving its chunks until the last
+            self._complete(handle, error)
+            self._requests[handle] = request
+
+    async def read(self, offset, length):
+        """
+        Returns length number of bytes read from the export, starting at
+        the given offset.
+        """
+        _check_alignment("offset", offset)
+        _check_alignment("length", length)
+        return await self._request(NBD_CMD_READ, offset, length)
+
+    async def write(self, data, offset):
+        """
+        Writes the given bytes to the export, starting at the given
+        offset.
+        """
+        _check_alignment("offset", offset)
+        _check_alignment("size", len(data))
+        self._flushed = False
+        await self._request(NBD_CMD_WRITE, offset, len(data), data)
+        return len(data)
+
+    async def flush(self):
+        """
+        Sends a flush request to the server if the server supports it,
+        which writes the completed writes to permanent storage.
+        """
+        if self._transmission_flags & python_nbd_client.NBD_FLAG_SEND_FLUSH == 0:
+            self._flushed = True
+            return False
+        await self._request(NBD_CMD_FLUSH, 0, 0)
+        self._flushed = True
+        return True
+
+    async def query_block_status(self, offset, length):
+        """
+        Query block status in the range defined by length and offset.
+        Returns a list of structured reply chunks.
+        The required meta contexts must have been negotiated using
+        set_meta_contexts.
+        """
+        return await self._request(NBD_CMD_BLOCK_STATUS, offset, length)
+
+    def get_size(self):
+        """
+        Return the size of the device in bytes.
+        """
+        return self._size
+
+    async def close(self):
+        """
+        Sends a flush request to the server if necessary, followed by a
+        disconnect request, and closes the connection.
+        """
+        if self._writer is None:
+            return
+        try:
+            if self._transmission_phase:
+                if not self._flushed and not self._receiver.done():
+                    await self.flush()
+                self._send_request(NBD_CMD_DISC, 0, 0)
+                if self._receiver.done():
+                    # The error has been raised by the requests
+                    self._receiver.exception()
+                self._receiver.cancel()
+            else:
+                self._send_option(python_nbd_client.NBD_OPT_ABORT)
+            await self._writer.drain()
+        finally:
+            self._writer.close()
+            self._writer = None
+
+
+async def open_nbd_client(
+    address,
+    exportname="",
+    port=10809,
+    unix=False,
+    use_tls=True,
+    cert=None,
+    subject=None,
+    structured_reply=False,
+    meta_contexts=None,
+):
+    """
+    Return an AsyncNbdClient connected to the export, with structured
+    replies if structured_reply, and the metadata contexts of the queries in
+    meta_contexts selected, which implies structured replies.
+    """
+    client = AsyncNbdClient()
+    try:
+        await client.open_connection(address, port, unix, use_tls, cert, subject)
+        if structured_reply or meta_contexts:
+            await client.negotiate_structured_reply()
+        if meta_contexts:
+            await client.set_meta_contexts(exportname, meta_contexts)
+        await client.connect(exportname)
+    except BaseException:
+        await client.close()
+        raise
+    return client
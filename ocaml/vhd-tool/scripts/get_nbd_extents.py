@@ -5,6 +5,17 @@ Returns a list of extents with their block statuses for an NBD export.
 
 This program uses new NBD capabilities introduced in QEMU 2.12.
 
+By default, the block statuses are those of the base:allocation metadata
+context. With --context qemu:dirty-bitmap:<name>, they are those of the
+dirty bitmap <name> of the export, in which NBD_STATE_DIRTY marks the
+extents changed since the bitmap was created.
+
+The extents are written as they are received, so the memory used does not
+depend on the size of the export: as a JSON list (the default), as JSON
+objects on separate lines (--format ndjson), or as records of EXTENT_RECORD,
+the length and flags of the extent (--format binary). With --coalesce,
+consecutive extents with the same flags are merged.
+
 It uses the BLOCK_STATUS NBD extension, which relies on the structured replies
 functionality. These are documented in the NBD protocol docs:
 https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
@@ -14,6 +25,8 @@ import argparse
 import json
 import logging
 import logging.handlers
+import struct
+import sys
 
 import python_nbd_client
 from python_nbd_client import assert_protocol
@@ -31,73 +44,149 @@ LOGGER.setLevel(logging.DEBUG)
 MAX_REQUEST_LEN = 2**32 - 1
 
 # Make the NBD_CMD_BLOCK_STATUS request aligned to 512 bytes, just in case. But
-# it looks like this is not required for qemu 2.12.
+# it looks like this is not required for qemu 2.12. get_extents further aligns
+# the requests to the preferred block size of the export.
 MAX_REQUEST_LEN = MAX_REQUEST_LEN - (MAX_REQUEST_LEN % 512)
 
+BASE_ALLOCATION = "base:allocation"
+DIRTY_BITMAP_PREFIX = "qemu:dirty-bitmap:"
+
+# The length and the flags of an extent in the binary output format
+EXTENT_RECORD = struct.Struct(">QL")
 
-def _get_extents(path, exportname, offset, length):
-    with PythonNbdClient(
+OUTPUT_FORMATS = ("json", "ndjson", "binary")
+
+
+def open_client(path, exportname, contexts=(BASE_ALLOCATION,)):
+    """
+    Return a PythonNbdClient connected to the export served at the Unix
+    socket path, with the metadata contexts selected, and a dict of the IDs
+    of the contexts by name. The client must be closed by the caller.
+    """
+    client = PythonNbdClient(
         address=path, exportname=exportname, unix=True, use_tls=False, connect=False
-    ) as client:
+    )
+    try:
         client.negotiate_structured_reply()
 
-        # Select our metadata context. This context is documented at
+        # Select our metadata contexts. The base:allocation context is
+        # documented at
         # https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md#baseallocation-metadata-context
-        context = "base:allocation"
-        selected_contexts = client.set_meta_contexts(exportname, [context])
-        assert_protocol(len(selected_contexts) == 1)
-        (meta_context_id, meta_context_name) = selected_contexts[0]
-        assert_protocol(meta_context_name == context)
+        # and the qemu:dirty-bitmap:<name> contexts at
+        # https://gitlab.com/qemu-project/qemu/-/blob/master/docs/interop/nbd.txt
+        selected_contexts = client.set_meta_contexts(exportname, list(contexts))
+        context_ids = {name: context_id for (context_id, name) in selected_contexts}
+        missing = set(contexts) - set(context_ids)
+        if missing:
+            raise ValueError("Export {} has no context {}".format(exportname, sorted(missing)))
+        assert_protocol(len(selected_contexts) == len(contexts))
 
+        client.negotiate_block_size(exportname)
         client.connect(exportname)
+    except BaseException:
+        client.close()
+        raise
+    LOGGER.debug(
+        "Connected to NBD export %s served at path %s of size %d bytes",
+        exportname,
+        path,
+        client.get_size(),
+    )
+    return (client, context_ids)
 
-        size = client.get_size()
-        LOGGER.debug(
-            "Connected to NBD export %s served at path %s of size %d bytes",
-            exportname,
-            path,
-            size,
-        )
 
-        if (offset < 0) or (length <= 0) or ((offset + length) > size):
-            raise ValueError(
-                "Offset={} and length={} out of bounds: " "export has size {}".format(
-                    offset, length, size
-                )
+def get_extents(client, meta_context_id, offset, length):
+    """
+    Yields the extents of the selected metadata context of the connected
+    client in the range of length bytes at offset, as dicts with the length
+    and the flags of the extent.
+    """
+    size = client.get_size()
+    if (offset < 0) or (length <= 0) or ((offset + length) > size):
+        raise ValueError(
+            "Offset={} and length={} out of bounds: " "export has size {}".format(
+                offset, length, size
             )
-        end = offset + length
-        while offset < end:
-            request_len = min(MAX_REQUEST_LEN, end - offset)
-            replies = client.query_block_status(offset, request_len)
-
-            # Process the returned structured reply chunks
-            # "For a successful return, the server MUST use a structured reply,
-            # containing exactly one chunk of type NBD_REPLY_TYPE_BLOCK_STATUS
-            # per selected context id"
-            assert_protocol(len(replies) == 1)
-            reply = replies[0]
+        )
+    # Sweep in requests ending at multiples of the preferred block size, in
+    # which the server tracks the allocation of the export
+    preferred = client.get_block_size()["preferred_block_size"]
+    request_size = MAX_REQUEST_LEN - MAX_REQUEST_LEN % preferred
+    end = offset + length
+    while offset < end:
+        request_len = min(request_size - offset % preferred, end - offset)
+        replies = client.query_block_status(offset, request_len)
 
+        # Process the returned structured reply chunks
+        # "For a successful return, the server MUST use a structured reply,
+        # containing exactly one chunk of type NBD_REPLY_TYPE_BLOCK_STATUS
+        # per selected context id"
+        for reply in replies:
             # First make sure it's a block status reply
             if python_nbd_client.is_error_chunk(reply_type=reply["reply_type"]):
                 raise Exception("Received error: {}".format(reply))
             if reply["reply_type"] != python_nbd_client.NBD_REPLY_TYPE_BLOCK_STATUS:
                 raise Exception("Unexpected reply: {}".format(reply))
 
-            # Then process the returned block status info
-            assert_protocol(reply["context_id"] == meta_context_id)
-            # Note: There might be consecutive descriptors with the same status
-            # value.
-            descriptors = reply["descriptors"]
-            for i, descriptor in enumerate(descriptors, 1):
-                (extent_length, flags) = descriptor
-                if i == (len(descriptors)):
-                    # The first N-1 extents must be smaller than the requested
-                    # length, but the last extent can exceed the requested
-                    # length
-                    extent_length = min(extent_length, end - offset)
-                yield {"length": extent_length, "flags": flags}
-                offset += extent_length
-                assert_protocol(offset <= end)
+        # Then process the returned block status info of our context
+        replies = [reply for reply in replies if reply["context_id"] == meta_context_id]
+        assert_protocol(len(replies) == 1)
+        reply = replies[0]
+        # Note: There might be consecutive descriptors with the same status
+        # value.
+        descriptors = reply["descriptors"]
+        for i, descriptor in enumerate(descriptors, 1):
+            (extent_length, flags) = descriptor
+            if i == (len(descriptors)):
+                # The first N-1 extents must be smaller than the requested
+                # length, but the last extent can exceed the requested
+                # length
+                extent_length = min(extent_length, end - offset)
+            yield {"length": extent_length, "flags": flags}
+            offset += extent_length
+            assert_protocol(offset <= end)
+
+
+def coalesce_extents(extents):
+    """Merge the consecutive extents with the same flags"""
+    previous = None
+    for extent in extents:
+        if previous is None:
+            previous = dict(extent)
+        elif extent["flags"] == previous["flags"]:
+            previous["length"] += extent["length"]
+        else:
+            yield previous
+            previous = dict(extent)
+    if previous is not None:
+        yield previous
+
+
+def write_extents(extents, out, output_format="json"):
+    """
+    Write the extents to the binary file out as they are received, in the
+    output format: one of OUTPUT_FORMATS.
+    """
+    if output_format == "binary":
+        for extent in extents:
+            out.write(EXTENT_RECORD.pack(extent["length"], extent["flags"]))
+        return
+    if output_format == "ndjson":
+        for extent in extents:
+            out.write(json.dumps(extent).encode("utf-8") + b"\n")
+            out.flush()
+        return
+    # The output of json.dumps() of the list, without keeping the list
+    out.write(b"[")
+    for i, extent in enumerate(extents):
+        out.write((", " if i else "").encode("utf-8") + json.dumps(extent).encode("utf-8"))
+    out.write(b"]\n")
+
+
+def _get_extents(path, exportname, offset, length, context=BASE_ALLOCATION):
+    (client, context_ids) = open_client(path, exportname, [context])
+    with client:
+        yield from get_extents(client, context_ids[context], offset, length)
 
 
 def _main():
@@ -118,7 +207,7 @@ def _main():
             "overlapping, in the correct order starting from the "
             "specified offset, and exactly cover the requested "
             "area. There might be consecutive extents with the "
-            "same status flags."
+            "same status flags, unless --coalesce is given."
         )
         parser.add_argument(
             "--path",
@@ -144,19 +233,40 @@ def _main():
             help="The returned list of extents will be computed "
             "for an area of this length starting at the given offset",
         )
+        parser.add_argument(
+            "--context",
+            default=BASE_ALLOCATION,
+            help="The metadata context of the block statuses: "
+            "base:allocation (default) or qemu:dirty-bitmap:<name>",
+        )
+        parser.add_argument(
+            "--coalesce",
+            action="store_true",
+            help="Merge the consecutive extents with the same status flags",
+        )
+        parser.add_argument(
+            "--format",
+            choices=OUTPUT_FORMATS,
+            default="json",
+            help="The output format: a JSON list (default), a JSON object per "
+            "line, or binary records of the length (u64) and flags (u32), "
+            "big-endian",
+        )
 
         args = parser.parse_args()
         LOGGER.debug("Called with args %s", args)
 
-        extents = list(
-            _get_extents(
-                path=args.path,
-                exportname=args.exportname,
-                offset=args.offset,
-                length=args.length,
-            )
+        extents = _get_extents(
+            path=args.path,
+            exportname=args.exportname,
+            offset=args.offset,
+            length=args.length,
+            context=args.context,
         )
-        print(json.dumps(extents))
+        if args.coalesce:
+            extents = coalesce_extents(extents)
+        write_extents(extents, sys.stdout.buffer, args.format)
+        sys.stdout.buffer.flush()
     except Exception as exc:
         LOGGER.exception(exc)
         raise
@@ -0,0 +1,30 @@
+"""
+Smoke test of the NBD client benchmark suite in nbd_benchmark.py
+
+Runs the benchmarks on small files with few I/Os to check that they work.
+For the numbers, run it with the default sizes:
+
+    python3 ocaml/vhd-tool/scripts/nbd_benchmark.py
+"""
+
+from nbd_benchmark import FRAGMENT_SIZE, run
+
+
+def it_measures_each_benchmark():
+    """
+    Given the benchmarks are run against python_nbd_server.py,
+    they report the throughput of each operation of the client.
+    """
+    results = {result["benchmark"]: result for result in run(size=4 << 20, ios=200)}
+
+    for benchmark in ("sequential_read", "sequential_write"):
+        assert results[benchmark]["size"] == 4 << 20
+        assert results[benchmark]["mb_per_second"] > 0
+    for benchmark in ("random_read_4k", "random_write_4k"):
+        assert results[benchmark]["iops"] > 0
+    assert results["handshake"]["ms"] > 0
+    # A data extent and a hole for each fragment
+    assert results["block_status"]["extents"] == 2 * (4 << 20) // FRAGMENT_SIZE
+    assert results["block_status"]["extents_per_second"] > 0
+    if "tls_handshake" in results:
+        assert results["tls_handshake"]["ms"] > 0
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+Benchmark the throughput of python_nbd_client.py
+
+Runs against NBD servers over Unix sockets: by default, instances of
+python_nbd_server.py serving temporary files, started in separate processes,
+or with --socket, an existing server (like qemu-nbd or tapdisk) of an export,
+which is only read unless --write: the write benchmarks overwrite it.
+
+Reports, one result per benchmark:
+
+- handshake:       the time of connecting to the export, in ms, with and
+                   without TLS (the TLS one needs openssl to create a
+                   certificate, and is skipped with --socket)
+- sequential_read: the MB/s of reading the export with read_into
+- sequential_write: the MB/s of writing the export with write, then flushing
+- random_read_4k:  the IOPS of 4 KiB reads at random offsets with read_many
+- random_write_4k: the IOPS of 4 KiB writes at random offsets with write_many
+- block_status:    the extents/s and MB/s of sweeping the base:allocation
+                   extents of a sparse file with a data block every 64 KiB
+                   (or of the export with --socket) with get_nbd_extents.py
+
+Usage:
+
+    python3 nbd_benchmark.py [--size MiB] [--ios N] [--json]
+                             [--socket PATH --exportname NAME [--write]]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import get_nbd_extents
+from python_nbd_client import PythonNbdClient
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_nbd_server.py")
+BUFFER_SIZE = 4 << 20
+IO_SIZE = 4096
+# The distance between the data blocks of the fragmented sparse file
+FRAGMENT_SIZE = 64 << 10
+HANDSHAKES = 50
+
+
+def _wait_for_socket(path, process, timeout=10):
+    """Wait until the server started in process accepts connections"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("The NBD server exited with {}".format(process.returncode))
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+class Server:
+    """A python_nbd_server.py serving the file in a separate process"""
+
+    def __init__(self, path, file, cert=None, key=None):
+        self.path = path
+        command = [sys.executable, SERVER, "--socket", path, "--file", file]
+        if cert:
+            command += ["--cert", cert, "--key", key]
+        self._process = subprocess.Popen(command)  # pylint: disable=consider-using-with
+        try:
+            _wait_for_socket(path, self._process)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        # The server removes its socket when interrupted
+        self._process.send_signal(signal.SIGINT)
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _create_certificate(directory):
+    """Return the paths of a self-signed certificate and its key, if possible"""
+    if not shutil.which("openssl"):
+        return (None, None)
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return (cert, key)
+
+
+def _create_data_file(path, size):
+    """Create a file of size bytes of random data"""
+    chunk = os.urandom(min(size, 1 << 20))
+    with open(path, "wb") as data_file:
+        for offset in range(0, size, len(chunk)):
+            data_file.write(chunk[: size - offset])
+
+
+def _create_fragmented_file(path, size):
+    """Create a sparse file with a data block every FRAGMENT_SIZE bytes"""
+    with open(path, "wb") as sparse_file:
+        sparse_file.truncate(size)
+        for offset in range(0, size, FRAGMENT_SIZE):
+            sparse_file.seek(offset)
+            sparse_file.write(b"x" * IO_SIZE)
+
+
+def _client(path, exportname="", **kwargs):
+    kwargs.setdefault("use_tls", False)
+    return PythonNbdClient(path, exportname=exportname, unix=True, **kwargs)
+
+
+def _mb_per_second(size, seconds):
+    return round(size / (1 << 20) / seconds, 1)
+
+
+def measure_handshake(path, exportname="", handshakes=HANDSHAKES, **kwargs):
+    """Return the average time of connecting to the export in ms"""
+    start = time.perf_counter()
+    for _ in range(handshakes):
+        _client(path, exportname, **kwargs).close()
+    return round((time.perf_counter() - start) / handshakes * 1000, 3)
+
+
+def measure_sequential_read(client):
+    """Return the MB/s of reading the whole export"""
+    size = client.get_size()
+    buffer = bytearray(BUFFER_SIZE)
+    start = time.perf_counter()
+    for offset in range(0, size, BUFFER_SIZE):
+        client.read_into(offset, memoryview(buffer)[: min(BUFFER_SIZE, size - offset)])
+    return _mb_per_second(size, time.perf_counter() - start)
+
+
+def measure_sequential_write(client):
+    """Return the MB/s of writing the whole export and flushing it"""
+    size = client.get_size()
+    buffer = os.urandom(BUFFER_SIZE)
+    start = time.perf_counter()
+    for offset in range(0, size, BUFFER_SIZE):
+        client.write(memoryview(buffer)[: min(BUFFER_SIZE, size - offset)], offset)
+    client.flush()
+    return _mb_per_second(size, time.perf_counter() - start)
+
+
+def _random_offsets(size, ios, seed=0):
+    generator = random.Random(seed)
+    return [generator.randrange(size // IO_SIZE) * IO_SIZE for _ in range(ios)]
+
+
+def measure_random_reads(client, ios):
+    """Return the IOPS of IO_SIZE reads at random offsets"""
+    requests = [(offset, IO_SIZE) for offset in _random_offsets(client.get_size(), ios)]
+    start = time.perf_counter()
+    for _ in client.read_many(requests):
+        pass
+    return round(ios / (time.perf_counter() - start))
+
+
+def measure_random_writes(client, ios):
+    """Return the IOPS of IO_SIZE writes at random offsets, then flushing"""
+    data = os.urandom(IO_SIZE)
+    requests = [(offset, data) for offset in _random_offsets(client.get_size(), ios, 1)]
+    start = time.perf_counter()
+    client.write_many(requests)
+    client.flush()
+    return round(ios / (time.perf_counter() - start))
+
+
+def measure_block_status(path, exportname=""):
+    """Return the extents/s and MB/s of sweeping the base:allocation extents"""
+    (client, context_ids) = get_nbd_extents.open_client(path, exportname)
+    with client:
+        size = client.get_size()
+        start = time.perf_counter()
+        extents = sum(
+            1 for _ in get_nbd_extents.get_extents(
+                client, context_ids[get_nbd_extents.BASE_ALLOCATION], 0, size
+            )
+        )
+        seconds = time.perf_counter() - start
+    return {
+        "extents": extents,
+        "extents_per_second": round(extents / seconds),
+        "mb_per_second": _mb_per_second(size, seconds),
+    }
+
+
+def measure(path, exportname="", ios=10000, read_only=True, block_status_path=None):
+    """
+    Run the benchmarks against the export, return a list of results. Unless
+    read_only is False, the write benchmarks, which overwrite the export,
+    are skipped.
+    """
+    results = [{"benchmark": "handshake", "ms": measure_handshake(path, exportname)}]
+    with _client(path, exportname) as client:
+        size = client.get_size()
+        results.append({"benchmark": "sequential_read", "size": size,
+                        "mb_per_second": measure_sequential_read(client)})
+        if not read_only:
+            results.append({"benchmark": "sequential_write", "size": size,
+                            "mb_per_second": measure_sequential_write(client)})
+        results.append({"benchmark": "random_read_4k", "ios": ios,
+                        "queue_depth": client.queue_depth,
+                        "iops": measure_random_reads(client, ios)})
+        if not read_only:
+            results.append({"benchmark": "random_write_4k", "ios": ios,
+                            "queue_depth": client.queue_depth,
+                            "iops": measure_random_writes(client, ios)})
+    results.append(dict(benchmark="block_status",
+                        **measure_block_status(block_status_path or path, exportname)))
+    return results
+
+
+def run(size=256 << 20, ios=10000):
+    """
+    Run the benchmarks against python_nbd_server.py instances serving
+    temporary files of size bytes, return a list of results
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        data_file = os.path.join(directory, "data.img")
+        sparse_file = os.path.join(directory, "sparse.img")
+        _create_data_file(data_file, size)
+        _create_fragmented_file(sparse_file, size)
+        with Server(os.path.join(directory, "data.sock"), data_file) as server, \
+                Server(os.path.join(directory, "sparse.sock"), sparse_file) as sparse_server:
+            results = measure(
+                server.path, ios=ios, read_only=False, block_status_path=sparse_server.path
+            )
+        (cert, key) = _create_certificate(directory)
+        if cert:
+            with open(cert) as pem:
+                cadata = pem.read()
+            tls_path = os.path.join(directory, "tls.sock")
+            with Server(tls_path, data_file, cert, key):
+                results.append({
+                    "benchmark": "tls_handshake",
+                    "ms": measure_handshake(tls_path, use_tls=True, cert=cadata),
+                })
+    return results
+
+
+def main():
+    """Run the benchmarks and print the results"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=256, help="the size of the files in MiB")
+    parser.add_argument("--ios", type=int, default=10000, help="the number of random I/Os")
+    parser.add_argument("--json", action="store_true", help="print one JSON line per result")
+    parser.add_argument("--socket", help="the Unix socket of an existing NBD server")
+    parser.add_argument("--exportname", default="", help="the export of the existing server")
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="also run the write benchmarks, overwriting the data of the existing export",
+    )
+    args = parser.parse_args()
+
+    if args.socket:
+        results = measure(args.socket, args.exportname, args.ios, read_only=not args.write)
+    else:
+        results = run(args.size << 20, args.ios)
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(" ".join("{}={}".format(key, value) for key, value in result.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+Copies an NBD export to a file, a block device or another NBD export,
+reading only its data extents.
+
+The extents of the base:allocation metadata context (see get_nbd_extents.py)
+tell which parts of the export are zeroes: instead of being read and
+written, they are punched as holes into the destination, or written with
+NBD_CMD_WRITE_ZEROES, so the time of a copy is proportional to the data of
+the export, not to its size. The data is read into a bounded pool of buffers
+while the previous buffers are written from another thread.
+
+Prints the statistics of the copy as JSON.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import stat
+import threading
+import time
+
+import get_nbd_extents
+import python_nbd_client
+from python_nbd_client import PythonNbdClient
+
+LOGGER = logging.getLogger("nbd_copy")
+LOGGER.setLevel(logging.DEBUG)
+
+# The size and the number of the buffers of the data being copied
+BUFFER_SIZE = 4 << 20
+BUFFERS = 4
+
+# The size of the read requests pipelined to fill a buffer, unless the
+# maximum block size of the export is smaller
+REQUEST_SIZE = 1 << 20
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_ZEROES = bytes(BUFFER_SIZE)
+
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocate the range of the file, which then reads as zeroes. Raises
+    OSError with EOPNOTSUPP if the file system does not support it.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if libc.fallocate(fd, mode, offset, length) < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+class FileDestination:
+    """
+    Writes the copy to a file or a block device. Unless truncate is False,
+    a regular file is truncated to the size of the copy, so its zero extents
+    are already holes.
+    """
+
+    def __init__(self, path, size, truncate=True):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._is_empty = False
+        self._can_punch_holes = True
+        mode = os.fstat(self._fd).st_mode
+        if stat.S_ISREG(mode) and truncate:
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, size)
+            self._is_empty = True
+        elif os.lseek(self._fd, 0, os.SEEK_END) < size:
+            os.close(self._fd)
+            raise ValueError("{} is smaller than {} bytes".format(path, size))
+
+    def write(self, offset, view):
+        """Write the memoryview at offset"""
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def zero(self, offset, length):
+        """Make the length bytes at offset zeroes"""
+        if self._is_empty:
+            return
+        if self._can_punch_holes:
+            try:
+                punch_hole(self._fd, offset, length)
+                return
+            except (OSError, AttributeError) as exc:
+                if getattr(exc, "errno", None) not in (None, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+                LOGGER.info("Cannot punch holes into %s, writing zeroes", self.path)
+                self._can_punch_holes = False
+        for start in range(offset, offset + length, len(_ZEROES)):
+            size = min(len(_ZEROES), offset + length - start)
+            self.write(start, memoryview(_ZEROES)[:size])
+
+    def close(self):
+        """Make the copy durable"""
+        try:
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+
+
+class NbdDestination:
+    """Writes the copy to an NBD export"""
+
+    def __init__(self, client, size, request_size=REQUEST_SIZE):
+        self._client = client
+        self._request_size = min(request_size, client.request_size())
+        if client.get_size() < size:
+            client.close()
+            raise ValueError("The destination export is smaller than {} bytes".format(size))
+
+    def _write_many(self, offset, view):
+        self._client.write_many(
+            (offset + start, view[start : start + self._request_size])
+            for start in range(0, len(view), self._request_size)
+        )
+
+    def write(self, offset, view):
+        """Write the memoryview at offset"""
+        self._write_many(offset, view)
+
+    def zero(self, offset, length):
+        """Make the length bytes at offset zeroes"""
+        if self._client.can_write_zeroes():
+            self._client.write_zeroes(offset, length)
+            return
+        for start in range(offset, offset + length, len(_ZEROES)):
+            size = min(len(_ZEROES), offset + length - start)
+            self._write_many(start, memoryview(_ZEROES)[:size])
+
+    def close(self):
+        """Flush and disconnect"""
+        self._client.close()
+
+
+class _Writer(threading.Thread):
+    """Writes the queued buffers to the destination and frees them"""
+
+    def __init__(self, destination, free_buffers):
+        super().__init__(name="nbd-copy-writer", daemon=True)
+        self.destination = destination
+        self.free_buffers = free_buffers
+        self.writes = queue.Queue()
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            (offset, buffer, length) = item
+            try:
+                if self.error is None:
+                    if buffer is None:
+                        self.destination.zero(offset, length)
+                    else:
+                        self.destination.write(offset, memoryview(buffer)[:length])
+            except Exception as exc:  # pylint: disable=broad-except
+                self.error = exc
+            if buffer is not None:
+                self.free_buffers.put(buffer)
+
+
+def copy(client, meta_context_id, destination, buffer_size=BUFFER_SIZE, buffers=BUFFERS,
+         request_size=REQUEST_SIZE):
+    """
+    Copy the export of the connected client, whose base:allocation context
+    is meta_context_id, to the destination. Returns the statistics of the
+    copy as a dict.
+    """
+    size = client.get_size()
+    request_size = min(request_size, client.request_size())
+    free_buffers = queue.Queue()
+    for _ in range(buffers):
+        free_buffers.put(bytearray(buffer_size))
+    writer = _Writer(destination, free_buffers)
+    writer.start()
+    copied = skipped = 0
+    start_time = time.monotonic()
+    try:
+        offset = 0
+        for extent in get_nbd_extents.get_extents(client, meta_context_id, 0, size):
+            length = extent["length"]
+            if writer.error:
+                break
+            if extent["flags"] & python_nbd_client.NBD_STATE_ZERO:
+                writer.writes.put((offset, None, length))
+                skipped += length
+                offset += length
+                continue
+            end = offset + length
+            while offset < end:
+                chunk = min(buffer_size, end - offset)
+                buffer = free_buffers.get()
+                client.read_into(offset, memoryview(buffer)[:chunk], request_size=request_size)
+                writer.writes.put((offset, buffer, chunk))
+                copied += chunk
+                offset += chunk
+    finally:
+        writer.writes.put(None)
+        writer.join()
+    if writer.error:
+        raise writer.error
+    seconds = time.monotonic() - start_time
+    return {
+        "size": size,
+        "bytes_copied": copied,
+        "bytes_skipped": skipped,
+        "seconds": round(seconds, 3),
+        "copied_mb_per_second": round(copied / (1 << 20) / seconds, 1) if seconds else None,
+    }
+
+
+def _main():
+    # Log into syslog, like get_nbd_extents.py
+    syslog_handler = logging.handlers.SysLogHandler(
+        address="/dev/log", facility=logging.handlers.SysLogHandler.LOG_USER
+    )
+    formatter = logging.Formatter("%(name)s: [%(levelname)s] %(message)s")
+    syslog_handler.setFormatter(formatter)
+    logging.getLogger().addHandler(syslog_handler)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        parser.add_argument(
+            "--path",
+            required=True,
+            help="The path of the Unix domain socket of the NBD server to copy from",
+        )
+        parser.add_argument(
+            "--exportname", required=True, help="The export name of the device to copy"
+        )
+        destination = parser.add_mutually_exclusive_group(required=True)
+        destination.add_argument(
+            "--dest-file",
+            help="The file or block device to copy to. Files are truncated first.",
+        )
+        destination.add_argument(
+            "--dest-path", help="The path of the Unix domain socket of the NBD server to copy to"
+        )
+        parser.add_argument(
+            "--dest-exportname", default="", help="The export name of the device to copy to"
+        )
+        parser.add_argument(
+            "--buffer-size", type=int, default=BUFFER_SIZE, help="The size of the buffers"
+        )
+        parser.add_argument(
+            "--buffers", type=int, default=BUFFERS, help="The number of buffers"
+        )
+        args = parser.parse_args()
+        LOGGER.debug("Called with args %s", args)
+
+        (client, context_ids) = get_nbd_extents.open_client(args.path, args.exportname)
+        meta_context_id = context_ids[get_nbd_extents.BASE_ALLOCATION]
+        with client:
+            if args.dest_file:
+                target = FileDestination(args.dest_file, client.get_size())
+            else:
+                target = NbdDestination(
+                    PythonNbdClient(
+                        args.dest_path, exportname=args.dest_exportname, unix=True, use_tls=False
+                    ),
+                    client.get_size(),
+                )
+            try:
+                stats = copy(client, meta_context_id, target, args.buffer_size, args.buffers)
+            finally:
+                target.close()
+        LOGGER.info("Copied %s: %s", args.exportname, stats)
+        print(json.dumps(stats))
+    except Exception as exc:
+        LOGGER.exception(exc)
+        raise
+
+
+if __name__ == "__main__":
+    _main()
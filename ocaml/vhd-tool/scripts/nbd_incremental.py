@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+Exports the blocks of an NBD export changed since a previous backup, and
+applies them to a copy of the previous backup.
+
+"export" reads only the extents marked dirty in the qemu:dirty-bitmap:<name>
+metadata context of the export, which tracks the changes since the bitmap
+was created with the previous backup, and writes them as a stream of
+changes. Of the dirty extents, those which are zeroes in the base:allocation
+context are recorded without their data.
+
+"apply" writes the changes of a stream to a file, a block device or an NBD
+export holding the previous backup, which then holds the new one.
+
+The stream starts with a header, STREAM_HEADER: the magic STREAM_MAGIC and
+the size of the export. It is followed by the map of the changes, as
+RECORD_HEADER records of their kind, offset and length, each CHANGE_DATA
+record followed by its length bytes of data, and ended by a CHANGE_END
+record.
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import struct
+import sys
+import time
+
+import get_nbd_extents
+import nbd_copy
+import python_nbd_client
+from python_nbd_client import PythonNbdClient
+
+LOGGER = logging.getLogger("nbd_incremental")
+LOGGER.setLevel(logging.DEBUG)
+
+STREAM_MAGIC = b"NBDDIFF1"
+STREAM_HEADER = struct.Struct(">8sQ")
+RECORD_HEADER = struct.Struct(">BQQ")
+
+# The kinds of the records of the stream
+CHANGE_END = 0
+CHANGE_DATA = 1
+CHANGE_ZERO = 2
+
+# The maximum length of the data of a record
+CHUNK_SIZE = 4 << 20
+
+
+class NBDStreamError(Exception):
+    """The stream of changes is invalid or truncated."""
+
+
+def _readinto_exactly(stream, view):
+    while view:
+        read = stream.readinto(view)
+        if not read:
+            raise NBDStreamError("The stream of changes is truncated")
+        view = view[read:]
+
+
+def export_changes(client, context_ids, bitmap, out, chunk_size=CHUNK_SIZE):
+    """
+    Writes the changes of the export of the client, with base:allocation
+    and the dirty bitmap contexts selected, as a stream to the binary file
+    out. Returns the statistics of the export as a dict.
+    """
+    size = client.get_size()
+    dirty_context_id = context_ids[get_nbd_extents.DIRTY_BITMAP_PREFIX + bitmap]
+    allocation_context_id = context_ids[get_nbd_extents.BASE_ALLOCATION]
+    buffer = bytearray(chunk_size)
+    stats = {"size": size, "dirty_bytes": 0, "data_bytes": 0, "zero_bytes": 0}
+    start_time = time.monotonic()
+    out.write(STREAM_HEADER.pack(STREAM_MAGIC, size))
+    offset = 0
+    for dirty_extent in get_nbd_extents.get_extents(client, dirty_context_id, 0, size):
+        dirty_end = offset + dirty_extent["length"]
+        if not dirty_extent["flags"] & python_nbd_client.NBD_STATE_DIRTY:
+            offset = dirty_end
+            continue
+        stats["dirty_bytes"] += dirty_extent["length"]
+        for extent in get_nbd_extents.get_extents(
+            client, allocation_context_id, offset, dirty_extent["length"]
+        ):
+            end = offset + extent["length"]
+            if extent["flags"] & python_nbd_client.NBD_STATE_ZERO:
+                out.write(RECORD_HEADER.pack(CHANGE_ZERO, offset, extent["length"]))
+                stats["zero_bytes"] += extent["length"]
+                offset = end
+                continue
+            while offset < end:
+                length = min(chunk_size, end - offset)
+                view = memoryview(buffer)[:length]
+                client.read_into(offset, view)
+                out.write(RECORD_HEADER.pack(CHANGE_DATA, offset, length))
+                out.write(view)
+                stats["data_bytes"] += length
+                offset += length
+        python_nbd_client.assert_protocol(offset == dirty_end)
+    out.write(RECORD_HEADER.pack(CHANGE_END, 0, 0))
+    stats["seconds"] = round(time.monotonic() - start_time, 3)
+    return stats
+
+
+def read_size(stream):
+    """Return the size of the export of the stream of changes"""
+    header = bytearray(STREAM_HEADER.size)
+    _readinto_exactly(stream, memoryview(header))
+    (magic, size) = STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC:
+        raise NBDStreamError("Not a stream of changes: {}".format(bytes(magic)))
+    return size
+
+
+def apply_changes(stream, destination, chunk_size=CHUNK_SIZE):
+    """
+    Applies the changes of the stream, after its header has been read by
+    read_size, to the destination of nbd_copy. Returns the statistics of
+    the changes as a dict.
+    """
+    buffer = bytearray(chunk_size)
+    header = bytearray(RECORD_HEADER.size)
+    stats = {"data_bytes": 0, "zero_bytes": 0}
+    while True:
+        _readinto_exactly(stream, memoryview(header))
+        (kind, offset, length) = RECORD_HEADER.unpack(header)
+        if kind == CHANGE_END:
+            return stats
+        if kind == CHANGE_ZERO:
+            destination.zero(offset, length)
+            stats["zero_bytes"] += length
+        elif kind == CHANGE_DATA:
+            for start in range(offset, offset + length, len(buffer)):
+                view = memoryview(buffer)[: min(len(buffer), offset + length - start)]
+                _readinto_exactly(stream, view)
+                destination.write(start, view)
+            stats["data_bytes"] += length
+        else:
+            raise NBDStreamError("Invalid record: {}".format((kind, offset, length)))
+
+
+def _export(args):
+    contexts = [get_nbd_extents.BASE_ALLOCATION, get_nbd_extents.DIRTY_BITMAP_PREFIX + args.bitmap]
+    (client, context_ids) = get_nbd_extents.open_client(args.path, args.exportname, contexts)
+    with client:
+        if args.output == "-":
+            return export_changes(client, context_ids, args.bitmap, sys.stdout.buffer)
+        with open(args.output, "wb") as out:
+            return export_changes(client, context_ids, args.bitmap, out)
+
+
+def _apply(args):
+    with open(args.input, "rb") if args.input != "-" else sys.stdin.buffer as stream:
+        size = read_size(stream)
+        if args.dest_file:
+            destination = nbd_copy.FileDestination(args.dest_file, size, truncate=False)
+        else:
+            client = PythonNbdClient(
+                args.dest_path, exportname=args.dest_exportname, unix=True, use_tls=False
+            )
+            destination = nbd_copy.NbdDestination(client, size)
+        try:
+            return apply_changes(stream, destination)
+        finally:
+            destination.close()
+
+
+def _main():
+    # Log into syslog, like get_nbd_extents.py
+    syslog_handler = logging.handlers.SysLogHandler(
+        address="/dev/log", facility=logging.handlers.SysLogHandler.LOG_USER
+    )
+    formatter = logging.Formatter("%(name)s: [%(levelname)s] %(message)s")
+    syslog_handler.setFormatter(formatter)
+    logging.getLogger().addHandler(syslog_handler)
+
+    try:
+        parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+        commands = parser.add_subparsers(dest="command")
+        commands.required = True
+        export = commands.add_parser("export", help="Export the changes of an NBD export")
+        export.add_argument(
+            "--path", required=True, help="The path of the Unix domain socket of the NBD server"
+        )
+        export.add_argument(
+            "--exportname", required=True, help="The export name of the device"
+        )
+        export.add_argument(
+            "--bitmap", required=True, help="The name of the dirty bitmap of the export"
+        )
+        export.add_argument(
+            "--output", required=True, help="The file to write the changes to, - for stdout"
+        )
+        apply = commands.add_parser("apply", help="Apply changes to a previous backup")
+        apply.add_argument(
+            "--input", required=True, help="The file of the changes, - for stdin"
+        )
+        destination = apply.add_mutually_exclusive_group(required=True)
+        destination.add_argument("--dest-file", help="The file or block device to apply to")
+        destination.add_argument(
+            "--dest-path", help="The path of the Unix domain socket of the NBD server to apply to"
+        )
+        apply.add_argument(
+            "--dest-exportname", default="", help="The export name of the device to apply to"
+        )
+        args = parser.parse_args()
+        LOGGER.debug("Called with args %s", args)
+
+        stats = _export(args) if args.command == "export" else _apply(args)
+        LOGGER.info("%s: %s", args.command, stats)
+        # The changes may be written to stdout
+        print(json.dumps(stats), file=sys.stderr if args.command == "export" else sys.stdout)
+    except Exception as exc:
+        LOGGER.exception(exc)
+        raise
+
+
+if __name__ == "__main__":
+    _main()
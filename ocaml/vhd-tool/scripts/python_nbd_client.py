@@ -23,8 +23,21 @@ newstyle negotiations:
 https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
 Additionally, it supports the BLOCK_STATUS extension:
 for the extension docs, see the same file in the extension-blockstatus branch.
+
+Reads and writes can be pipelined with read_many and write_many, which keep
+up to queue_depth requests in flight and match the replies, which the server
+may send in any order, to their requests by handle. read_into receives the
+data directly into a buffer of the caller.
+
+MultiConnNbdClient stripes reads and writes across several connections to
+exports of servers that advertise NBD_FLAG_CAN_MULTI_CONN.
+
+CachingNbdClient caches the blocks read with a client, reading ahead of
+sequential reads.
 """
 
+import collections
+import concurrent.futures
 import logging
 import socket
 import ssl
@@ -32,17 +45,30 @@ import struct
 
 LOGGER = logging.getLogger("python_nbd_client")
 
+# The default number of requests sent before waiting for their replies
+DEFAULT_QUEUE_DEPTH = 16
+
 # Request types
 NBD_CMD_READ = 0
 NBD_CMD_WRITE = 1
 # a disconnect request
 NBD_CMD_DISC = 2
 NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+NBD_CMD_WRITE_ZEROES = 6
 NBD_CMD_BLOCK_STATUS = 7
 
+# Command flags
+NBD_CMD_FLAG_FUA = 1 << 0
+NBD_CMD_FLAG_NO_HOLE = 1 << 1
+
 # Transmission flags
 NBD_FLAG_HAS_FLAGS = 1 << 0
 NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_SEND_FUA = 1 << 3
+NBD_FLAG_SEND_TRIM = 1 << 5
+NBD_FLAG_SEND_WRITE_ZEROES = 1 << 6
+NBD_FLAG_CAN_MULTI_CONN = 1 << 8
 
 # Client flags
 NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
@@ -74,18 +100,31 @@ NBD_REPLY_TYPE_OFFSET_DATA = 1
 NBD_REPLY_TYPE_OFFSET_HOLE = 2
 NBD_REPLY_TYPE_BLOCK_STATUS = 5
 NBD_REPLY_TYPE_ERROR_BIT = 1 << 15
-NBD_REPLY_TYPE_ERROR = 1 << 15 + 1
-NBD_REPLY_TYPE_ERROR_OFFSET = 1 << 15 + 2
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+NBD_REPLY_TYPE_ERROR_OFFSET = (1 << 15) + 2
 
 # Structured reply flags
 NBD_REPLY_FLAG_DONE = 1 << 0
 
+# Flags of the extents of the base:allocation metadata context
+NBD_STATE_HOLE = 1 << 0
+NBD_STATE_ZERO = 1 << 1
+
+# Flag of the extents of the qemu:dirty-bitmap:<name> metadata contexts
+NBD_STATE_DIRTY = 1 << 0
+
 # NBD_INFO information types
 NBD_INFO_EXPORT = 0
 NBD_INFO_NAME = 1
 NBD_INFO_DESCRIPTION = 2
 NBD_INFO_BLOCK_SIZE = 3
 
+# The block size constraints assumed when the server does not send
+# NBD_INFO_BLOCK_SIZE, see get_block_size
+DEFAULT_MINIMUM_BLOCK_SIZE = 512
+DEFAULT_PREFERRED_BLOCK_SIZE = 4096
+DEFAULT_MAXIMUM_BLOCK_SIZE = 32 << 20
+
 
 class NBDEOFError(EOFError):
     """
@@ -162,8 +201,8 @@ class NBDUnexpectedStructuredReplyType(Exception):
 
 class NBDUnexpectedReplyHandleError(Exception):
     """
-    The NBD server sent a reply to a request different from the most recent one
-    that the client is expecting a response to.
+    The NBD server sent a reply with a handle that does not belong to any of
+    the requests that the client is expecting a response to.
 
     :attribute expected: The handle of the most recent request that the client
                          is expecting a reply to.
@@ -180,6 +219,19 @@ class NBDUnexpectedReplyHandleError(Exception):
         self.received = received
 
 
+class NBDUnsupportedCommandError(Exception):
+    """
+    The NBD server does not advertise support for the command in its
+    transmission flags.
+
+    :attribute command: The command that is not supported.
+    """
+
+    def __init__(self, command):
+        super().__init__("Server does not support command {}".format(command))
+        self.command = command
+
+
 class NBDProtocolError(Exception):
     """
     The NBD server sent an invalid response that is not allowed by the NBD
@@ -193,10 +245,65 @@ def assert_protocol(assertion):
         raise NBDProtocolError
 
 
-def _check_alignment(name, value):
-    if not value % 512:
+def _check_alignment(name, value, alignment=DEFAULT_MINIMUM_BLOCK_SIZE):
+    if not value % alignment:
         return
-    raise ValueError("%s=%i is not a multiple of 512" % (name, value))
+    raise ValueError("%s=%i is not a multiple of %i" % (name, value, alignment))
+
+
+# Copied into the buffers of read_into for holes
+_ZEROES = bytes(1 << 16)
+
+
+def _fill_zeroes(view):
+    for start in range(0, len(view), len(_ZEROES)):
+        end = min(start + len(_ZEROES), len(view))
+        view[start:end] = _ZEROES[: end - start]
+
+
+def _destination(target, offset, length):
+    """
+    Return the part of the buffer of target, the (offset, memoryview) of a
+    read request, for the length bytes at offset of the export.
+    """
+    (start_offset, view) = target
+    start = offset - start_offset
+    assert_protocol(0 <= start and start + length <= len(view))
+    return view[start : start + length]
+
+
+def tls_context(cert, subject):
+    """
+    Return the SSL context to upgrade connections to TLS, verifying the
+    server with the CA certificate cert, and its name if subject is given.
+    """
+    # Forcing the client to use TLSv1_2
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    context.options &= ~ssl.OP_NO_TLSv1
+    context.options &= ~ssl.OP_NO_TLSv1_1
+    context.options &= ~ssl.OP_NO_SSLv2
+    context.options &= ~ssl.OP_NO_SSLv3
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = subject is not None
+    context.load_verify_locations(cadata=cert)
+    return context
+
+
+def _zero_runs(view, block_size):
+    """
+    Return the (is_zero, start, end) of the runs of blocks of block_size
+    bytes of the memoryview which are all zeroes or not.
+    """
+    runs = []
+    zeroes = bytes(block_size)
+    for start in range(0, len(view), block_size):
+        end = min(start + block_size, len(view))
+        is_zero = view[start:end] == zeroes[: end - start]
+        if runs and runs[-1][0] == is_zero:
+            runs[-1] = (is_zero, runs[-1][1], end)
+        else:
+            runs.append((is_zero, start, end))
+    return runs
 
 
 def _is_final_structured_reply_chunk(flags):
@@ -224,6 +331,12 @@ class PythonNbdClient:
     negotiation, and also has support for upgrading the connection to TLS
     during fixed-newstyle negotiation, structured replies, and the BLOCK_STATUS
     extension.
+
+    :param queue_depth: The maximum number of requests that read_many and
+                        write_many keep in flight.
+
+    Unless connect is False, the block sizes of the export are negotiated
+    before connecting to it; otherwise negotiate_block_size may be called.
     """
 
     def __init__(
@@ -238,11 +351,16 @@ class PythonNbdClient:
         new_style_handshake=True,
         unix=False,
         connect=True,
+        queue_depth=DEFAULT_QUEUE_DEPTH,
     ):
         LOGGER.info("Creating connection to address '%s' and port '%s'", address, port)
         self._flushed = True
         self._closed = True
         self._handle = 0
+        # handle -> (request type, offset, length) of the requests in flight
+        self._in_flight = {}
+        self.queue_depth = queue_depth
+        self._block_size = None
         self._last_sent_option = None
         self._structured_reply = False
         self._transmission_phase = False
@@ -258,6 +376,7 @@ class PythonNbdClient:
         if new_style_handshake:
             self._fixed_new_style_handshake(cert=cert, subject=subject, use_tls=use_tls)
             if connect:
+                self.negotiate_block_size(exportname)
                 self.connect(exportname=exportname)
         else:
             self._old_style_handshake()
@@ -281,8 +400,11 @@ class PythonNbdClient:
 
     def _recvall(self, length):
         data = bytearray(length)
-        view = memoryview(data)
-        bytes_left = length
+        self._recvall_into(memoryview(data))
+        return data
+
+    def _recvall_into(self, view):
+        bytes_left = len(view)
         while bytes_left:
             received = self._s.recv_into(view, bytes_left)
             # If recv reads 0 bytes, that means the peer has properly
@@ -291,7 +413,6 @@ class PythonNbdClient:
                 raise NBDEOFError
             view = view[received:]
             bytes_left -= received
-        return data
 
     # Handshake phase
 
@@ -321,9 +442,12 @@ class PythonNbdClient:
             raise NBDUnexpectedOptionResponseError(
                 expected=self._last_sent_option, received=option
             )
+        data = self._recvall(data_length)
         if reply_type & NBD_REP_ERROR_BIT != 0:
+            # The data of errors, if any, is a message for humans, which must
+            # be received for the next reply to be parsed
+            LOGGER.debug("NBD option error: %s", data)
             raise NBDOptionError(reply=reply_type)
-        data = self._recvall(data_length)
         return (reply_type, data)
 
     def _parse_option_reply_ack(self):
@@ -342,15 +466,7 @@ class PythonNbdClient:
         return (context_id, name)
 
     def _upgrade_socket_to_tls(self, cert, subject):
-        # Forcing the client to use TLSv1_2
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        context.options &= ~ssl.OP_NO_TLSv1
-        context.options &= ~ssl.OP_NO_TLSv1_1
-        context.options &= ~ssl.OP_NO_SSLv2
-        context.options &= ~ssl.OP_NO_SSLv3
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.check_hostname = subject is not None
-        context.load_verify_locations(cadata=cert)
+        context = tls_context(cert, subject)
         cleartext_socket = self._s
         self._s = context.wrap_socket(
             cleartext_socket,
@@ -406,6 +522,93 @@ class PythonNbdClient:
                 raise NBDProtocolError("Unexpected reply type: {}".format(reply_type))
         return infos
 
+    def negotiate_block_size(self, export_name):
+        """
+        Query the block size constraints of the export with NBD_OPT_INFO,
+        which get_block_size then returns. Only valid during the handshake
+        phase. Returns False if the server does not send them.
+        """
+        try:
+            infos = self.request_info(export_name, [NBD_INFO_BLOCK_SIZE])
+        except NBDOptionError as exc:
+            LOGGER.info("Cannot query the block size of '%s': %s", export_name, exc)
+            return False
+        for info in infos:
+            if info["information_type"] == NBD_INFO_BLOCK_SIZE:
+                minimum = info["minimum_block_size"]
+                preferred = info["preferred_block_size"]
+                maximum = info["maximum_block_size"]
+                # The sizes must be powers of 2 (of at least 512 for the
+                # preferred one) and the maximum a multiple of the minimum
+                assert_protocol(minimum and not minimum & (minimum - 1))
+                assert_protocol(preferred >= 512 and not preferred & (preferred - 1))
+                assert_protocol(maximum >= minimum and not maximum % minimum)
+                self._block_size = (minimum, preferred, maximum)
+                LOGGER.debug("NBD got block sizes %s", self._block_size)
+                return True
+        return False
+
+    def get_block_size(self):
+        """
+        Return the minimum, preferred and maximum block sizes of the export
+        as a dict, as sent by the server to negotiate_block_size, or the
+        DEFAULT_*_BLOCK_SIZE constants. Requests must be aligned to the
+        minimum one and should not transfer more data than the maximum one.
+        """
+        (minimum, preferred, maximum) = self._block_size or (
+            DEFAULT_MINIMUM_BLOCK_SIZE,
+            DEFAULT_PREFERRED_BLOCK_SIZE,
+            DEFAULT_MAXIMUM_BLOCK_SIZE,
+        )
+        return {
+            "minimum_block_size": minimum,
+            "preferred_block_size": preferred,
+            "maximum_block_size": maximum,
+        }
+
+    def _check_request(self, offset, length, has_data=True):
+        """
+        Raise a ValueError if the request is not aligned to the minimum
+        block size or, if it transfers data, is larger than the maximum one.
+        """
+        sizes = self.get_block_size()
+        _check_alignment("offset", offset, sizes["minimum_block_size"])
+        _check_alignment("length", length, sizes["minimum_block_size"])
+        if has_data and length > sizes["maximum_block_size"]:
+            raise ValueError(
+                "length=%i is larger than the maximum block size %i"
+                % (length, sizes["maximum_block_size"])
+            )
+
+    def request_size(self):
+        """
+        Return the size of the requests into which bulk transfers are
+        split: the largest multiple of the preferred block size which does
+        not exceed the maximum block size.
+        """
+        sizes = self.get_block_size()
+        maximum = sizes["maximum_block_size"]
+        if maximum < sizes["preferred_block_size"]:
+            return maximum
+        return maximum - maximum % sizes["preferred_block_size"]
+
+    def _split_requests(self, offset, length, request_size=None):
+        """
+        Split the range into the (offset, length) of requests of at most
+        request_size bytes. By default, the requests are of at most
+        self.request_size() bytes, and all but the first one start at a
+        multiple of the preferred block size.
+        """
+        alignment = 1
+        if not request_size:
+            request_size = self.request_size()
+            alignment = min(request_size, self.get_block_size()["preferred_block_size"])
+        end = offset + length
+        while offset < end:
+            request_end = min(end, offset - offset % alignment + request_size)
+            yield (offset, request_end - offset)
+            offset = request_end
+
     def negotiate_structured_reply(self):
         """
         Negotiate use of the structured reply extension, fail if unsupported.
@@ -513,10 +716,12 @@ class PythonNbdClient:
 
     # Transmission phase
 
-    def _send_request_header(self, request_type, offset, length):
+    def _send_request_header(self, request_type, offset, length, command_flags=0):
         LOGGER.debug("NBD request offset=%d length=%d", offset, length)
-        command_flags = 0
         self._handle += 1
+        if request_type != NBD_CMD_DISC:
+            # The server does not reply to NBD_CMD_DISC
+            self._in_flight[self._handle] = (request_type, offset, length)
         header = struct.pack(
             ">LHHQQL",
             NBD_REQUEST_MAGIC,
@@ -527,9 +732,10 @@ class PythonNbdClient:
             length,
         )
         self._s.sendall(header)
+        return self._handle
 
     def _check_handle(self, handle):
-        if handle != self._handle:
+        if handle not in self._in_flight:
             raise NBDUnexpectedReplyHandleError(expected=self._handle, received=handle)
 
     def _parse_simple_reply(self, data_length=0):
@@ -541,6 +747,7 @@ class PythonNbdClient:
         )
         assert_protocol(magic == NBD_SIMPLE_REPLY_MAGIC)
         self._check_handle(handle)
+        del self._in_flight[handle]
         data = self._recvall(length=data_length)
         LOGGER.debug("NBD response received data_length=%d bytes", data_length)
         if errno != 0:
@@ -558,18 +765,25 @@ class PythonNbdClient:
         assert_protocol(descriptors)
         fields["descriptors"] = descriptors
 
-    def _handle_data_reply(self, fields):
+    def _handle_data_reply(self, fields, into):
         data_length = fields["data_length"]
         assert_protocol(data_length >= 9)
         buf = self._recvall(8)
         fields["offset"] = struct.unpack(">Q", buf)[0]
+        if fields["handle"] in into:
+            target = into[fields["handle"]]
+            self._recvall_into(_destination(target, fields["offset"], data_length - 8))
+            return
         fields["data"] = self._recvall(data_length - 8)
         assert_protocol(fields["data"])
 
-    def _handle_hole_reply(self, fields):
+    def _handle_hole_reply(self, fields, into):
         assert_protocol(fields["data_length"] == 12)
         buf = self._recvall(12)
         (fields["offset"], fields["hole_size"]) = struct.unpack(">QL", buf)
+        if fields["handle"] in into:
+            target = into[fields["handle"]]
+            _fill_zeroes(_destination(target, fields["offset"], fields["hole_size"]))
 
     def _handle_structured_reply_error(self, fields):
         data_length = fields["data_length"]
@@ -591,11 +805,18 @@ class PythonNbdClient:
         if fields["reply_type"] == NBD_REPLY_TYPE_ERROR_OFFSET:
             fields["offset"] = struct.unpack(">Q", view)[0]
 
-    def _parse_structured_reply_chunk(self):
+    def _parse_structured_reply_chunk(self, magic=None, into=None):
+        """
+        Receive a structured reply chunk. The data of the reads whose handles
+        are in into, as (offset, memoryview) of the read, is received into
+        their memoryview instead of the fields of the chunk.
+        """
         LOGGER.debug("NBD parsing structured reply chunk")
-        reply = self._recvall(4 + 2 + 2 + 8 + 4)
-        header = struct.unpack(">LHHQL", reply)
-        (magic, flags, reply_type, handle, data_length) = header
+        into = into or {}
+        if magic is None:
+            (magic,) = struct.unpack(">L", self._recvall(4))
+        reply = self._recvall(2 + 2 + 8 + 4)
+        (flags, reply_type, handle, data_length) = struct.unpack(">HHQL", reply)
         LOGGER.debug(
             "NBD structured reply magic='%x' flags='%s' "
             "reply_type='%d' handle='%d' data_length='%d'",
@@ -607,20 +828,27 @@ class PythonNbdClient:
         )
         assert_protocol(magic == NBD_STRUCTURED_REPLY_MAGIC)
         self._check_handle(handle)
-        fields = {"flags": flags, "reply_type": reply_type, "data_length": data_length}
+        fields = {
+            "flags": flags,
+            "reply_type": reply_type,
+            "data_length": data_length,
+            "handle": handle,
+        }
         if reply_type == NBD_REPLY_TYPE_BLOCK_STATUS:
             self._handle_block_status_reply(fields)
         elif reply_type == NBD_REPLY_TYPE_NONE:
             assert_protocol(data_length == 0)
             assert_protocol(_is_final_structured_reply_chunk(flags=flags))
         elif reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
-            self._handle_data_reply(fields)
+            self._handle_data_reply(fields, into)
         elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
-            self._handle_hole_reply(fields)
+            self._handle_hole_reply(fields, into)
         elif is_error_chunk(reply_type=reply_type):
             self._handle_structured_reply_error(fields)
         else:
             raise NBDUnexpectedStructuredReplyType(reply_type)
+        if _is_final_structured_reply_chunk(flags=flags):
+            del self._in_flight[handle]
         return fields
 
     def _parse_structured_reply_chunks(self):
@@ -630,40 +858,309 @@ class PythonNbdClient:
             if _is_final_structured_reply_chunk(flags=reply["flags"]):
                 return
 
-    def write(self, data, offset):
+    def _parse_reply(self, into=None):
+        """
+        Receive the next simple reply or structured reply chunk to any of the
+        requests in flight. Returns its fields, with "done" set for the last
+        reply to the request, which is then no longer in flight. The data of
+        reads in into is received into their buffer, see
+        _parse_structured_reply_chunk.
+        """
+        into = into or {}
+        (magic,) = struct.unpack(">L", self._recvall(4))
+        if magic == NBD_STRUCTURED_REPLY_MAGIC:
+            fields = self._parse_structured_reply_chunk(magic, into)
+            fields["done"] = _is_final_structured_reply_chunk(flags=fields["flags"])
+            return fields
+        assert_protocol(magic == NBD_SIMPLE_REPLY_MAGIC)
+        (errno, handle) = struct.unpack(">LQ", self._recvall(4 + 8))
+        LOGGER.debug("NBD simple reply errno='%d' handle='%d'", errno, handle)
+        self._check_handle(handle)
+        (request_type, _, length) = self._in_flight.pop(handle)
+        fields = {"handle": handle, "done": True}
+        if errno != 0:
+            # The server must not send the data of a failed read
+            fields["error"] = errno
+        elif handle in into:
+            self._recvall_into(into[handle][1])
+        elif request_type == NBD_CMD_READ:
+            fields["data"] = self._recvall(length)
+        return fields
+
+    def _pipeline(self, send_requests, queue_depth, into=None):
+        """
+        Send the requests of the send_requests generator, which yields after
+        each, while keeping at most queue_depth of them in flight. Yields the
+        replies as they arrive, which can be in any order. into is passed to
+        _parse_reply.
+
+        When the caller stops early (like on the first error reply) or
+        send_requests raises, the replies to the requests still in flight
+        are received and dropped, so that the connection can be used for
+        the next requests. When the connection fails (or the server breaks
+        the protocol), the replies cannot be matched to their requests any
+        more: the client is then unusable and must be closed.
+        """
+        queue_depth = queue_depth or self.queue_depth
+        assert_protocol(not self._in_flight)
+        try:
+            for _ in send_requests:
+                while len(self._in_flight) >= queue_depth:
+                    yield self._parse_reply(into)
+            while self._in_flight:
+                yield self._parse_reply(into)
+        except (
+            OSError,
+            EOFError,
+            NBDProtocolError,
+            NBDUnexpectedReplyHandleError,
+            NBDUnexpectedStructuredReplyType,
+        ):
+            self._in_flight.clear()
+            raise
+        finally:
+            self._drain_replies(into)
+
+    def _drain_replies(self, into=None):
+        """Receive and drop the replies to the requests in flight"""
+        try:
+            while self._in_flight:
+                self._parse_reply(into)
+        finally:
+            self._in_flight.clear()
+
+    def read_many(self, requests, queue_depth=None):
+        """
+        Reads the (offset, length) ranges of requests from the export,
+        keeping up to queue_depth (default: self.queue_depth) requests in
+        flight. Yields (offset, data) for each range, in the order in which
+        the server completes them, which need not be the order of requests.
+        """
+        reads = ((offset, memoryview(bytearray(length))) for offset, length in requests)
+        for offset, view in self._read_pipelined(reads, queue_depth):
+            yield (offset, view.obj)
+
+    def read_into(self, offset, buffer, request_size=None, queue_depth=None):
+        """
+        Reads len(buffer) bytes from the export at the given offset directly
+        into the given writable buffer (like a bytearray or a memoryview),
+        without allocating buffers for the data. The read is split into
+        requests of at most request_size bytes (by default, as many as
+        allowed by the block sizes, see _split_requests), of which up to
+        queue_depth (default: self.queue_depth) are in flight.
+        Returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast("B")
+        reads = (
+            (start, view[start - offset : start - offset + length])
+            for start, length in self._split_requests(offset, len(view), request_size)
+        )
+        for _ in self._read_pipelined(reads, queue_depth):
+            pass
+        return len(view)
+
+    def _read_pipelined(self, reads, queue_depth):
+        """
+        Reads the (offset, memoryview) of reads from the export, at offset
+        into the memoryview, and yields them when complete.
+        """
+        # handle -> (offset, memoryview) of the reads in flight
+        into = {}
+
+        def send_requests():
+            for offset, view in reads:
+                self._check_request(offset, len(view))
+                handle = self._send_request_header(NBD_CMD_READ, offset, len(view))
+                into[handle] = (offset, view)
+                yield
+
+        for reply in self._pipeline(send_requests(), queue_depth, into):
+            if "error" in reply:
+                raise NBDTransmissionError(reply["error"])
+            if reply["done"]:
+                yield into.pop(reply["handle"])
+
+    def write_many(self, requests, queue_depth=None):
+        """
+        Writes the data of the (offset, data) pairs of requests to the
+        export, keeping up to queue_depth (default: self.queue_depth)
+        requests in flight. Raises a ValueError for requests larger than
+        the maximum block size. Returns the number of bytes written.
+        """
+        written = 0
+
+        def send_requests():
+            nonlocal written
+            for offset, data in requests:
+                self._check_request(offset, len(data))
+                self._flushed = False
+                self._send_request_header(NBD_CMD_WRITE, offset, len(data))
+                self._s.sendall(data)
+                written += len(data)
+                yield
+
+        for reply in self._pipeline(send_requests(), queue_depth):
+            if "error" in reply:
+                raise NBDTransmissionError(reply["error"])
+        return written
+
+    def write(self, data, offset, fua=False):
         """
         Writes the given bytes to the export, starting at the given
-        offset.
+        offset. With fua, the data is on permanent storage when it returns,
+        see _fua_flags. Data larger than self.request_size() is sent as
+        pipelined requests of this size.
         """
         LOGGER.debug("NBD_CMD_WRITE")
-        _check_alignment("offset", offset)
-        _check_alignment("size", len(data))
+        self._check_request(offset, len(data), has_data=False)
+        view = memoryview(data).cast("B")
+        flags = self._fua_flags(fua)
+
+        def send_requests():
+            for start, length in self._split_requests(offset, len(view)):
+                self._send_request_header(NBD_CMD_WRITE, start, length, flags)
+                self._s.sendall(view[start - offset : start - offset + length])
+                yield
+
         self._flushed = False
-        self._send_request_header(NBD_CMD_WRITE, offset, len(data))
-        self._s.sendall(data)
-        # TODO: the server MAY respond with a structured reply (e.g. to report
-        # errors)
-        self._parse_simple_reply()
+        for reply in self._pipeline(send_requests(), None):
+            if "error" in reply:
+                raise NBDTransmissionError(reply["error"])
+        self._flush_unless_fua(fua)
         return len(data)
 
+    def _request(self, request_type, offset, length, command_flags=0, data=b""):
+        """Send a request without data in its reply and wait for the reply"""
+
+        def send_request():
+            self._send_request_header(request_type, offset, length, command_flags)
+            if data:
+                self._s.sendall(data)
+            yield
+
+        # The server may use a simple or a structured reply
+        for reply in self._pipeline(send_request(), 1):
+            if "error" in reply:
+                raise NBDTransmissionError(reply["error"])
+
+    def _fua_flags(self, fua):
+        """
+        Return the command flags for fua. If the server does not support
+        NBD_CMD_FLAG_FUA, the writes are flushed by _flush_unless_fua instead.
+        """
+        return NBD_CMD_FLAG_FUA if fua and self.can_fua() else 0
+
+    def _flush_unless_fua(self, fua):
+        if fua and not self.can_fua():
+            self.flush()
+
+    def write_zeroes(self, offset, length, no_hole=False, fua=False):
+        """
+        Writes length zeroes to the export at offset without sending them.
+        Unless no_hole, the server may punch a hole to do so.
+        Raises NBDUnsupportedCommandError if the server does not support it.
+        """
+        LOGGER.debug("NBD_CMD_WRITE_ZEROES")
+        if not self.can_write_zeroes():
+            raise NBDUnsupportedCommandError(NBD_CMD_WRITE_ZEROES)
+        self._check_request(offset, length, has_data=False)
+        self._flushed = False
+        flags = self._fua_flags(fua) | (NBD_CMD_FLAG_NO_HOLE if no_hole else 0)
+        self._request(NBD_CMD_WRITE_ZEROES, offset, length, flags)
+        self._flush_unless_fua(fua)
+        return length
+
+    def trim(self, offset, length, fua=False):
+        """
+        Tells the server that the length bytes at offset are no longer
+        needed, after which their content is undefined. As trimming is only
+        advisory, it does nothing and returns False if the server does not
+        support it.
+        """
+        LOGGER.debug("NBD_CMD_TRIM")
+        if not self.can_trim():
+            return False
+        self._check_request(offset, length, has_data=False)
+        self._flushed = False
+        self._request(NBD_CMD_TRIM, offset, length, self._fua_flags(fua))
+        self._flush_unless_fua(fua)
+        return True
+
+    def write_sparse(
+        self, data, offset, block_size=None, max_request_size=None, fua=False, queue_depth=None
+    ):
+        """
+        Writes the given bytes to the export at offset like write, but sends
+        the blocks of block_size (default: the preferred block size) bytes
+        that are zeroes as NBD_CMD_WRITE_ZEROES (which may punch holes) if
+        the server supports it. The runs of data and zero blocks are sent as
+        pipelined requests of at most max_request_size (default:
+        self.request_size()) bytes.
+        Returns the number of bytes of zeroes which were not sent.
+        """
+        sizes = self.get_block_size()
+        block_size = block_size or sizes["preferred_block_size"]
+        self._check_request(offset, len(data), has_data=False)
+        _check_alignment("block_size", block_size, sizes["minimum_block_size"])
+        view = memoryview(data).cast("B")
+        runs = [(False, 0, len(view))]
+        if self.can_write_zeroes():
+            runs = _zero_runs(view, block_size)
+        flags = self._fua_flags(fua)
+        zeroes = 0
+
+        def send_requests():
+            nonlocal zeroes
+            for is_zero, run_start, run_end in runs:
+                for start, length in self._split_requests(
+                    offset + run_start, run_end - run_start, max_request_size
+                ):
+                    if is_zero:
+                        self._send_request_header(NBD_CMD_WRITE_ZEROES, start, length, flags)
+                        zeroes += length
+                    else:
+                        self._send_request_header(NBD_CMD_WRITE, start, length, flags)
+                        self._s.sendall(view[start - offset : start - offset + length])
+                    yield
+
+        self._flushed = False
+        for reply in self._pipeline(send_requests(), queue_depth):
+            if "error" in reply:
+                raise NBDTransmissionError(reply["error"])
+        self._flush_unless_fua(fua)
+        return zeroes
+
     def read(self, offset, length):
         """
         Returns length number of bytes read from the export, starting at
         the given offset.
         If structured replies have been negotiated, it returns a generator
         containing the reply chunks. The caller must consume this generator
-        before further NBD commands, since this client does not support
-        asynchronous request processing.
+        before further NBD commands. Reads larger than the maximum block size
+        are split into requests of self.request_size() bytes, sent one after
+        the other. To have several reads in flight, use read_many or
+        read_into.
         """
         LOGGER.debug("NBD_CMD_READ")
-        _check_alignment("offset", offset)
-        _check_alignment("length", length)
+        self._check_request(offset, length, has_data=False)
+        if length > self.get_block_size()["maximum_block_size"]:
+            if self._structured_reply:
+                return self._read_chunks(offset, length)
+            buffer = bytearray(length)
+            self.read_into(offset, buffer, queue_depth=1)
+            return bytes(buffer)
         self._send_request_header(NBD_CMD_READ, offset, length)
         if self._structured_reply:
             return self._parse_structured_reply_chunks()
         data = self._parse_simple_reply(length)
         return data
 
+    def _read_chunks(self, offset, length):
+        """Yield the structured reply chunks of the split requests of read"""
+        for start, request_length in self._split_requests(offset, length):
+            self._send_request_header(NBD_CMD_READ, start, request_length)
+            yield from self._parse_structured_reply_chunks()
+
     def _need_flush(self):
         return self._transmission_flags & NBD_FLAG_SEND_FLUSH != 0
 
@@ -708,3 +1205,325 @@ class PythonNbdClient:
         Return the size of the device in bytes.
         """
         return self._size
+
+    def can_fua(self):
+        """Return whether the server supports NBD_CMD_FLAG_FUA"""
+        return self._transmission_flags & NBD_FLAG_SEND_FUA != 0
+
+    def can_trim(self):
+        """Return whether the server supports NBD_CMD_TRIM"""
+        return self._transmission_flags & NBD_FLAG_SEND_TRIM != 0
+
+    def can_write_zeroes(self):
+        """Return whether the server supports NBD_CMD_WRITE_ZEROES"""
+        return self._transmission_flags & NBD_FLAG_SEND_WRITE_ZEROES != 0
+
+    def can_multi_conn(self):
+        """
+        Return whether the server allows several connections to the export,
+        with consistent reads across them and flushes covering all of them.
+        """
+        return self._transmission_flags & NBD_FLAG_CAN_MULTI_CONN != 0
+
+
+class MultiConnNbdClient:
+    """
+    Transfers data over several connections to the same export in parallel.
+
+    The transfers are split into stripes of stripe_size bytes, each of which
+    is transferred over the connection of its index modulo the number of
+    connections, so that large transfers use all of them. The connections
+    are made with the keyword arguments of PythonNbdClient (only fixed
+    newstyle connections to exports are supported). If the server does not
+    advertise NBD_FLAG_CAN_MULTI_CONN, only one connection is used.
+    """
+
+    def __init__(self, address, connections=4, stripe_size=1 << 20, **kwargs):
+        if stripe_size % 512:
+            raise ValueError("stripe_size=%i is not a multiple of 512" % stripe_size)
+        kwargs.update(new_style_handshake=True, connect=True)
+        self._clients = [PythonNbdClient(address, **kwargs)]
+        # A stripe is read or written with a single request
+        self.stripe_size = min(stripe_size, self._clients[0].request_size())
+        try:
+            if not self._clients[0].can_multi_conn():
+                LOGGER.info("The server does not support multiple connections")
+                connections = 1
+            while len(self._clients) < connections:
+                self._clients.append(PythonNbdClient(address, **kwargs))
+        except Exception:
+            self.close()
+            raise
+        self._executor = concurrent.futures.ThreadPoolExecutor(len(self._clients))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def connections(self):
+        """The number of connections used"""
+        return len(self._clients)
+
+    def get_size(self):
+        """
+        Return the size of the device in bytes.
+        """
+        return self._clients[0].get_size()
+
+    def _stripes(self, offset, length):
+        """
+        Return the (offset, start, length) of the stripes of the range of
+        each connection: offset in the export and start in the range.
+        """
+        stripes = [[] for _ in self._clients]
+        start = 0
+        while start < length:
+            stripe = (offset + start) // self.stripe_size
+            stripe_length = min((stripe + 1) * self.stripe_size - offset - start, length - start)
+            stripes[stripe % len(self._clients)].append((offset + start, start, stripe_length))
+            start += stripe_length
+        return stripes
+
+    def _run(self, function, stripes):
+        """Run function(client, stripes) for each connection in parallel"""
+        futures = [
+            self._executor.submit(function, client, client_stripes)
+            for client, client_stripes in zip(self._clients, stripes)
+            if client_stripes
+        ]
+        # Wait for all to complete before raising the first exception
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def read_into(self, offset, buffer):
+        """
+        Reads len(buffer) bytes at the given offset into the given writable
+        buffer over all connections. Returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast("B")
+
+        def read_stripes(client, stripes):
+            reads = ((stripe_offset, view[start : start + length])
+                     for stripe_offset, start, length in stripes)
+            for _ in client._read_pipelined(reads, None):  # pylint: disable=protected-access
+                pass
+
+        self._run(read_stripes, self._stripes(offset, len(view)))
+        return len(view)
+
+    def read(self, offset, length):
+        """
+        Returns length number of bytes read from the export, starting at
+        the given offset.
+        """
+        data = bytearray(length)
+        self.read_into(offset, data)
+        return data
+
+    def write(self, data, offset):
+        """
+        Writes the given bytes to the export, starting at the given
+        offset, over all connections.
+        """
+        view = memoryview(data).cast("B")
+
+        def write_stripes(client, stripes):
+            client.write_many(
+                (stripe_offset, view[start : start + length])
+                for stripe_offset, start, length in stripes
+            )
+
+        self._run(write_stripes, self._stripes(offset, len(view)))
+        return len(view)
+
+    def flush(self):
+        """
+        Sends a flush request to the server if it supports it and there are
+        unflushed writes on any connection. As the writes on all connections
+        have completed, and the server supports multiple connections, one
+        flush covers them all.
+        """
+        if all(client._flushed for client in self._clients):  # pylint: disable=protected-access
+            return False
+        flushed = self._clients[0].flush()
+        for client in self._clients:
+            client._flushed = True  # pylint: disable=protected-access
+        return flushed
+
+    def close(self):
+        """
+        Flushes the writes if necessary, and disconnects all connections,
+        even if the flush fails.
+        """
+        try:
+            if self._clients and self._clients[0]._transmission_phase:  # pylint: disable=protected-access
+                self.flush()
+        finally:
+            clients, self._clients = self._clients, []
+            try:
+                for client in clients:
+                    # Do not flush the connections again
+                    client._flushed = True  # pylint: disable=protected-access
+                    client.close()
+            finally:
+                if getattr(self, "_executor", None):
+                    self._executor.shutdown()
+
+
+class CachingNbdClient:
+    """
+    Caches the reads of a connected PythonNbdClient, for the many small
+    reads of the parsers of on-disk formats, like VHD footers and BATs,
+    qcow2 tables or filesystem probes.
+
+    The export is read in blocks of block_size bytes (default: its preferred
+    block size), of which the cache_size bytes of the least recently used
+    ones are kept. Reads need not be aligned to the blocks. When a read
+    starts where the previous one ended and the block following it is not
+    cached, the next blocks are read ahead with it, doubling the read-ahead
+    from one block up to max_readahead bytes while the reads remain
+    sequential. The cached blocks of the writes made with
+    this wrapper are invalidated, but not those written with other clients.
+
+    :attribute hits: The number of blocks read from the cache.
+    :attribute misses: The number of blocks read from the export for reads.
+    :attribute read_ahead: The number of blocks read ahead of the reads.
+    """
+
+    def __init__(self, client, cache_size=16 << 20, block_size=None, max_readahead=1 << 20):
+        self.client = client
+        self.block_size = block_size or client.get_block_size()["preferred_block_size"]
+        _check_alignment(
+            "block_size", self.block_size, client.get_block_size()["minimum_block_size"]
+        )
+        self.max_blocks = max(1, cache_size // self.block_size)
+        self.max_readahead_blocks = max_readahead // self.block_size
+        self.hits = 0
+        self.misses = 0
+        self.read_ahead = 0
+        # block index -> data, from the least to the most recently used
+        self._blocks = collections.OrderedDict()
+        self._next_offset = None  # The end of the previous read
+        self._readahead_blocks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_size(self):
+        """
+        Return the size of the device in bytes.
+        """
+        return self.client.get_size()
+
+    def _blocks_of(self, offset, length):
+        """Return the range of the indexes of the blocks of the range"""
+        return range(offset // self.block_size, (offset + length - 1) // self.block_size + 1)
+
+    def _fetch(self, indexes):
+        """Read the blocks with the given sorted indexes from the export"""
+        fetched = {}
+        size = self.get_size()
+        start = 0
+        while start < len(indexes):
+            # Read each run of consecutive blocks with one read_into
+            end = start + 1
+            while end < len(indexes) and indexes[end] == indexes[end - 1] + 1:
+                end += 1
+            offset = indexes[start] * self.block_size
+            data = bytearray(min(size, indexes[end - 1] * self.block_size + self.block_size)
+                             - offset)
+            self.client.read_into(offset, data)
+            for i, index in enumerate(indexes[start:end]):
+                fetched[index] = bytes(data[i * self.block_size : (i + 1) * self.block_size])
+            start = end
+        return fetched
+
+    def read(self, offset, length):
+        """
+        Returns length number of bytes read from the export, starting at
+        the given offset, from the cache if possible.
+        """
+        if offset < 0 or length < 0 or offset + length > self.get_size():
+            raise ValueError(
+                "offset=%i and length=%i exceed the size of the export" % (offset, length)
+            )
+        if not length:
+            return b""
+        blocks = self._blocks_of(offset, length)
+        readahead = range(0)
+        if offset != self._next_offset:
+            self._readahead_blocks = 0
+        elif blocks.stop not in self._blocks:
+            self._readahead_blocks = min(
+                max(1, 2 * self._readahead_blocks), self.max_readahead_blocks
+            )
+            last_block = (self.get_size() - 1) // self.block_size
+            readahead = range(
+                blocks.stop, min(blocks.stop + self._readahead_blocks, last_block + 1)
+            )
+        self._next_offset = offset + length
+
+        missing = [index for index in blocks if index not in self._blocks]
+        self.misses += len(missing)
+        self.hits += len(blocks) - len(missing)
+        missing_readahead = [index for index in readahead if index not in self._blocks]
+        self.read_ahead += len(missing_readahead)
+        fetched = self._fetch(missing + missing_readahead)
+
+        data = b"".join(
+            fetched[index] if index in fetched else self._blocks[index] for index in blocks
+        )
+        # Cache the blocks read ahead as less recently used than those read
+        for index in list(readahead) + list(blocks):
+            if index in fetched:
+                self._blocks[index] = fetched[index]
+            elif index in self._blocks:
+                self._blocks.move_to_end(index)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        start = offset - blocks.start * self.block_size
+        return data[start : start + length]
+
+    def invalidate(self, offset=0, length=None):
+        """
+        Drop the cached blocks of the range, by default of the whole export,
+        for example after it has been written by another client.
+        """
+        if length is None:
+            length = self.get_size() - offset
+        for index in self._blocks_of(offset, length):
+            self._blocks.pop(index, None)
+
+    def write(self, data, offset, fua=False):
+        """
+        Writes the given bytes to the export, starting at the given offset,
+        see PythonNbdClient.write.
+        """
+        self.invalidate(offset, len(data))
+        return self.client.write(data, offset, fua=fua)
+
+    def write_zeroes(self, offset, length, no_hole=False, fua=False):
+        """See PythonNbdClient.write_zeroes"""
+        self.invalidate(offset, length)
+        return self.client.write_zeroes(offset, length, no_hole=no_hole, fua=fua)
+
+    def trim(self, offset, length, fua=False):
+        """See PythonNbdClient.trim"""
+        self.invalidate(offset, length)
+        return self.client.trim(offset, length, fua=fua)
+
+    def flush(self):
+        """See PythonNbdClient.flush"""
+        return self.client.flush()
+
+    def close(self):
+        """Drops the cache and closes the client"""
+        self._blocks.clear()
+        self.client.close()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+A pure-Python NBD server, serving a file or a block device over a Unix socket.
+
+It stands in for tapdisk or qemu-nbd to test and benchmark the clients of
+python_nbd_client.py and the tools using them, like get_nbd_extents.py:
+
+    python_nbd_server.py --socket /tmp/nbd.sock --file disk.img
+
+It supports the fixed-newstyle handshake with NBD_OPT_EXPORT_NAME, NBD_OPT_GO
+and NBD_OPT_INFO, TLS (with NBD_OPT_STARTTLS), structured replies, and the
+base:allocation metadata context, whose extents are the data and the holes
+of the file found with SEEK_DATA and SEEK_HOLE. Reads send the data with
+os.sendfile, and the holes as NBD_REPLY_TYPE_OFFSET_HOLE chunks if structured
+replies have been negotiated. WRITE_ZEROES and TRIM punch holes into the
+file, and as all the connections use the same file, the server advertises
+NBD_FLAG_CAN_MULTI_CONN.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import socket
+import socketserver
+import ssl
+import stat
+import struct
+import threading
+
+import nbd_copy
+import python_nbd_client as nbd
+
+LOGGER = logging.getLogger("python_nbd_server")
+
+# Handshake flags
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+
+# Client flags
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_OPT_GO = 7
+
+NBD_FLAG_READ_ONLY = 1 << 1
+
+NBD_CMD_FLAG_REQ_ONE = 1 << 3
+
+# Option error replies
+NBD_REP_ERR_UNSUP = nbd.NBD_REP_ERROR_BIT | 1
+NBD_REP_ERR_POLICY = nbd.NBD_REP_ERROR_BIT | 2
+NBD_REP_ERR_INVALID = nbd.NBD_REP_ERROR_BIT | 3
+NBD_REP_ERR_TLS_REQD = nbd.NBD_REP_ERROR_BIT | 5
+NBD_REP_ERR_UNKNOWN = nbd.NBD_REP_ERROR_BIT | 6
+
+# The errors of the replies to requests. Other errors are sent as EIO.
+NBD_ERRORS = (errno.EPERM, errno.EIO, errno.ENOMEM, errno.EINVAL, errno.ENOSPC,
+              errno.EOVERFLOW, errno.ENOTSUP, errno.ESHUTDOWN)
+
+# The block sizes sent for NBD_INFO_BLOCK_SIZE
+MINIMUM_BLOCK_SIZE = 512
+PREFERRED_BLOCK_SIZE = 4096
+MAXIMUM_BLOCK_SIZE = 32 << 20
+
+BASE_ALLOCATION_ID = 1
+
+# The size of the buffers of the data received and of the zeroes written
+BUFFER_SIZE = 1 << 20
+
+_ZEROES = bytes(BUFFER_SIZE)
+
+
+class _RequestError(Exception):
+    """Fails a request with the error of its reply"""
+
+    def __init__(self, error, message=""):
+        super().__init__(message)
+        self.error = error
+
+
+def file_extents(fd, offset, length):
+    """
+    Yield the (length, is_hole) of the data and hole extents of the range
+    of the file at offset, using SEEK_DATA and SEEK_HOLE. Files which do
+    not support them, like block devices, have a single data extent.
+    """
+    end = offset + length
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                data = end  # A hole until the end of the file
+            elif exc.errno in (errno.EINVAL, errno.ENOTSUP):
+                yield (end - offset, False)
+                return
+            else:
+                raise
+        if data > offset:
+            hole_end = min(data, end)
+            yield (hole_end - offset, True)
+            offset = hole_end
+            continue
+        data_end = min(os.lseek(fd, offset, os.SEEK_HOLE), end)
+        yield (data_end - offset, False)
+        offset = data_end
+
+
+def server_tls_context(certfile, keyfile=None):
+    """Return the SSL context of the server, with its certificate chain"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class _Export:
+    """The file served, shared by all the connections"""
+
+    def __init__(self, path, name, read_only):
+        self.path = path
+        self.name = name
+        self.read_only = read_only
+        self.fd = os.open(path, os.O_RDONLY if read_only else os.O_RDWR)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.is_regular_file = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.can_punch_holes = self.is_regular_file
+
+    def transmission_flags(self):
+        flags = (
+            nbd.NBD_FLAG_HAS_FLAGS
+            | nbd.NBD_FLAG_SEND_FLUSH
+            | nbd.NBD_FLAG_SEND_FUA
+            | nbd.NBD_FLAG_CAN_MULTI_CONN
+        )
+        if self.read_only:
+            return flags | NBD_FLAG_READ_ONLY
+        return flags | nbd.NBD_FLAG_SEND_TRIM | nbd.NBD_FLAG_SEND_WRITE_ZEROES
+
+    def punch_hole(self, offset, length):
+        """Punch a hole, returning False if the file does not support it"""
+        if self.can_punch_holes:
+            try:
+                nbd_copy.punch_hole(self.fd, offset, length)
+                return True
+            except (OSError, AttributeError) as exc:
+                if getattr(exc, "errno", None) not in (None, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+                LOGGER.info("Cannot punch holes into %s", self.path)
+                self.can_punch_holes = False
+        return False
+
+    def write_zeroes(self, offset, length):
+        for start in range(offset, offset + length, len(_ZEROES)):
+            view = memoryview(_ZEROES)[: min(len(_ZEROES), offset + length - start)]
+            while view:
+                written = os.pwrite(self.fd, view, start)
+                view = view[written:]
+                start += written
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _NbdRequestHandler(socketserver.BaseRequestHandler):
+    """Serves the export to one client connection"""
+
+    def setup(self):
+        self.export = self.server.export
+        self.structured_reply = False
+        self.base_allocation = False
+        self.tls = False
+        # self.request becomes the TLS socket after NBD_OPT_STARTTLS
+        self.connection = self.request
+        self.server.add_connection(self.connection)
+
+    def finish(self):
+        self.server.remove_connection(self.connection)
+
+    def handle(self):
+        try:
+            self.request.sendall(
+                b"NBDMAGICIHAVEOPT"
+                + struct.pack(">H", NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+            )
+            (client_flags,) = struct.unpack(">L", self._recvall(4))
+            if self._negotiate(client_flags):
+                self._transmit()
+        except (EOFError, OSError) as exc:
+            LOGGER.debug("Connection closed: %s", exc)
+
+    def _recvall(self, length):
+        data = bytearray(length)
+        self._recvall_into(memoryview(data))
+        return data
+
+    def _recvall_into(self, view):
+        while view:
+            received = self.request.recv_into(view)
+            if not received:
+                raise EOFError("The client closed the connection")
+            view = view[received:]
+
+    # Handshake phase
+
+    def _send_option_reply(self, option, reply_type, data=b""):
+        header = struct.pack(">QLLL", nbd.OPTION_REPLY_MAGIC, option, reply_type, len(data))
+        self.request.sendall(header + data)
+
+    def _send_info(self, option, info_type):
+        if info_type == nbd.NBD_INFO_EXPORT:
+            payload = struct.pack(">QH", self.export.size, self.export.transmission_flags())
+        elif info_type == nbd.NBD_INFO_BLOCK_SIZE:
+            payload = struct.pack(
+                ">LLL", MINIMUM_BLOCK_SIZE, PREFERRED_BLOCK_SIZE, MAXIMUM_BLOCK_SIZE
+            )
+        else:
+            return
+        self._send_option_reply(
+            option, nbd.NBD_REP_INFO, struct.pack(">H", info_type) + payload
+        )
+
+    @staticmethod
+    def _parse_export_name(data):
+        (length,) = struct.unpack(">L", data[:4])
+        return (bytes(data[4 : 4 + length]).decode("utf-8"), data[4 + length :])
+
+    def _negotiate(self, client_flags):
+        """
+        Process the options of the client. Returns whether the client
+        entered the transmission phase.
+        """
+        while True:
+            (magic, option, length) = struct.unpack(">8sLL", self._recvall(16))
+            if magic != b"IHAVEOPT":
+                raise EOFError("Invalid option magic")
+            data = self._recvall(length)
+            LOGGER.debug("Option %d", option)
+            if option == nbd.NBD_OPT_ABORT:
+                self._send_option_reply(option, nbd.NBD_REP_ACK)
+                return False
+            if self.server.tls_context and not self.tls:
+                if option == nbd.NBD_OPT_EXPORT_NAME:
+                    return False  # It cannot be refused with an error
+                if option != nbd.NBD_OPT_STARTTLS:
+                    self._send_option_reply(option, NBD_REP_ERR_TLS_REQD)
+                    continue
+            if option == nbd.NBD_OPT_EXPORT_NAME:
+                if bytes(data).decode("utf-8") != self.export.name:
+                    return False
+                reply = struct.pack(">QH", self.export.size, self.export.transmission_flags())
+                if not client_flags & NBD_FLAG_C_NO_ZEROES:
+                    reply += bytes(124)
+                self.request.sendall(reply)
+                return True
+            if option in (nbd.NBD_OPT_INFO, NBD_OPT_GO):
+                (name, data) = self._parse_export_name(data)
+                if name != self.export.name:
+                    self._send_option_reply(option, NBD_REP_ERR_UNKNOWN)
+                    continue
+                (count,) = struct.unpack(">H", data[:2])
+                requests = struct.unpack(">%dH" % count, data[2 : 2 + 2 * count])
+                for info_type in sorted(set(requests) | {nbd.NBD_INFO_EXPORT}):
+                    self._send_info(option, info_type)
+                self._send_option_reply(option, nbd.NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return True
+            elif option == nbd.NBD_OPT_STARTTLS:
+                if not self.server.tls_context or self.tls:
+                    self._send_option_reply(option, NBD_REP_ERR_POLICY)
+                    continue
+                self._send_option_reply(option, nbd.NBD_REP_ACK)
+                self.request = self.server.tls_context.wrap_socket(
+                    self.request, server_side=True
+                )
+                self.tls = True
+            elif option == nbd.NBD_OPT_STRUCTURED_REPLY:
+                self.structured_reply = True
+                self._send_option_reply(option, nbd.NBD_REP_ACK)
+            elif option in (nbd.NBD_OPT_SET_META_CONTEXT, nbd.NBD_OPT_LIST_META_CONTEXT):
+                self._meta_context_option(option, data)
+            else:
+                self._send_option_reply(option, NBD_REP_ERR_UNSUP)
+
+    def _meta_context_option(self, option, data):
+        if not self.structured_reply:
+            self._send_option_reply(option, NBD_REP_ERR_INVALID)
+            return
+        (name, data) = self._parse_export_name(data)
+        (count,) = struct.unpack(">L", data[:4])
+        queries = []
+        data = data[4:]
+        for _ in range(count):
+            (length,) = struct.unpack(">L", data[:4])
+            queries.append(bytes(data[4 : 4 + length]).decode("utf-8"))
+            data = data[4 + length :]
+        if name != self.export.name:
+            self._send_option_reply(option, NBD_REP_ERR_UNKNOWN)
+            return
+        selected = "base:allocation" in queries or (
+            option == nbd.NBD_OPT_LIST_META_CONTEXT
+            and (not queries or "base:" in queries)
+        )
+        if option == nbd.NBD_OPT_SET_META_CONTEXT:
+            self.base_allocation = selected
+        if selected:
+            self._send_option_reply(
+                option,
+                nbd.NBD_REP_META_CONTEXT,
+                struct.pack(">L", BASE_ALLOCATION_ID) + b"base:allocation",
+            )
+        self._send_option_reply(option, nbd.NBD_REP_ACK)
+
+    # Transmission phase
+
+    def _transmit(self):
+        while True:
+            header = self._recvall(28)
+            (magic, flags, command, handle, offset, length) = struct.unpack(">LHHQQL", header)
+            if magic != nbd.NBD_REQUEST_MAGIC:
+                raise EOFError("Invalid request magic")
+            if command == nbd.NBD_CMD_DISC:
+                return
+            try:
+                self._request(command, flags, handle, offset, length)
+            except _RequestError as exc:
+                LOGGER.debug("Request %d failed: %s", command, exc)
+                self._send_error(handle, exc.error, str(exc))
+            except OSError as exc:
+                LOGGER.warning("Request %d failed: %s", command, exc)
+                error = exc.errno if exc.errno in NBD_ERRORS else errno.EIO
+                self._send_error(handle, error, exc.strerror or "")
+
+    def _check_range(self, offset, length):
+        if offset + length > self.export.size:
+            raise _RequestError(errno.EINVAL, "The request exceeds the size of the export")
+
+    def _check_writable(self):
+        if self.export.read_only:
+            raise _RequestError(errno.EPERM, "The export is read-only")
+
+    def _request(self, command, flags, handle, offset, length):
+        if command == nbd.NBD_CMD_WRITE:
+            # Receive the data even if the request fails
+            self._write(offset, length)
+            self._sync_if_fua(flags)
+            self._send_simple_reply(handle)
+        elif command == nbd.NBD_CMD_READ:
+            self._check_range(offset, length)
+            if length > MAXIMUM_BLOCK_SIZE:
+                raise _RequestError(errno.EOVERFLOW, "The request is too large")
+            self._read(handle, offset, length)
+        elif command == nbd.NBD_CMD_FLUSH:
+            os.fsync(self.export.fd)
+            self._send_simple_reply(handle)
+        elif command in (nbd.NBD_CMD_WRITE_ZEROES, nbd.NBD_CMD_TRIM):
+            self._check_writable()
+            self._check_range(offset, length)
+            can_punch_hole = command == nbd.NBD_CMD_TRIM or not flags & nbd.NBD_CMD_FLAG_NO_HOLE
+            if not (can_punch_hole and self.export.punch_hole(offset, length)):
+                # Trimming is only advisory
+                if command == nbd.NBD_CMD_WRITE_ZEROES:
+                    self.export.write_zeroes(offset, length)
+            self._sync_if_fua(flags)
+            self._send_simple_reply(handle)
+        elif command == nbd.NBD_CMD_BLOCK_STATUS:
+            if not self.base_allocation:
+                raise _RequestError(errno.EINVAL, "No metadata context selected")
+            self._check_range(offset, length)
+            self._block_status(handle, flags, offset, length)
+        else:
+            raise _RequestError(errno.EINVAL, "Unsupported command {}".format(command))
+
+    def _sync_if_fua(self, flags):
+        if flags & nbd.NBD_CMD_FLAG_FUA:
+            os.fdatasync(self.export.fd)
+
+    def _write(self, offset, length):
+        error = None
+        if offset + length > self.export.size:
+            error = _RequestError(errno.EINVAL, "The request exceeds the size of the export")
+        elif self.export.read_only:
+            error = _RequestError(errno.EPERM, "The export is read-only")
+        buffer = memoryview(bytearray(min(length, BUFFER_SIZE)))
+        end = offset + length
+        while offset < end:
+            view = buffer[: min(len(buffer), end - offset)]
+            self._recvall_into(view)
+            while view and not error:
+                written = os.pwrite(self.export.fd, view, offset)
+                view = view[written:]
+                offset += written
+            offset += len(view)
+        if error:
+            raise error
+
+    def _send_simple_reply(self, handle, error=0):
+        self.request.sendall(struct.pack(">LLQ", nbd.NBD_SIMPLE_REPLY_MAGIC, error, handle))
+
+    def _send_chunk_header(self, flags, reply_type, handle, length):
+        self.request.sendall(
+            struct.pack(">LHHQL", nbd.NBD_STRUCTURED_REPLY_MAGIC, flags, reply_type, handle, length)
+        )
+
+    def _send_error(self, handle, error, message):
+        if not self.structured_reply:
+            self._send_simple_reply(handle, error)
+            return
+        message = message.encode("utf-8")
+        payload = struct.pack(">LH", error, len(message)) + message
+        self._send_chunk_header(
+            nbd.NBD_REPLY_FLAG_DONE, nbd.NBD_REPLY_TYPE_ERROR, handle, len(payload)
+        )
+        self.request.sendall(payload)
+
+    def _send_data(self, offset, length):
+        """Send the data of the file, with sendfile unless over TLS"""
+        if self.tls:
+            for start in range(offset, offset + length, BUFFER_SIZE):
+                data = os.pread(self.export.fd, min(BUFFER_SIZE, offset + length - start), start)
+                if not data:
+                    raise EOFError("The file is truncated")
+                self.request.sendall(data)
+            return
+        end = offset + length
+        while offset < end:
+            sent = os.sendfile(self.request.fileno(), self.export.fd, offset, end - offset)
+            if not sent:
+                raise EOFError("The file is truncated")
+            offset += sent
+
+    def _read(self, handle, offset, length):
+        if not self.structured_reply:
+            self._send_simple_reply(handle)
+            self._send_data(offset, length)
+            return
+        extents = list(file_extents(self.export.fd, offset, length))
+        if not extents:
+            self._send_chunk_header(nbd.NBD_REPLY_FLAG_DONE, nbd.NBD_REPLY_TYPE_NONE, handle, 0)
+        for i, (extent_length, is_hole) in enumerate(extents, 1):
+            flags = nbd.NBD_REPLY_FLAG_DONE if i == len(extents) else 0
+            if is_hole:
+                self._send_chunk_header(flags, nbd.NBD_REPLY_TYPE_OFFSET_HOLE, handle, 12)
+                self.request.sendall(struct.pack(">QL", offset, extent_length))
+            else:
+                self._send_chunk_header(
+                    flags, nbd.NBD_REPLY_TYPE_OFFSET_DATA, handle, 8 + extent_length
+                )
+                self.request.sendall(struct.pack(">Q", offset))
+                self._send_data(offset, extent_length)
+            offset += extent_length
+
+    def _block_status(self, handle, flags, offset, length):
+        descriptors = []
+        for extent_length, is_hole in file_extents(self.export.fd, offset, length):
+            state = nbd.NBD_STATE_HOLE | nbd.NBD_STATE_ZERO if is_hole else 0
+            if descriptors and descriptors[-1][1] == state:
+                descriptors[-1] = (descriptors[-1][0] + extent_length, state)
+            else:
+                descriptors.append((extent_length, state))
+            if flags & NBD_CMD_FLAG_REQ_ONE:
+                break
+        payload = struct.pack(">L", BASE_ALLOCATION_ID) + b"".join(
+            struct.pack(">LL", extent_length, state) for extent_length, state in descriptors
+        )
+        self._send_chunk_header(
+            nbd.NBD_REPLY_FLAG_DONE, nbd.NBD_REPLY_TYPE_BLOCK_STATUS, handle, len(payload)
+        )
+        self.request.sendall(payload)
+
+
+class PythonNbdServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the file at file_path as the export exportname over the Unix
+    socket path, each connection from its own thread. With tls_context
+    (see server_tls_context), clients must upgrade their connections to TLS.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, file_path, exportname="", read_only=False, tls_context=None):
+        self.export = _Export(file_path, exportname, read_only)
+        self.tls_context = tls_context
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        if os.path.exists(path):
+            os.unlink(path)
+        try:
+            super().__init__(path, _NbdRequestHandler)
+        except Exception:
+            self.export.close()
+            raise
+
+    def add_connection(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def remove_connection(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def start(self):
+        """Serve the connections from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop serving, disconnecting the clients, and remove the socket"""
+        if self._thread:
+            self.shutdown()
+            self._thread.join()
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.server_close()
+        self.export.close()
+        os.unlink(self.server_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _main():
+    logging.basicConfig(format="%(name)s: [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", required=True, help="The Unix socket to listen on")
+    parser.add_argument("--file", required=True, help="The file or block device to serve")
+    parser.add_argument("--exportname", default="", help="The name of the export")
+    parser.add_argument("--read-only", action="store_true", help="Serve a read-only export")
+    parser.add_argument("--cert", help="The PEM certificate chain of the server, for TLS")
+    parser.add_argument("--key", help="The PEM private key of the server, if not in --cert")
+    parser.add_argument("--debug", action="store_true", help="Log the options and errors")
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    tls = server_tls_context(args.cert, args.key) if args.cert else None
+    server = PythonNbdServer(args.socket, args.file, args.exportname, args.read_only, tls)
+    LOGGER.info("Serving %s on %s", args.file, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.export.close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    _main()
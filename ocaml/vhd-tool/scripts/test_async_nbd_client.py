@@ -0,0 +1,137 @@
+"""Test ocaml/vhd-tool/scripts/async_nbd_client.AsyncNbdClient"""
+
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import async_nbd_client  # Tested module
+import python_nbd_client
+import python_nbd_server
+from test_python_nbd_client import FakeNbdServer
+
+# pylint: disable=missing-function-docstring,protected-access
+
+
+class TestAsyncNbdClient(unittest.IsolatedAsyncioTestCase):
+    """Test the asyncio NBD client against a FakeNbdServer"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        # 32 blocks of 512 bytes, the odd ones with zeroes in their first half
+        self.data = b"".join(
+            bytes(256) + bytes([i]) * 256 if i % 2 else bytes([i]) * 512 for i in range(32)
+        )
+        self.data += bytes(4096)
+        self.server = None
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    async def client(self, structured=False, **kwargs):
+        self.server = FakeNbdServer(self.path, self.data, structured)
+        return await async_nbd_client.open_nbd_client(
+            self.path, unix=True, use_tls=False, structured_reply=structured, **kwargs
+        )
+
+    async def check_concurrent_reads(self, structured):
+        async with await self.client(structured) as client:
+            self.assertEqual(client.get_size(), len(self.data))
+            blocks = await asyncio.gather(
+                *(client.read(offset, 512) for offset in range(0, 32 * 512, 512))
+            )
+
+        self.assertEqual(b"".join(blocks), self.data[: 32 * 512])
+        # The server has received the requests before replying in reverse order
+        self.assertEqual(self.server.max_in_flight, 8)
+
+    async def test_concurrent_reads_with_simple_replies(self):
+        await self.check_concurrent_reads(structured=False)
+
+    async def test_concurrent_reads_with_structured_replies(self):
+        await self.check_concurrent_reads(structured=True)
+
+    async def test_concurrent_writes_are_flushed_on_close(self):
+        async with await self.client() as client:
+            written = await asyncio.gather(
+                *(client.write(bytes([i]) * 1024, i * 1024) for i in range(16))
+            )
+
+        self.assertEqual(written, [1024] * 16)
+        self.assertEqual(
+            bytes(self.server.data[: 16 * 1024]), b"".join(bytes([i]) * 1024 for i in range(16))
+        )
+        self.assertEqual(self.server.flushes, 1)
+
+    async def test_block_status(self):
+        async with await self.client(True, meta_contexts=["base:allocation"]) as client:
+            replies = await client.query_block_status(31 * 512, 512 + 4096)
+
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0]["context_id"], 1)
+        self.assertEqual(replies[0]["descriptors"], [(512, 0), (4096, 3)])
+
+    async def test_requests_fail_when_the_connection_is_lost(self):
+        client = await self.client()
+        self.server.reply_handle = 1000
+
+        with self.assertRaises(python_nbd_client.NBDUnexpectedReplyHandleError):
+            await client.read(0, 512)
+        with self.assertRaises(python_nbd_client.NBDUnexpectedReplyHandleError):
+            await client.read(0, 512)
+        await client.close()
+
+
+class TestAsyncNbdClientTls(unittest.IsolatedAsyncioTestCase):
+    """Test the TLS upgrade of the asyncio NBD client with python_nbd_server"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        self.file = os.path.join(self.tmpdir.name, "disk.img")
+        self.data = bytes(range(256)) * 64
+        with open(self.file, "wb") as disk:
+            disk.write(self.data)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @unittest.skipUnless(async_nbd_client.TLS_SUPPORTED, "needs Python 3.7")
+    @unittest.skipUnless(shutil.which("openssl"), "needs openssl to create a certificate")
+    async def test_tls(self):
+        cert = os.path.join(self.tmpdir.name, "cert.pem")
+        key = os.path.join(self.tmpdir.name, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        with open(cert) as pem:
+            cadata = pem.read()
+        tls_context = python_nbd_server.server_tls_context(cert, key)
+
+        with python_nbd_server.PythonNbdServer(
+            self.path, self.file, "disk", tls_context=tls_context
+        ):
+            client = await async_nbd_client.open_nbd_client(
+                self.path, "disk", unix=True, cert=cadata, subject="localhost"
+            )
+            # The server refuses the clients which do not upgrade to TLS
+            async with client:
+                await client.write(b"x" * 512, 512)
+                blocks = await asyncio.gather(client.read(0, 1024), client.read(4096, 512))
+
+        self.assertEqual(blocks[0], self.data[:512] + b"x" * 512)
+        self.assertEqual(blocks[1], self.data[4096:4608])
+
+    async def test_tls_needs_python_3_7(self):
+        with mock.patch.object(async_nbd_client, "TLS_SUPPORTED", False):
+            with self.assertRaises(NotImplementedError):
+                await async_nbd_client.open_nbd_client(self.path, "disk", unix=True)
@@ -0,0 +1,80 @@
+"""Test ocaml/vhd-tool/scripts/get_nbd_extents.py"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import get_nbd_extents  # Tested module
+from test_python_nbd_client import FakeNbdServer
+
+# pylint: disable=missing-function-docstring,protected-access
+
+EXTENTS = [
+    {"length": 512, "flags": 0},
+    {"length": 1024, "flags": 0},
+    {"length": 512, "flags": 3},
+    {"length": 512, "flags": 0},
+]
+
+
+class TestOutput(unittest.TestCase):
+    """Test the coalescing and the output formats of the extents"""
+
+    def write(self, extents, output_format):
+        out = io.BytesIO()
+        get_nbd_extents.write_extents(iter(extents), out, output_format)
+        return out.getvalue()
+
+    def test_coalesce_extents(self):
+        self.assertEqual(
+            list(get_nbd_extents.coalesce_extents(iter(EXTENTS))),
+            [{"length": 1536, "flags": 0}, {"length": 512, "flags": 3},
+             {"length": 512, "flags": 0}],
+        )
+        self.assertEqual(list(get_nbd_extents.coalesce_extents(iter([]))), [])
+
+    def test_json_is_the_json_list_of_the_extents(self):
+        for extents in (EXTENTS, EXTENTS[:1], []):
+            self.assertEqual(
+                self.write(extents, "json").decode(), json.dumps(extents) + "\n"
+            )
+
+    def test_ndjson(self):
+        lines = self.write(EXTENTS, "ndjson").decode().splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines], EXTENTS)
+
+    def test_binary(self):
+        output = self.write(EXTENTS, "binary")
+
+        self.assertEqual(
+            list(get_nbd_extents.EXTENT_RECORD.iter_unpack(output)),
+            [(extent["length"], extent["flags"]) for extent in EXTENTS],
+        )
+
+
+class TestGetExtents(unittest.TestCase):
+    """Test the extents of the base:allocation context of an export"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        data = b"x" * 1024 + bytes(2048) + b"x" * 512
+        self.server = FakeNbdServer(self.path, data, structured=True)
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def test_extents_are_clipped_to_the_requested_range(self):
+        extents = get_nbd_extents._get_extents(self.path, "", 512, 2048)
+
+        self.assertEqual(
+            list(extents), [{"length": 512, "flags": 0}, {"length": 1536, "flags": 3}]
+        )
+
+    def test_out_of_bounds_ranges_are_rejected(self):
+        with self.assertRaises(ValueError):
+            list(get_nbd_extents._get_extents(self.path, "", 512, 4096))
@@ -0,0 +1,96 @@
+"""Test ocaml/vhd-tool/scripts/nbd_copy.py"""
+
+import os
+import tempfile
+import unittest
+
+import get_nbd_extents
+import nbd_copy  # Tested module
+import python_nbd_client
+from python_nbd_client import PythonNbdClient
+from test_python_nbd_client import FakeNbdServer
+
+# pylint: disable=missing-function-docstring
+
+
+class TestCopy(unittest.TestCase):
+    """Test copying the data extents of an export to files and exports"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "source.sock")
+        # 256 KiB: 64 KiB of data, 128 KiB of zeroes, 4 KiB of data, zeroes
+        self.data = os.urandom(65536) + bytes(131072) + os.urandom(4096)
+        self.data += bytes(262144 - len(self.data))
+        self.servers = [FakeNbdServer(self.path, self.data, structured=True)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        self.tmpdir.cleanup()
+
+    def copy(self, destination):
+        (client, context_ids) = get_nbd_extents.open_client(self.path, "")
+        meta_context_id = context_ids[get_nbd_extents.BASE_ALLOCATION]
+        with client:
+            target = destination(client.get_size())
+            try:
+                return nbd_copy.copy(
+                    client, meta_context_id, target, buffer_size=16384, buffers=2,
+                    request_size=4096,
+                )
+            finally:
+                target.close()
+
+    def check_stats(self, stats):
+        self.assertEqual(stats["size"], len(self.data))
+        self.assertEqual(stats["bytes_copied"], 65536 + 4096)
+        self.assertEqual(stats["bytes_skipped"], len(self.data) - 65536 - 4096)
+
+    def test_copy_to_a_file(self):
+        filename = os.path.join(self.tmpdir.name, "copy")
+        with open(filename, "wb") as file:
+            file.write(b"x" * 2 * len(self.data))
+
+        self.check_stats(self.copy(lambda size: nbd_copy.FileDestination(filename, size)))
+
+        with open(filename, "rb") as file:
+            self.assertEqual(file.read(), self.data)
+        # The zero extents are holes
+        self.assertLess(os.stat(filename).st_blocks * 512, len(self.data))
+
+    def copy_to_an_export(self, flags):
+        path = os.path.join(self.tmpdir.name, "destination.sock")
+        destination = FakeNbdServer(path, b"x" * len(self.data), flags=flags)
+        self.servers.append(destination)
+
+        def nbd_destination(size):
+            client = PythonNbdClient(path, unix=True, use_tls=False)
+            return nbd_copy.NbdDestination(client, size, request_size=4096)
+
+        self.check_stats(self.copy(nbd_destination))
+        self.assertEqual(bytes(destination.data), self.data)
+        return destination
+
+    def test_copy_to_an_export_with_write_zeroes(self):
+        destination = self.copy_to_an_export(python_nbd_client.NBD_FLAG_SEND_WRITE_ZEROES)
+
+        written = sum(
+            length for command, _, _, length in destination.commands
+            if command == python_nbd_client.NBD_CMD_WRITE
+        )
+        self.assertEqual(written, 65536 + 4096)
+
+    def test_copy_to_an_export_without_write_zeroes(self):
+        self.copy_to_an_export(0)
+
+    def test_destinations_smaller_than_the_source_are_rejected(self):
+        path = os.path.join(self.tmpdir.name, "destination.sock")
+        self.servers.append(FakeNbdServer(path, bytes(512)))
+
+        with self.assertRaises(ValueError):
+            self.copy(
+                lambda size: nbd_copy.NbdDestination(
+                    PythonNbdClient(path, unix=True, use_tls=False), size
+                )
+            )
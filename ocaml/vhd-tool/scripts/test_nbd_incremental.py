@@ -0,0 +1,99 @@
+"""Test ocaml/vhd-tool/scripts/nbd_incremental.py"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import get_nbd_extents
+import nbd_copy
+import nbd_incremental  # Tested module
+from test_python_nbd_client import FakeNbdServer
+
+# pylint: disable=missing-function-docstring
+
+
+class TestIncrementalBackup(unittest.TestCase):
+    """Test exporting the dirty extents of an export and applying them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        self.previous = os.urandom(65536)
+        # Blocks 8-15 changed to data, 32-35 changed to zeroes
+        self.data = bytearray(self.previous)
+        self.data[8 * 512 : 16 * 512] = os.urandom(8 * 512)
+        self.data[32 * 512 : 36 * 512] = bytes(4 * 512)
+        self.server = FakeNbdServer(self.path, self.data, structured=True)
+        self.server.dirty_blocks = set(range(8, 16)) | set(range(32, 36))
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def export(self, chunk_size=nbd_incremental.CHUNK_SIZE):
+        contexts = [get_nbd_extents.BASE_ALLOCATION, "qemu:dirty-bitmap:backup"]
+        (client, context_ids) = get_nbd_extents.open_client(self.path, "", contexts)
+        out = io.BytesIO()
+        with client:
+            stats = nbd_incremental.export_changes(client, context_ids, "backup", out, chunk_size)
+        return (stats, out.getvalue())
+
+    def test_only_the_dirty_extents_are_exported(self):
+        (stats, changes) = self.export()
+
+        self.assertEqual(stats["dirty_bytes"], 12 * 512)
+        self.assertEqual(stats["data_bytes"], 8 * 512)
+        self.assertEqual(stats["zero_bytes"], 4 * 512)
+        header = nbd_incremental.STREAM_HEADER.size + nbd_incremental.RECORD_HEADER.size * 3
+        self.assertEqual(len(changes), header + 8 * 512)
+        # Only the requests of the dirty extents read data
+        reads = [command for command in self.server.commands if command[0] == 0]
+        self.assertEqual([(offset, length) for _, _, offset, length in reads], [(4096, 4096)])
+
+    def test_changes_applied_to_the_previous_backup(self):
+        (_, changes) = self.export(chunk_size=1024)
+        backup = os.path.join(self.tmpdir.name, "backup")
+        with open(backup, "wb") as file:
+            file.write(self.previous)
+
+        stream = io.BytesIO(changes)
+        size = nbd_incremental.read_size(stream)
+        destination = nbd_copy.FileDestination(backup, size, truncate=False)
+        try:
+            stats = nbd_incremental.apply_changes(stream, destination, chunk_size=512)
+        finally:
+            destination.close()
+
+        self.assertEqual(stats, {"data_bytes": 8 * 512, "zero_bytes": 4 * 512})
+        with open(backup, "rb") as file:
+            self.assertEqual(file.read(), self.data)
+
+    def test_truncated_streams_are_rejected(self):
+        (_, changes) = self.export()
+        stream = io.BytesIO(changes[:-1])
+        nbd_incremental.read_size(stream)
+
+        with self.assertRaises(nbd_incremental.NBDStreamError):
+            nbd_incremental.apply_changes(stream, Mock())
+
+    def test_missing_bitmaps_are_rejected(self):
+        with self.assertRaises(ValueError):
+            get_nbd_extents.open_client(self.path, "", ["qemu:dirty-bitmap:other"])
+
+    def test_extents_of_the_dirty_bitmap(self):
+        extents = get_nbd_extents._get_extents(  # pylint: disable=protected-access
+            self.path, "", 0, 65536, context="qemu:dirty-bitmap:backup"
+        )
+
+        self.assertEqual(
+            list(extents),
+            [
+                {"length": 8 * 512, "flags": 0},
+                {"length": 8 * 512, "flags": 1},
+                {"length": 16 * 512, "flags": 0},
+                {"length": 4 * 512, "flags": 1},
+                {"length": 92 * 512, "flags": 0},
+            ],
+        )
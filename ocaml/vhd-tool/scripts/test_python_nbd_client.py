@@ -0,0 +1,699 @@
+"""Test ocaml/vhd-tool/scripts/python_nbd_client.PythonNbdClient"""
+
+import os
+import select
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import python_nbd_client  # Tested module
+from python_nbd_client import PythonNbdClient
+
+# pylint: disable=missing-function-docstring,protected-access
+
+
+class FakeNbdServer:
+    """
+    Serves an in-memory export to clients over a Unix socket, replying to
+    the requests in flight in reverse order to check that the client matches
+    the replies to their requests by handle.
+    """
+
+    def __init__(self, path, data, structured=False, queue_depth=8, flags=0, connections=1):
+        self.data = bytearray(data)
+        self.structured = structured
+        self.queue_depth = queue_depth
+        self.flags = flags
+        self.max_in_flight = 0
+        self.flushes = 0
+        self.commands = []  # The (command, flags, offset, length) of the requests
+        self.requests = []  # The number of requests of each connection
+        self.reply_handle = None  # Replace the handles of the replies
+        self.error_offset = None  # Fail the reads at this offset with EIO
+        self.dirty_blocks = None  # The dirty blocks of 512 bytes of the dirty bitmap
+        self.selected_contexts = []
+        self.block_size = None  # The (minimum, preferred, maximum) sent for NBD_OPT_INFO
+        self.option_error = b""  # The message of the errors of unsupported options
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(connections)
+        self._threads = []
+        for _ in range(connections):
+            self._threads.append(threading.Thread(target=self._serve, daemon=True))
+            self._threads[-1].start()
+
+    def close(self):
+        # Stop waiting for the connections which have not been made
+        self._listener.shutdown(socket.SHUT_RDWR)
+        self._listener.close()
+        for thread in self._threads:
+            thread.join(10)
+
+    @staticmethod
+    def _recvall(connection, length):
+        data = b""
+        while len(data) < length:
+            received = connection.recv(length - len(data))
+            if not received:
+                raise EOFError
+            data += received
+        return data
+
+    def _serve(self):
+        try:
+            connection, _ = self._listener.accept()
+        except OSError:
+            return  # Closed before the client connected
+        with connection:
+            connection.sendall(b"NBDMAGICIHAVEOPT" + struct.pack(">H", 1))
+            self._recvall(connection, 4)
+            try:
+                if self._negotiate(connection):
+                    self._transmit(connection)
+            except (EOFError, OSError):
+                pass
+
+    def _negotiate(self, connection):
+        while True:
+            magic, option, length = struct.unpack(">8sLL", self._recvall(connection, 16))
+            assert magic == b"IHAVEOPT"
+            data = self._recvall(connection, length)
+            if option == python_nbd_client.NBD_OPT_SET_META_CONTEXT and self.structured:
+                self.selected_contexts = [
+                    (context_id, name) for context_id, name in self._contexts()
+                    if name.encode() in data
+                ]
+                for context_id, name in self.selected_contexts:
+                    connection.sendall(
+                        struct.pack(">QLLLL", python_nbd_client.OPTION_REPLY_MAGIC, option,
+                                    python_nbd_client.NBD_REP_META_CONTEXT, 4 + len(name),
+                                    context_id)
+                        + name.encode()
+                    )
+                connection.sendall(
+                    struct.pack(">QLLL", python_nbd_client.OPTION_REPLY_MAGIC, option,
+                                python_nbd_client.NBD_REP_ACK, 0)
+                )
+                continue
+            if option == python_nbd_client.NBD_OPT_INFO and self.block_size:
+                for payload in (
+                    struct.pack(">HQH", python_nbd_client.NBD_INFO_EXPORT, len(self.data), 0),
+                    struct.pack(">HLLL", python_nbd_client.NBD_INFO_BLOCK_SIZE, *self.block_size),
+                ):
+                    connection.sendall(
+                        struct.pack(">QLLL", python_nbd_client.OPTION_REPLY_MAGIC, option,
+                                    python_nbd_client.NBD_REP_INFO, len(payload))
+                        + payload
+                    )
+                connection.sendall(
+                    struct.pack(">QLLL", python_nbd_client.OPTION_REPLY_MAGIC, option,
+                                python_nbd_client.NBD_REP_ACK, 0)
+                )
+                continue
+            if option == python_nbd_client.NBD_OPT_EXPORT_NAME:
+                flags = python_nbd_client.NBD_FLAG_HAS_FLAGS
+                flags |= python_nbd_client.NBD_FLAG_SEND_FLUSH | self.flags
+                connection.sendall(struct.pack(">QH", len(self.data), flags) + bytes(124))
+                return True
+            if option == python_nbd_client.NBD_OPT_ABORT:
+                return False
+            reply = python_nbd_client.NBD_REP_ACK
+            message = b""
+            if option != python_nbd_client.NBD_OPT_STRUCTURED_REPLY or not self.structured:
+                reply = python_nbd_client.NBD_REP_ERROR_BIT | 1
+                message = self.option_error
+            connection.sendall(
+                struct.pack(">QLLL", python_nbd_client.OPTION_REPLY_MAGIC, option, reply,
+                            len(message))
+                + message
+            )
+
+    def _transmit(self, connection):
+        pending = []
+        connection_index = len(self.requests)
+        self.requests.append(0)
+        while True:
+            # Reply when the queue is full, or when the client waits for replies
+            header = None
+            if not pending or select.select([connection], [], [], 0.05)[0]:
+                header = self._recvall(connection, 28)
+            if header is not None:
+                _, flags, command, handle, offset, length = struct.unpack(">LHHQQL", header)
+                if command == python_nbd_client.NBD_CMD_DISC:
+                    return
+                self.commands.append((command, flags, offset, length))
+                if command == python_nbd_client.NBD_CMD_WRITE:
+                    self.data[offset : offset + length] = self._recvall(connection, length)
+                if command in (python_nbd_client.NBD_CMD_WRITE_ZEROES,
+                               python_nbd_client.NBD_CMD_TRIM):
+                    self.data[offset : offset + length] = bytes(length)
+                if command == python_nbd_client.NBD_CMD_FLUSH:
+                    self.flushes += 1
+                self.requests[connection_index] += 1
+                pending.append((command, handle, offset, length))
+                self.max_in_flight = max(self.max_in_flight, len(pending))
+            if header is None or len(pending) >= self.queue_depth:
+                for request in reversed(pending):
+                    self._reply(connection, *request)
+                pending = []
+
+    def _reply(self, connection, command, handle, offset, length):
+        handle = self.reply_handle or handle
+        if command == python_nbd_client.NBD_CMD_BLOCK_STATUS:
+            self._reply_block_status(connection, handle, offset, length)
+            return
+        if command == python_nbd_client.NBD_CMD_READ and offset == self.error_offset:
+            self._reply_error(connection, handle, 5)  # EIO
+            return
+        data = bytes(self.data[offset : offset + length])
+        if command != python_nbd_client.NBD_CMD_READ:
+            data = b""
+        if not self.structured or command != python_nbd_client.NBD_CMD_READ:
+            connection.sendall(
+                struct.pack(">LLQ", python_nbd_client.NBD_SIMPLE_REPLY_MAGIC, 0, handle) + data
+            )
+            return
+        # The second half first, and the first half as a hole if it is zeroes
+        half = length // 2
+        chunks = [(python_nbd_client.NBD_REPLY_TYPE_OFFSET_DATA,
+                   struct.pack(">Q", offset + half) + data[half:])]
+        if any(data[:half]):
+            chunks.append((python_nbd_client.NBD_REPLY_TYPE_OFFSET_DATA,
+                           struct.pack(">Q", offset) + data[:half]))
+        else:
+            chunks.append((python_nbd_client.NBD_REPLY_TYPE_OFFSET_HOLE,
+                           struct.pack(">QL", offset, half)))
+        chunks.append((python_nbd_client.NBD_REPLY_TYPE_NONE, b""))
+        for i, (reply_type, payload) in enumerate(chunks, 1):
+            flags = python_nbd_client.NBD_REPLY_FLAG_DONE if i == len(chunks) else 0
+            connection.sendall(
+                struct.pack(">LHHQL", python_nbd_client.NBD_STRUCTURED_REPLY_MAGIC,
+                            flags, reply_type, handle, len(payload)) + payload
+            )
+
+
+    def _reply_error(self, connection, handle, errno):
+        if not self.structured:
+            connection.sendall(
+                struct.pack(">LLQ", python_nbd_client.NBD_SIMPLE_REPLY_MAGIC, errno, handle)
+            )
+            return
+        message = b"I/O error"
+        payload = struct.pack(">LH", errno, len(message)) + message
+        connection.sendall(
+            struct.pack(">LHHQL", python_nbd_client.NBD_STRUCTURED_REPLY_MAGIC,
+                        python_nbd_client.NBD_REPLY_FLAG_DONE,
+                        python_nbd_client.NBD_REPLY_TYPE_ERROR, handle, len(payload))
+            + payload
+        )
+
+    def _contexts(self):
+        yield (1, "base:allocation")
+        if self.dirty_blocks is not None:
+            yield (2, "qemu:dirty-bitmap:backup")
+
+    def _block_flags(self, context_id, start):
+        if context_id == 1:
+            return 0 if any(self.data[start : start + 512]) else 3
+        return 1 if start // 512 in self.dirty_blocks else 0
+
+    def _reply_block_status(self, connection, handle, offset, length):
+        """
+        Reply with the extents of the blocks of 512 bytes of zeroes or data
+        for base:allocation, and of dirty blocks for the dirty bitmap
+        """
+        for i, (context_id, _) in enumerate(self.selected_contexts, 1):
+            descriptors = []
+            for start in range(offset, offset + length, 512):
+                flags = self._block_flags(context_id, start)
+                if descriptors and descriptors[-1][1] == flags:
+                    descriptors[-1][0] += 512
+                else:
+                    descriptors.append([512, flags])
+            payload = struct.pack(">L", context_id)
+            payload += b"".join(struct.pack(">LL", *d) for d in descriptors)
+            done = python_nbd_client.NBD_REPLY_FLAG_DONE if i == len(self.selected_contexts) else 0
+            connection.sendall(
+                struct.pack(">LHHQL", python_nbd_client.NBD_STRUCTURED_REPLY_MAGIC, done,
+                            python_nbd_client.NBD_REPLY_TYPE_BLOCK_STATUS, handle, len(payload))
+                + payload
+            )
+
+
+class FakeNbdServerTestCase(unittest.TestCase):
+    """Base class of the tests of clients of a FakeNbdServer"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        # 64 blocks of 512 bytes, the odd ones with zeroes in their first half
+        self.data = b"".join(
+            bytes(256) + bytes([i]) * 256 if i % 2 else bytes([i]) * 512 for i in range(64)
+        )
+        self.server = None
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def client(self, structured=False, **kwargs):
+        self.server = FakeNbdServer(self.path, self.data, structured, **kwargs)
+        client = PythonNbdClient(self.path, unix=True, use_tls=False, connect=False)
+        if structured:
+            client.negotiate_structured_reply()
+        client.connect("")
+        return client
+
+
+class TestPipelining(FakeNbdServerTestCase):
+    """Test read_many and write_many with several requests in flight"""
+
+    def check_read_many(self, structured):
+        requests = [(i * 512, 512) for i in range(64)]
+        with self.client(structured, queue_depth=8) as client:
+            replies = list(client.read_many(requests, queue_depth=8))
+
+        self.assertEqual(sorted(offset for offset, _ in replies), [o for o, _ in requests])
+        # The server replied in reverse order, the client matched the handles
+        self.assertNotEqual([offset for offset, _ in replies], [o for o, _ in requests])
+        for offset, data in replies:
+            self.assertEqual(bytes(data), self.data[offset : offset + 512])
+        self.assertEqual(self.server.max_in_flight, 8)
+
+    def test_read_many_with_simple_replies(self):
+        self.check_read_many(structured=False)
+
+    def test_read_many_with_structured_replies(self):
+        self.check_read_many(structured=True)
+
+    def test_queue_depth_limits_the_requests_in_flight(self):
+        with self.client(queue_depth=64) as client:
+            client.queue_depth = 4
+            list(client.read_many((i * 512, 512) for i in range(16)))
+
+        self.assertEqual(self.server.max_in_flight, 4)
+
+    def test_write_many(self):
+        writes = [(i * 1024, bytes([255 - i]) * 1024) for i in range(32)]
+        with self.client() as client:
+            written = client.write_many(writes)
+            self.assertFalse(client._flushed)
+            data = client.read(0, 32 * 1024)
+
+        self.assertEqual(written, 32 * 1024)
+        self.assertEqual(bytes(data), b"".join(data for _, data in writes))
+
+    def test_unexpected_handles_are_rejected(self):
+        with self.client() as client:
+            self.server.reply_handle = 1000
+            with self.assertRaises(python_nbd_client.NBDUnexpectedReplyHandleError):
+                list(client.read_many([(0, 512), (512, 512)]))
+            client._transmission_phase = False
+
+    def check_error_replies_leave_the_connection_usable(self, structured):
+        requests = [(i * 512, 512) for i in range(8)]
+        with self.client(structured, queue_depth=8) as client:
+            # The server replies to the last request first
+            self.server.error_offset = 7 * 512
+            with self.assertRaises(python_nbd_client.NBDTransmissionError) as context:
+                list(client.read_many(requests))
+            self.assertEqual(context.exception.error_code, 5)
+            self.assertEqual(client._in_flight, {})
+
+            buffer = bytearray(512)
+            client.read_into(512, buffer)
+
+        self.assertEqual(buffer, self.data[512:1024])
+
+    def test_error_replies_leave_the_connection_usable(self):
+        self.check_error_replies_leave_the_connection_usable(structured=False)
+
+    def test_structured_error_replies_leave_the_connection_usable(self):
+        self.check_error_replies_leave_the_connection_usable(structured=True)
+
+    def test_unfinished_read_many_leaves_the_connection_usable(self):
+        with self.client(queue_depth=8) as client:
+            replies = client.read_many((i * 512, 512) for i in range(16))
+            next(replies)
+            replies.close()
+            buffer = bytearray(512)
+            client.read_into(1024, buffer)
+
+        self.assertEqual(buffer, self.data[1024:1536])
+
+
+class TestReadInto(FakeNbdServerTestCase):
+    """Test read_into, which receives the data into the buffer of the caller"""
+
+    def check_read_into(self, structured, **kwargs):
+        buffer = bytearray(b"x" * (len(self.data) + 512))
+        with self.client(structured) as client:
+            read = client.read_into(1024, memoryview(buffer)[512:-1024], **kwargs)
+
+        self.assertEqual(read, len(self.data) - 1024)
+        self.assertEqual(buffer[:512], b"x" * 512)
+        # The holes have overwritten the previous content of the buffer
+        self.assertEqual(buffer[512:-1024], self.data[1024:])
+        self.assertEqual(buffer[-1024:], b"x" * 1024)
+
+    def test_read_into_with_simple_replies(self):
+        self.check_read_into(structured=False)
+
+    def test_read_into_with_structured_replies(self):
+        self.check_read_into(structured=True)
+
+    def test_read_into_in_several_requests(self):
+        self.check_read_into(structured=True, request_size=2048, queue_depth=4)
+        self.assertEqual(self.server.max_in_flight, 4)
+
+
+class TestBlockSize(FakeNbdServerTestCase):
+    """Test the requests sized from the block sizes sent by the server"""
+
+    def client_with_block_size(self, block_size):
+        self.server = FakeNbdServer(self.path, self.data)
+        self.server.block_size = block_size
+        return PythonNbdClient(self.path, unix=True, use_tls=False)
+
+    def requests(self):
+        return [
+            (offset, length) for command, _, offset, length in self.server.commands
+            if command != python_nbd_client.NBD_CMD_FLUSH
+        ]
+
+    def test_defaults_without_the_support_of_the_server(self):
+        with self.client_with_block_size(None) as client:
+            self.assertEqual(
+                client.get_block_size(),
+                {
+                    "minimum_block_size": 512,
+                    "preferred_block_size": 4096,
+                    "maximum_block_size": 32 << 20,
+                },
+            )
+            self.assertEqual(client.request_size(), 32 << 20)
+
+    def test_option_errors_with_a_message(self):
+        # Like qemu-nbd, which explains why it does not support an option
+        self.server = FakeNbdServer(self.path, self.data)
+        self.server.option_error = b"Unsupported option 6 (info)"
+        with PythonNbdClient(self.path, unix=True, use_tls=False) as client:
+            self.assertEqual(client.get_size(), len(self.data))
+            self.assertEqual(client.get_block_size()["maximum_block_size"], 32 << 20)
+            self.assertEqual(client.read(512, 512), self.data[512:1024])
+
+    def test_block_sizes_are_negotiated_when_connecting(self):
+        with self.client_with_block_size((1024, 2048, 5120)) as client:
+            self.assertEqual(
+                client.get_block_size(),
+                {
+                    "minimum_block_size": 1024,
+                    "preferred_block_size": 2048,
+                    "maximum_block_size": 5120,
+                },
+            )
+            self.assertEqual(client.request_size(), 4096)
+
+    def test_reads_are_split_and_aligned_to_the_preferred_block_size(self):
+        buffer = bytearray(len(self.data) - 3072)
+        with self.client_with_block_size((512, 4096, 8192)) as client:
+            client.read_into(1024, buffer)
+
+        self.assertEqual(buffer, self.data[1024:-2048])
+        self.assertEqual(
+            self.requests(),
+            [(1024, 7168), (8192, 8192), (16384, 8192), (24576, 6144)],
+        )
+
+    def test_large_writes_are_split(self):
+        data = bytes(range(256)) * 64
+        with self.client_with_block_size((512, 4096, 4096)) as client:
+            client.write(data, 0)
+
+        self.assertEqual(bytes(self.server.data[: len(data)]), data)
+        self.assertEqual(self.requests(), [(0, 4096), (4096, 4096), (8192, 4096), (12288, 4096)])
+
+    def check_large_reads_are_split(self, structured):
+        self.server = FakeNbdServer(self.path, self.data, structured)
+        self.server.block_size = (512, 4096, 8192)
+        client = PythonNbdClient(self.path, unix=True, use_tls=False, connect=False)
+        if structured:
+            client.negotiate_structured_reply()
+        client.negotiate_block_size("")
+        client.connect("")
+        with client:
+            data = client.read(1024, 20480)
+            if structured:
+                buffer = bytearray(len(self.data))
+                for chunk in data:
+                    if "data" in chunk:
+                        offset = chunk["offset"]
+                        buffer[offset : offset + len(chunk["data"])] = chunk["data"]
+                data = bytes(buffer[1024:21504])
+
+        self.assertEqual(data, self.data[1024:21504])
+        self.assertEqual(self.requests(), [(1024, 7168), (8192, 8192), (16384, 5120)])
+
+    def test_large_reads_are_split_with_simple_replies(self):
+        self.check_large_reads_are_split(structured=False)
+
+    def test_large_reads_are_split_with_structured_replies(self):
+        self.check_large_reads_are_split(structured=True)
+
+    def test_requests_must_respect_the_block_sizes(self):
+        with self.client_with_block_size((1024, 4096, 4096)) as client:
+            with self.assertRaisesRegex(ValueError, "not a multiple of 1024"):
+                client.read(512, 1024)
+            with self.assertRaisesRegex(ValueError, "larger than the maximum block size"):
+                list(client.read_many([(0, 8192)]))
+
+        self.assertEqual(self.server.commands, [])
+
+
+class TestCachingNbdClient(FakeNbdServerTestCase):
+    """Test the LRU cache and the read-ahead of the reads of a client"""
+
+    def caching_client(self, **kwargs):
+        return python_nbd_client.CachingNbdClient(self.client(), block_size=1024, **kwargs)
+
+    def reads(self):
+        return [
+            (offset, length) for command, _, offset, length in self.server.commands
+            if command == python_nbd_client.NBD_CMD_READ
+        ]
+
+    def test_unaligned_reads_are_served_from_the_cache(self):
+        with self.caching_client() as client:
+            self.assertEqual(client.read(100, 10), self.data[100:110])
+            self.assertEqual(client.read(1000, 48), self.data[1000:1048])
+            self.assertEqual(client.read(900, 20), self.data[900:920])
+
+            self.assertEqual((client.hits, client.misses, client.read_ahead), (2, 2, 0))
+        self.assertEqual(self.reads(), [(0, 1024), (1024, 1024)])
+
+    def test_sequential_reads_are_read_ahead(self):
+        with self.caching_client(max_readahead=4096) as client:
+            data = b"".join(client.read(offset, 512) for offset in range(0, len(self.data), 512))
+
+            self.assertEqual(data, self.data)
+            self.assertEqual(client.misses, 1)
+            self.assertEqual(client.read_ahead, 31)
+        # The read-ahead doubled from one to four blocks
+        self.assertEqual(
+            self.reads()[:4], [(0, 1024), (1024, 1024), (2048, 2048), (4096, 4096)]
+        )
+        self.assertEqual(len(self.reads()), 10)
+
+    def test_random_reads_are_not_read_ahead(self):
+        with self.caching_client() as client:
+            for offset in (8192, 0, 20480, 4096):
+                client.read(offset, 512)
+
+            self.assertEqual(client.read_ahead, 0)
+        self.assertEqual(self.reads(), [(8192, 1024), (0, 1024), (20480, 1024), (4096, 1024)])
+
+    def test_least_recently_used_blocks_are_evicted(self):
+        with self.caching_client(cache_size=2048) as client:
+            for offset in (0, 4096, 0, 8192, 0, 4096):
+                client.read(offset, 512)
+
+            self.assertEqual((client.hits, client.misses), (2, 4))
+        self.assertEqual(self.reads(), [(0, 1024), (4096, 1024), (8192, 1024), (4096, 1024)])
+
+    def test_writes_invalidate_the_cache(self):
+        with self.caching_client() as client:
+            client.read(0, 2048)
+            client.write(b"w" * 512, 512)
+
+            self.assertEqual(
+                client.read(0, 2048), self.data[:512] + b"w" * 512 + self.data[1024:2048]
+            )
+            self.assertEqual((client.hits, client.misses), (1, 3))
+
+    def test_reads_beyond_the_end_are_rejected(self):
+        with self.caching_client() as client:
+            with self.assertRaises(ValueError):
+                client.read(len(self.data) - 512, 1024)
+
+
+class TestMultiConnNbdClient(unittest.TestCase):
+    """Test the client striping the transfers across several connections"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        self.data = bytes(range(256)) * 256
+        self.server = None
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def client(self, flags=python_nbd_client.NBD_FLAG_CAN_MULTI_CONN, connections=4):
+        self.server = FakeNbdServer(self.path, self.data, flags=flags, connections=connections)
+        return python_nbd_client.MultiConnNbdClient(
+            self.path, connections=connections, stripe_size=4096, unix=True, use_tls=False
+        )
+
+    def test_reads_are_striped_across_the_connections(self):
+        with self.client() as client:
+            self.assertEqual(client.connections, 4)
+            self.assertEqual(client.get_size(), len(self.data))
+            data = client.read(512, len(self.data) - 1024)
+
+        self.assertEqual(bytes(data), self.data[512:-512])
+        # 16 stripes of 4096 bytes, 4 per connection, with 2 partial ones
+        self.assertEqual(self.server.requests, [4, 4, 4, 4])
+
+    def test_writes_are_flushed_once(self):
+        written = bytes(reversed(self.data))
+        with self.client() as client:
+            client.write(written, 0)
+
+        self.assertEqual(bytes(self.server.data), written)
+        self.assertEqual(sum(self.server.requests), 16 + 1)
+        self.assertEqual(self.server.flushes, 1)
+
+    def test_one_connection_without_multi_conn(self):
+        with self.client(flags=0) as client:
+            self.assertEqual(client.connections, 1)
+            data = client.read(0, len(self.data))
+
+        self.assertEqual(bytes(data), self.data)
+        self.assertEqual(self.server.requests, [16])
+
+    def test_connections_are_closed_when_the_flush_fails(self):
+        client = self.client()
+        client.write(b"x" * 512, 0)
+        connections = list(client._clients)
+        executor = client._executor
+
+        with mock.patch.object(
+            PythonNbdClient, "flush", side_effect=python_nbd_client.NBDTransmissionError(5)
+        ):
+            with self.assertRaises(python_nbd_client.NBDTransmissionError):
+                client.close()
+
+        self.assertTrue(all(connection._closed for connection in connections))
+        self.assertEqual(client._clients, [])
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)  # Shut down
+
+
+class TestWriteZeroesTrimAndFua(FakeNbdServerTestCase):
+    """Test the commands gated on the transmission flags of the server"""
+
+    ALL_FLAGS = (
+        python_nbd_client.NBD_FLAG_SEND_FUA
+        | python_nbd_client.NBD_FLAG_SEND_TRIM
+        | python_nbd_client.NBD_FLAG_SEND_WRITE_ZEROES
+    )
+
+    def commands(self):
+        return [command[:2] for command in self.server.commands]
+
+    def test_write_zeroes(self):
+        with self.client(flags=self.ALL_FLAGS) as client:
+            client.write_zeroes(512, 1024, no_hole=True)
+
+        self.assertEqual(self.server.data[512:1536], bytes(1024))
+        self.assertEqual(
+            self.server.commands[0],
+            (python_nbd_client.NBD_CMD_WRITE_ZEROES, python_nbd_client.NBD_CMD_FLAG_NO_HOLE,
+             512, 1024),
+        )
+
+    def test_write_zeroes_needs_the_support_of_the_server(self):
+        with self.client() as client:
+            with self.assertRaises(python_nbd_client.NBDUnsupportedCommandError):
+                client.write_zeroes(0, 512)
+
+        self.assertEqual(self.server.data, self.data)
+
+    def test_trim(self):
+        with self.client(flags=self.ALL_FLAGS) as client:
+            self.assertTrue(client.trim(0, 512, fua=True))
+
+        self.assertEqual(
+            self.commands()[0],
+            (python_nbd_client.NBD_CMD_TRIM, python_nbd_client.NBD_CMD_FLAG_FUA),
+        )
+
+    def test_trim_does_nothing_without_the_support_of_the_server(self):
+        with self.client() as client:
+            self.assertFalse(client.trim(0, 512))
+
+        self.assertEqual(self.server.commands, [])
+
+    def test_fua_writes(self):
+        with self.client(flags=self.ALL_FLAGS) as client:
+            client.write(bytes(512), 0, fua=True)
+
+        self.assertEqual(
+            self.commands()[0],
+            (python_nbd_client.NBD_CMD_WRITE, python_nbd_client.NBD_CMD_FLAG_FUA),
+        )
+
+    def test_fua_writes_are_flushed_without_the_support_of_the_server(self):
+        with self.client() as client:
+            client.write(bytes(512), 0, fua=True)
+            self.assertTrue(client._flushed)
+
+        self.assertEqual(
+            self.commands(),
+            [(python_nbd_client.NBD_CMD_WRITE, 0), (python_nbd_client.NBD_CMD_FLUSH, 0)],
+        )
+
+    def test_write_sparse_sends_zero_blocks_as_write_zeroes(self):
+        data = bytes(8192) + b"x" * 4096 + bytes(4096) + b"y" * 512
+        with self.client(flags=self.ALL_FLAGS) as client:
+            zeroes = client.write_sparse(data, 1024, max_request_size=4096)
+
+        self.assertEqual(zeroes, 12288)
+        self.assertEqual(bytes(self.server.data[1024 : 1024 + len(data)]), data)
+        write, write_zeroes = (
+            python_nbd_client.NBD_CMD_WRITE, python_nbd_client.NBD_CMD_WRITE_ZEROES
+        )
+        self.assertEqual(
+            [(command, offset, length) for command, _, offset, length in self.server.commands],
+            [
+                (write_zeroes, 1024, 4096),
+                (write_zeroes, 5120, 4096),
+                (write, 9216, 4096),
+                (write_zeroes, 13312, 4096),
+                (write, 17408, 512),
+                (python_nbd_client.NBD_CMD_FLUSH, 0, 0),
+            ],
+        )
+
+    def test_write_sparse_without_write_zeroes(self):
+        data = bytes(8192) + b"x" * 4096
+        with self.client() as client:
+            zeroes = client.write_sparse(data, 0)
+
+        self.assertEqual(zeroes, 0)
+        self.assertEqual(bytes(self.server.data[: len(data)]), data)
+        self.assertEqual(self.commands()[0], (python_nbd_client.NBD_CMD_WRITE, 0))
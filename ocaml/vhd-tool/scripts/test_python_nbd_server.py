@@ -0,0 +1,171 @@
+"""Test ocaml/vhd-tool/scripts/python_nbd_server.PythonNbdServer"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import get_nbd_extents
+import python_nbd_client
+import python_nbd_server  # Tested module
+from python_nbd_client import MultiConnNbdClient, PythonNbdClient
+
+# pylint: disable=missing-function-docstring,protected-access
+
+SIZE = 1 << 20
+# The (offset, data) of the data extents of the sparse file
+DATA = [(64 << 10, bytes(range(256)) * 256), (512 << 10, b"x" * 4096)]
+
+
+class TestPythonNbdServer(unittest.TestCase):
+    """Test the server with PythonNbdClient over a sparse file"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "nbd.sock")
+        self.file = os.path.join(self.tmpdir.name, "disk.img")
+        with open(self.file, "wb") as disk:
+            disk.truncate(SIZE)
+            for offset, data in DATA:
+                disk.seek(offset)
+                disk.write(data)
+        self.data = bytearray(SIZE)
+        for offset, data in DATA:
+            self.data[offset : offset + len(data)] = data
+        self.server = None
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def serve(self, **kwargs):
+        self.server = python_nbd_server.PythonNbdServer(
+            self.path, self.file, "disk", **kwargs
+        ).start()
+
+    def client(self, structured=False, **kwargs):
+        self.serve(**kwargs)
+        client = PythonNbdClient(
+            self.path, exportname="disk", unix=True, use_tls=False, connect=False
+        )
+        if structured:
+            client.negotiate_structured_reply()
+        client.negotiate_block_size("disk")
+        client.connect("disk")
+        return client
+
+    def file_data(self):
+        with open(self.file, "rb") as disk:
+            return disk.read()
+
+    def check_read_into(self, structured):
+        buffer = bytearray(b"y" * SIZE)
+        with self.client(structured) as client:
+            self.assertEqual(client.get_size(), SIZE)
+            client.read_into(0, buffer, request_size=128 << 10)
+
+        self.assertEqual(buffer, self.data)
+
+    def test_read_into_with_simple_replies(self):
+        self.check_read_into(structured=False)
+
+    def test_read_into_with_structured_replies(self):
+        self.check_read_into(structured=True)
+
+    def test_block_sizes(self):
+        with self.client() as client:
+            self.assertEqual(
+                client.get_block_size(),
+                {
+                    "minimum_block_size": python_nbd_server.MINIMUM_BLOCK_SIZE,
+                    "preferred_block_size": python_nbd_server.PREFERRED_BLOCK_SIZE,
+                    "maximum_block_size": python_nbd_server.MAXIMUM_BLOCK_SIZE,
+                },
+            )
+
+    def test_base_allocation_from_the_holes_of_the_file(self):
+        self.serve()
+        (client, context_ids) = get_nbd_extents.open_client(self.path, "disk")
+        with client:
+            extents = list(
+                get_nbd_extents.get_extents(
+                    client, context_ids[get_nbd_extents.BASE_ALLOCATION], 0, SIZE
+                )
+            )
+
+        self.assertEqual(
+            extents,
+            [
+                {"length": 64 << 10, "flags": 3},
+                {"length": 64 << 10, "flags": 0},
+                {"length": 384 << 10, "flags": 3},
+                {"length": 4096, "flags": 0},
+                {"length": SIZE - (512 << 10) - 4096, "flags": 3},
+            ],
+        )
+
+    def test_writes(self):
+        with self.client(structured=True) as client:
+            client.write(b"z" * 8192, 4096, fua=True)
+            client.write_zeroes(64 << 10, 8192)
+            client.write_zeroes(512 << 10, 512, no_hole=True)
+            client.flush()
+
+        self.data[4096 : 4096 + 8192] = b"z" * 8192
+        self.data[64 << 10 : (64 << 10) + 8192] = bytes(8192)
+        self.data[512 << 10 : (512 << 10) + 512] = bytes(512)
+        self.assertEqual(self.file_data(), self.data)
+
+    def test_errors(self):
+        with self.client(structured=True) as client:
+            with self.assertRaises(python_nbd_client.NBDTransmissionError) as context:
+                list(client.read_many([(SIZE, 512)]))
+            self.assertEqual(context.exception.error_code, 22)  # EINVAL
+            # The connection is still usable
+            buffer = bytearray(512)
+            client.read_into(64 << 10, buffer)
+
+        self.assertEqual(buffer, self.data[64 << 10 : (64 << 10) + 512])
+
+    def test_read_only_exports(self):
+        with self.client(read_only=True) as client:
+            self.assertFalse(client.can_write_zeroes())
+            with self.assertRaises(python_nbd_client.NBDTransmissionError) as context:
+                client.write(b"z" * 512, 0)
+            self.assertEqual(context.exception.error_code, 1)  # EPERM
+
+        self.assertEqual(self.file_data(), self.data)
+
+    def test_multi_conn(self):
+        self.serve()
+        buffer = bytearray(SIZE)
+        with MultiConnNbdClient(
+            self.path, exportname="disk", unix=True, use_tls=False, stripe_size=64 << 10
+        ) as client:
+            self.assertEqual(client.connections, 4)
+            client.read_into(0, buffer)
+            client.write(b"w" * (256 << 10), 256 << 10)
+
+        self.assertEqual(buffer, self.data)
+        self.data[256 << 10 : 512 << 10] = b"w" * (256 << 10)
+        self.assertEqual(self.file_data(), self.data)
+
+    @unittest.skipUnless(shutil.which("openssl"), "needs openssl to create a certificate")
+    def test_tls(self):
+        cert = os.path.join(self.tmpdir.name, "cert.pem")
+        key = os.path.join(self.tmpdir.name, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.serve(tls_context=python_nbd_server.server_tls_context(cert, key))
+        with open(cert) as pem:
+            cadata = pem.read()
+        with PythonNbdClient(
+            self.path, exportname="disk", unix=True, cert=cadata, subject="localhost"
+        ) as client:
+            self.assertEqual(client.read(64 << 10, 4096), self.data[64 << 10 : 68 << 10])
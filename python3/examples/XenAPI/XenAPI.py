@@ -54,28 +54,55 @@
 # OF THIS SOFTWARE.
 # --------------------------------------------------------------------
 
-import gettext
+# Every plugin call is a new Python process importing this module: Import
+# only what Session needs here, and optional machinery (OpenTelemetry,
+# gettext, gzip decoding, ...) on first use.
+import collections.abc
 import os
 import socket
 import sys
+import time
 import http.client as httplib
 import xmlrpc.client as xmlrpclib
 
-otel = False
-try:
-    if os.environ["OTEL_SDK_DISABLED"] == "false":
-        from opentelemetry import propagate
-        from opentelemetry.trace.propagation import set_span_in_context, get_current_span
-        otel = True
+# The OpenTelemetry propagation functions, probed on the first request
+_otel = None
 
-except Exception:
-    pass
+def _otel_propagation():
+    """Return (propagate, set_span_in_context, get_current_span) if tracing
+    is enabled by OTEL_SDK_DISABLED=false and OpenTelemetry is installed,
+    otherwise False"""
+    global _otel
+    if _otel is None:
+        _otel = False
+        try:
+            if os.environ["OTEL_SDK_DISABLED"] == "false":
+                from opentelemetry import propagate
+                from opentelemetry.trace.propagation import set_span_in_context, get_current_span
+                _otel = (propagate, set_span_in_context, get_current_span)
+        except Exception:
+            pass
+    return _otel
+
+class _LazyTranslation:
+    """The gettext translation of the xen-xm domain, loaded on first use"""
+
+    _translation = None
 
-translation = gettext.translation('xen-xm', fallback = True)
+    def __getattr__(self, name):
+        if self._translation is None:
+            import gettext
+            self._translation = gettext.translation('xen-xm', fallback = True)
+        return getattr(self._translation, name)
+
+translation = _LazyTranslation()
 
 API_VERSION_1_1 = '1.1'
 API_VERSION_1_2 = '1.2'
 
+# The Unix socket of the local session broker (see libexec/session-broker.py)
+SESSION_BROKER_SOCKET = '/var/lib/xcp/session-broker'
+
 class Failure(Exception):
     def __init__(self, details):
         self.details = details
@@ -108,11 +135,11 @@ class UDSTransport(xmlrpclib.Transport):
         self._extra_headers += [ (key,value) ]
 
     def with_tracecontext(self):
+        otel = _otel_propagation()
         if otel:
+            propagate, set_span_in_context, get_current_span = otel
             headers = {}
-            # pylint: disable=possibly-used-before-assignment
             ctx = set_span_in_context(get_current_span())
-            # pylint: disable=possibly-used-before-assignment
             propagators = propagate.get_global_textmap()
             propagators.inject(headers, ctx)
 
@@ -164,7 +191,7 @@ class Session(xmlrpclib.ServerProxy):
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=False,
-                 allow_none=True, ignore_ssl=False):
+                 allow_none=True, ignore_ssl=False, session_broker=None):
 
         verbose = bool(verbose)
         allow_none = bool(allow_none)
@@ -182,7 +209,28 @@ class Session(xmlrpclib.ServerProxy):
         self.last_login_method = None
         self.last_login_params = None
         self._API_version = API_VERSION_1_1
-
+        self._session_broker = session_broker
+        self._brokered = False
+        self.call_stats = None
+        self._byte_counts = [0, 0]
+        if os.getenv("XENAPI_CALL_STATS"):
+            self.enable_call_stats(_process_call_stats())
+
+    def enable_call_stats(self, call_stats=None):
+        """Record the calls made through xenapi_request() in call_stats (a new
+        CallStats if not given) and return it. Calls through xenapi_stream
+        are not recorded.
+
+        Setting the XENAPI_CALL_STATS environment variable to a file name
+        enables this for all sessions of the process and writes the summary
+        of their calls to the file (as ndjson) when the process exits."""
+        if call_stats is None:
+            call_stats = CallStats()
+        if self.call_stats is None:
+            _count_transport_bytes(self._ServerProxy__transport,
+                                   self._byte_counts)
+        self.call_stats = call_stats
+        return call_stats
 
     def xenapi_request(self, methodname, params):
         if methodname.startswith('login'):
@@ -191,24 +239,155 @@ class Session(xmlrpclib.ServerProxy):
         elif methodname == 'logout' or methodname == 'session.logout':
             self._logout()
             return None
+        elif self.call_stats is None:
+            return self._request_with_retry(self._request, methodname, params)
         else:
-            retry_count = 0
-            while retry_count < 3:
-                full_params = (self._session,) + params
-                result = _parse_result(getattr(self, methodname)(*full_params))
-                if result is _RECONNECT_AND_RETRY:
-                    retry_count += 1
-                    if self.last_login_method:
-                        self._login(self.last_login_method,
-                                    self.last_login_params)
-                    else:
-                        raise xmlrpclib.Fault(401, 'You must log in')
+            return self._recorded_request(methodname, params)
+
+    def _recorded_request(self, methodname, params):
+        calls = [0]
+
+        def request(methodname, full_params):
+            calls[0] += 1
+            return self._request(methodname, full_params)
+
+        self._byte_counts[:] = [0, 0]
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = self._request_with_retry(request, methodname, params)
+            failed = False
+            return result
+        finally:
+            self.call_stats.record(methodname, time.perf_counter() - start,
+                                   self._byte_counts[0], self._byte_counts[1],
+                                   calls[0] - 1, failed)
+
+    def xenapi_request_stream(self, methodname, params):
+        """Like xenapi_request(), but decode the response while it is received.
+
+        Returns an iterable over the result: for a struct (like the result of
+        get_all_records) it yields (key, value) pairs, for an array (like the
+        result of get_all) it yields the elements, and any other result is
+        yielded as a single item. Each item is handed over as soon as it has
+        been decoded, so peak memory is proportional to one record instead of
+        the whole result. The iterable must be consumed, or closed using its
+        close() method or a with statement, before the next call on this
+        session.
+
+        Login and logout calls are not streamed: they are passed on to
+        xenapi_request() and return None like there.
+        """
+        if methodname.startswith('login') or methodname in ('logout',
+                                                            'session.logout'):
+            return self.xenapi_request(methodname, params)
+        return self._request_with_retry(self._stream_request, methodname,
+                                        params)
+
+    def xenapi_request_compact(self, methodname, params):
+        """Like xenapi_request(), but return records as compact Record
+        objects: get_all_records(_where) returns a dict of OpaqueRefs to
+        Records, get_record a Record. The records are decoded one by one from
+        the response as it is received (see xenapi_request_stream()), and the
+        field names and OpaqueRefs in them are interned. Other results are
+        returned like by xenapi_request(), with their OpaqueRefs interned."""
+        name = methodname.rsplit('.', 1)[-1]
+        with self.xenapi_request_stream(methodname, params) as stream:
+            if stream.kind == 'struct':
+                if name in ('get_all_records', 'get_all_records_where'):
+                    return {_intern_ref(ref): _compact_record(value)
+                            for ref, value in stream}
+                elif name == 'get_record':
+                    return _compact_record(dict(stream))
+                return _compact_field(dict(stream))
+            elif stream.kind == 'array':
+                return [_intern_ref(value) for value in stream]
+            return _intern_ref(stream.result)
+
+    def _request_with_retry(self, request, methodname, params):
+        retry_count = 0
+        while retry_count < 3:
+            full_params = (self._session,) + params
+            result = request(methodname, full_params)
+            if result is _RECONNECT_AND_RETRY:
+                retry_count += 1
+                # Log in directly, the broker has just handed out this session
+                self._session_broker = None
+                if self.last_login_method:
+                    self._relogin()
                 else:
-                    return result
-            raise xmlrpclib.Fault(
-                500, 'Tried 3 times to get a valid session, but failed')
+                    raise xmlrpclib.Fault(401, 'You must log in')
+            else:
+                return result
+        raise xmlrpclib.Fault(
+            500, 'Tried 3 times to get a valid session, but failed')
+
+    def _relogin(self):
+        # With call stats, record the login apart from the retried call
+        if self.call_stats is None:
+            self._login(self.last_login_method, self.last_login_params)
+            return
+        method = 'session.' + self.last_login_method
+        byte_counts = list(self._byte_counts)
+        self._byte_counts[:] = [0, 0]
+        failed = True
+        start = time.perf_counter()
+        try:
+            self._login(self.last_login_method, self.last_login_params)
+            failed = False
+        finally:
+            self.call_stats.record(method, time.perf_counter() - start,
+                                   self._byte_counts[0], self._byte_counts[1],
+                                   0, failed)
+            self._byte_counts[:] = byte_counts
+
+    def _request(self, methodname, full_params):
+        return _parse_result(getattr(self, methodname)(*full_params))
+
+    def _stream_request(self, methodname, full_params):
+        # Based upon ServerProxy.__request and Transport.single_request from
+        # xmlrpclib, but hands the response to a _ResultStream instead of
+        # parsing all of it with Transport.parse_response.
+        transport = self._ServerProxy__transport
+        host = self._ServerProxy__host
+        handler = self._ServerProxy__handler
+        encoding = self._ServerProxy__encoding
+        request = xmlrpclib.dumps(
+            full_params, methodname, encoding=encoding,
+            allow_none=self._ServerProxy__allow_none
+        ).encode(encoding, 'xmlcharrefreplace')
+        try:
+            connection = transport.send_request(host, handler, request,
+                                                self._ServerProxy__verbose)
+            response = connection.getresponse()
+            if response.status == 200:
+                stream = _ResultStream(transport, response)
+                if stream.kind is None and \
+                        stream.result is _RECONNECT_AND_RETRY:
+                    return _RECONNECT_AND_RETRY
+                return stream
+        except (xmlrpclib.Fault, Failure):
+            raise
+        except Exception:
+            transport.close()
+            raise
+        if response.getheader("content-length", ""):
+            response.read()
+        raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                      response.reason,
+                                      dict(response.getheaders()))
 
     def _login(self, method, params):
+        if self._session_broker and method == 'login_with_password':
+            session = _session_from_broker(self._session_broker, params)
+            if session:
+                self._session = session
+                self._brokered = True
+                self.last_login_method = method
+                self.last_login_params = params
+                self._API_version = None
+                return
+        self._brokered = False
         try:
             result = _parse_result(
                 getattr(self, 'session.%s' % method)(*params))
@@ -232,6 +411,9 @@ class Session(xmlrpclib.ServerProxy):
 
     def _logout(self):
         try:
+            if self._brokered:
+                # The session is shared with the other clients of the broker
+                return None
             if self.last_login_method.startswith("slave_local"):
                 # Proxied function, pytype can't see it
                 # pytype: disable=attribute-error
@@ -244,6 +426,7 @@ class Session(xmlrpclib.ServerProxy):
             self.last_login_method = None
             self.last_login_params = None
             self._API_version = API_VERSION_1_1
+            self._brokered = False
 
     def _get_api_version(self):
         pool = self.xenapi.pool.get_all()[0]
@@ -263,6 +446,10 @@ class Session(xmlrpclib.ServerProxy):
             return self._session
         elif name == 'xenapi':
             return _Dispatcher(self.xenapi_request, None)
+        elif name == 'xenapi_stream':
+            return _Dispatcher(self.xenapi_request_stream, None)
+        elif name == 'xenapi_compact':
+            return _Dispatcher(self.xenapi_request_compact, None)
         elif name.startswith('login') or name.startswith('slave_local'):
             return lambda *params: self._login(name, params)
         elif name == 'logout':
@@ -272,8 +459,57 @@ class Session(xmlrpclib.ServerProxy):
         else:
             return xmlrpclib.ServerProxy.__getattr__(self, name)
 
-def xapi_local():
-    return Session("http://_var_lib_xcp_xapi/", transport=UDSTransport())
+def xapi_local(session_broker=None):
+    """Return a Session for the local xapi, connected over its Unix socket.
+
+    If session_broker (or else the XAPI_SESSION_BROKER environment variable)
+    is the path of the socket of a local session broker, login_with_password
+    takes a shared session from the broker instead of creating a new one, and
+    logout leaves it for the other clients of the broker. If the broker is not
+    available, or the session it gave is no longer valid, the session logs in
+    directly."""
+    if session_broker is None:
+        session_broker = os.getenv("XAPI_SESSION_BROKER")
+    return Session("http://_var_lib_xcp_xapi/", transport=UDSTransport(),
+                   session_broker=session_broker)
+
+# Seconds to wait for the session broker before logging in directly
+SESSION_BROKER_TIMEOUT = 0.2
+
+def _session_from_broker(path, params):
+    """Return the session reference handed out by the broker listening on
+    path for the login_with_password params, or None if it cannot be used.
+
+    The broker keeps a session per (username, originator), so the session
+    keeps the identity of the caller. It logs in without a password, so only
+    logins without a password are brokered."""
+    if not 2 <= len(params) <= 4:
+        return None
+    username, password = params[:2]
+    originator = params[3] if len(params) == 4 else ""
+    request = "%s\t%s\n" % (username, originator)
+    if password or request.count("\t") != 1 or request.count("\n") != 1:
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(SESSION_BROKER_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(request.encode("utf-8"))
+            reply = b""
+            while not reply.endswith(b"\n") and len(reply) < 1024:
+                data = sock.recv(256)
+                if not data:
+                    break
+                reply += data
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout):
+        return None
+    session = reply.decode("utf-8", "replace").strip()
+    if session.startswith("OpaqueRef:") and session != "OpaqueRef:NULL":
+        return session
+    return None
 
 def _parse_result(result):
     if type(result) != dict or 'Status' not in result:
@@ -295,6 +531,326 @@ def _parse_result(result):
                 500, 'Missing ErrorDescription in response from server')
 
 
+class CallStats:
+    """Per-method statistics of the calls made by sessions, see
+    Session.enable_call_stats(): the number of calls, failures and retries,
+    the request and response bytes, and a histogram of the wall time.
+
+    If calls_file (a file object) is given, every call is also written to it
+    as one ndjson line."""
+
+    # Upper bounds of the wall time histogram buckets in seconds (1ms to 32s),
+    # the last bucket counts the calls taking longer than that
+    LATENCY_BUCKETS = tuple(0.001 * 2 ** i for i in range(16))
+
+    def __init__(self, calls_file=None):
+        import threading
+        self._lock = threading.Lock()
+        self._methods = {}
+        self._calls_file = calls_file
+
+    def record(self, method, seconds, request_bytes, response_bytes, retries,
+               failed=False):
+        bucket = 0
+        while bucket < len(self.LATENCY_BUCKETS) and \
+                seconds > self.LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = {
+                    "count": 0, "failed": 0, "retries": 0,
+                    "total_seconds": 0.0, "max_seconds": 0.0,
+                    "request_bytes": 0, "response_bytes": 0,
+                    "latency_buckets": [0] * (len(self.LATENCY_BUCKETS) + 1),
+                }
+            stats["count"] += 1
+            stats["failed"] += int(failed)
+            stats["retries"] += retries
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["request_bytes"] += request_bytes
+            stats["response_bytes"] += response_bytes
+            stats["latency_buckets"][bucket] += 1
+            if self._calls_file is not None:
+                import json
+                self._calls_file.write(json.dumps({
+                    "method": method, "seconds": seconds,
+                    "request_bytes": request_bytes,
+                    "response_bytes": response_bytes,
+                    "retries": retries, "failed": failed,
+                }) + "\n")
+
+    def summary(self):
+        """Return a dict of the statistics of each method"""
+        with self._lock:
+            return {method: dict(stats, latency_buckets=list(
+                        stats["latency_buckets"]))
+                    for method, stats in self._methods.items()}
+
+    def dump(self, out):
+        """Write the summary to the file object out, one ndjson line per
+        method, sorted by the total time spent in the method"""
+        import json
+        summary = self.summary()
+        for method in sorted(summary, key=lambda m: -summary[m]["total_seconds"]):
+            out.write(json.dumps(dict(method=method, **summary[method])) + "\n")
+
+
+_call_stats = None
+
+def _process_call_stats():
+    """Return the CallStats of the process enabled by XENAPI_CALL_STATS"""
+    global _call_stats
+    if _call_stats is None:
+        import atexit
+        _call_stats = CallStats()
+        atexit.register(_write_process_call_stats, os.environ["XENAPI_CALL_STATS"])
+    return _call_stats
+
+def _write_process_call_stats(path):
+    try:
+        with open(path, "a") as out:
+            _call_stats.dump(out)
+    except (IOError, OSError) as exn:
+        sys.stderr.write("Failed to write XenAPI call stats: %s\n" % exn)
+
+class _CountingResponse:
+    """Wraps a HTTP response to count the bytes read from it"""
+
+    def __init__(self, response, byte_counts):
+        self._response = response
+        self._byte_counts = byte_counts
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._byte_counts[1] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+def _count_transport_bytes(transport, byte_counts):
+    """Make transport add the sizes of the requests it sends and of the
+    responses it parses to byte_counts"""
+    request = transport.request
+    parse_response = transport.parse_response
+
+    def counted_request(host, handler, request_body, verbose=False):
+        byte_counts[0] += len(request_body)
+        return request(host, handler, request_body, verbose)
+
+    def counted_parse_response(response):
+        return parse_response(_CountingResponse(response, byte_counts))
+
+    transport.request = counted_request
+    transport.parse_response = counted_parse_response
+
+
+class Record(collections.abc.Mapping):
+    """A read-only XenAPI record that stores only its values: the field
+    names are held in an index shared by all records with the same fields.
+    Fields can be read like in the dict of the record (record['uuid'],
+    record.get('uuid'), dict(record)) or as attributes (record.uuid)."""
+
+    __slots__ = ('_fields', '_values')
+
+    def __init__(self, fields, values):
+        self._fields = fields
+        self._values = values
+
+    def __getitem__(self, name):
+        return self._values[self._fields[name]]
+
+    def __getattr__(self, name):
+        # Private and special names (looked up by copy and pickle before
+        # the slots are set) are never fields
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._fields[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        # Unpickled records share the field index of the other records
+        return (_compact_record, (dict(self),))
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Record(%r)' % dict(self)
+
+# The field indexes of the records, by their tuple of field names
+_record_fields = {}
+
+def _intern_ref(value):
+    if isinstance(value, str) and value.startswith('OpaqueRef:'):
+        return sys.intern(value)
+    return value
+
+def _compact_record(record):
+    """Return the record dict as a Record"""
+    names = tuple(record)
+    fields = _record_fields.get(names)
+    if fields is None:
+        names = tuple(sys.intern(str(name)) for name in names)
+        fields = _record_fields[names] = {name: i for i, name in enumerate(names)}
+    return Record(fields, tuple(_compact_field(v) for v in record.values()))
+
+def _compact_field(value):
+    if isinstance(value, list):
+        return [_intern_ref(v) for v in value]
+    elif isinstance(value, dict):
+        # Maps like other_config vary by record: keep them as dicts
+        return {_intern_ref(k): _intern_ref(v) for k, v in value.items()}
+    return _intern_ref(value)
+
+
+class _StreamingUnmarshaller(xmlrpclib.Unmarshaller):
+    """An Unmarshaller which takes the members of the struct (or the elements
+    of the array) in the 'Value' of a XenAPI response off its stack as soon as
+    each one has been decoded, and appends them to self.items instead."""
+
+    def __init__(self, use_datetime=False, use_builtin_types=False):
+        xmlrpclib.Unmarshaller.__init__(self, use_datetime, use_builtin_types)
+        self.kind = None
+        self.items = []
+        self._stream_mark = None
+
+    def start(self, tag, attrs):
+        # The streamed container is a struct or array started directly after
+        # the 'Value' name in the top-level struct of the response
+        if self.kind is None and tag in ("struct", "array") and \
+                len(self._marks) == 1 and \
+                (len(self._stack) - self._marks[0]) % 2 == 1 and \
+                self._stack[-1] == 'Value':
+            self.kind = tag
+            self._stream_mark = len(self._stack)
+        xmlrpclib.Unmarshaller.start(self, tag, attrs)
+
+    def end(self, tag):
+        xmlrpclib.Unmarshaller.end(self, tag)
+        if self._stream_mark is None:
+            return
+        if len(self._marks) < 2:
+            # The streamed container has been closed
+            self._stream_mark = None
+        elif len(self._marks) == 2:
+            mark = self._stream_mark
+            if self.kind == "struct" and tag == "member":
+                self.items.append(tuple(self._stack[mark:]))
+                del self._stack[mark:]
+            elif self.kind == "array" and tag == "value":
+                self.items.extend(self._stack[mark:])
+                del self._stack[mark:]
+
+
+class _ResultStream:
+    """Iterates over the items of a XenAPI result while the response is being
+    received and parsed, see Session.xenapi_request_stream().
+
+    The response is read until the start of its 'Value' struct or array. If
+    the response has ended before that, kind is None and result holds the
+    outcome of _parse_result() instead.
+
+    If the stream is closed before the response has been read to its end,
+    the connection is closed, as it cannot be used for the next request."""
+
+    chunk_size = 65536
+
+    def __init__(self, transport, response):
+        self._transport = transport
+        self._response = response
+        if response.getheader("Content-Encoding", "") == "gzip":
+            self._stream = _GzipDecodingStream(response)
+        else:
+            self._stream = response
+        self._unmarshaller = _StreamingUnmarshaller(
+            getattr(transport, '_use_datetime', False),
+            getattr(transport, '_use_builtin_types', False))
+        self._parser = xmlrpclib.ExpatParser(self._unmarshaller)
+        self._done = False
+        self._closed = False
+        self.result = None
+        while self.kind is None and not self._done:
+            self._feed()
+        if self.kind is None:
+            self.result = _parse_result(self.result)
+
+    @property
+    def kind(self):
+        return self._unmarshaller.kind
+
+    def _feed(self):
+        data = self._stream.read(self.chunk_size)
+        if data:
+            self._parser.feed(data)
+            return
+        self._done = True
+        self._parser.close()
+        self.result = self._unmarshaller.close()[0]
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            if not self._done:
+                self._transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self._closed:
+            raise ValueError("The result stream has been closed")
+        if self.kind is None:
+            yield self.result
+            return
+        try:
+            items = self._unmarshaller.items
+            while True:
+                # Hand over the decoded items and drop our references to them
+                while items:
+                    batch = items[:]
+                    del items[:]
+                    for item in batch:
+                        yield item
+                    del batch
+                if self._done:
+                    break
+                self._feed()
+            # Raise for errors, the streamed container itself is now empty
+            _parse_result(self.result)
+        finally:
+            self.close()
+
+
+class _GzipDecodingStream:
+    """Decompresses a gzip-encoded response chunk by chunk while it is read,
+    unlike xmlrpclib.GzipDecodedResponse, which reads all of it first."""
+
+    def __init__(self, response):
+        self._response = response
+        import zlib
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size):
+        while True:
+            data = self._response.read(size)
+            if not data:
+                return self._decompressor.flush()
+            data = self._decompressor.decompress(data)
+            if data:
+                return data
+
+
 # Based upon _Method from xmlrpclib.
 class _Dispatcher:
     def __init__(self, send, name):
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+#
+# Copyright (C) Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only. with the special
+# exception on linking described in file LICENSE.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+"""
+Local session broker for short-lived dom0 scripts.
+
+Holds sessions of the local xapi and hands their references to the root
+processes connecting to its Unix socket, so that bursts of scripts (like
+mail-alarm during an alarm storm) do not each log in and out of xapi.
+
+A client sends "<username>\t<originator>\n" and receives the reference of
+the session the broker keeps for this username and originator, so xapi still
+sees the identity of the script, followed by "\n" (an empty line if there is
+no session).
+
+The broker is opt-in: scripts use it when XenAPI.xapi_local() is passed the
+socket path, or when XAPI_SESSION_BROKER is set to it in their environment.
+They fall back to logging in directly if the broker is not running or the
+session it gave them turns out to be invalid.
+
+It can be socket-activated by systemd (session-broker.socket passes the
+listening socket as stdin) and then exits after being idle for a while.
+"""
+
+import argparse
+import logging
+import logging.handlers
+import os
+import socket
+import stat
+import struct
+import sys
+import time
+
+import XenAPI
+
+LOGGER = logging.getLogger("session-broker")
+LOGGER.setLevel(logging.INFO)
+
+# Seconds after which the session is checked again before handing it out
+REVALIDATE_INTERVAL = 30
+
+# Seconds without connections after which a socket-activated broker exits
+IDLE_TIMEOUT = 300
+
+
+class SessionBroker:
+    """Hands out validated, reused sessions of the local xapi"""
+
+    def __init__(self, session_factory=XenAPI.xapi_local,
+                 revalidate_interval=REVALIDATE_INTERVAL, clock=time.monotonic):
+        self._session_factory = session_factory
+        self._revalidate_interval = revalidate_interval
+        self._clock = clock
+        # (username, originator) -> (Session, time of the last validation)
+        self._sessions = {}
+
+    def _login(self, username, originator):
+        # Never take the session from a broker, which could be this one
+        session = self._session_factory(session_broker="")
+        session.xenapi.login_with_password(username, "", "1.0", originator)
+        LOGGER.info("Logged in to xapi as %r for %r", username, originator)
+        return session
+
+    def get_session(self, username, originator):
+        """Return a valid session reference for the username and originator,
+        or None if xapi cannot be used"""
+        key = (username, originator)
+        try:
+            if key not in self._sessions:
+                self._sessions[key] = (self._login(username, originator),
+                                       self._clock())
+            session, validated = self._sessions[key]
+            if self._clock() - validated >= self._revalidate_interval:
+                # On SESSION_INVALID, the Session logs in again by itself
+                session.xenapi.pool.get_all()
+                self._sessions[key] = (session, self._clock())
+            return session.handle
+        except Exception as exn:
+            LOGGER.warning("Cannot get a valid session for %r: %s", key, exn)
+            self._sessions.pop(key, None)
+            return None
+
+    def logout(self):
+        """Log out of the sessions, which invalidates them for the clients"""
+        for session, _ in self._sessions.values():
+            try:
+                session.xenapi.session.logout()
+            except Exception as exn:
+                LOGGER.warning("Failed to log out: %s", exn)
+        self._sessions.clear()
+
+    def handle(self, connection):
+        """Send the session reference to a root client, close the connection"""
+        try:
+            creds = connection.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            pid, uid, _ = struct.unpack("3i", creds)
+            if uid != 0:
+                LOGGER.warning("Refusing session to pid %d of uid %d", pid, uid)
+                return
+            request = _read_line(connection)
+            fields = request.split("\t")
+            if len(fields) != 2:
+                LOGGER.warning("Invalid request from pid %d: %r", pid, request)
+                return
+            session = self.get_session(*fields)
+            connection.sendall((session or "").encode("utf-8") + b"\n")
+        except OSError as exn:
+            LOGGER.warning("Failed to serve a client: %s", exn)
+        finally:
+            connection.close()
+
+    def serve(self, listener, idle_timeout=None):
+        """Serve the clients connecting to the listener until idle_timeout"""
+        listener.settimeout(idle_timeout)
+        try:
+            while True:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    LOGGER.info("Exiting after %s seconds idle", idle_timeout)
+                    return
+                connection.settimeout(1)
+                self.handle(connection)
+        finally:
+            self.logout()
+
+
+def _read_line(connection, limit=1024):
+    """Return the first line received on the connection, without the newline"""
+    data = b""
+    while not data.endswith(b"\n") and len(data) < limit:
+        received = connection.recv(limit - len(data))
+        if not received:
+            break
+        data += received
+    return data.decode("utf-8", "replace").rstrip("\n")
+
+
+def _activation_socket():
+    """Return the listening socket passed as stdin by systemd, if any"""
+    try:
+        if not stat.S_ISSOCK(os.fstat(0).st_mode):
+            return None
+    except OSError:
+        return None
+    return socket.socket(fileno=os.dup(0))
+
+
+def _listen(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o600)
+    listener.listen(16)
+    return listener
+
+
+def main():
+    syslog_handler = logging.handlers.SysLogHandler(
+        address="/dev/log", facility=logging.handlers.SysLogHandler.LOG_DAEMON
+    )
+    syslog_handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+    logging.getLogger().addHandler(syslog_handler)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--socket",
+        default=XenAPI.SESSION_BROKER_SOCKET,
+        help="The path of the Unix socket to listen on, unless socket-activated",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="Exit after this many seconds without clients (default: %d when "
+        "socket-activated, never otherwise)" % IDLE_TIMEOUT,
+    )
+    parser.add_argument(
+        "--revalidate-interval",
+        type=float,
+        default=REVALIDATE_INTERVAL,
+        help="Check that the session is still valid when it is older than this "
+        "many seconds",
+    )
+    args = parser.parse_args()
+
+    listener = _activation_socket()
+    idle_timeout = args.idle_timeout
+    if listener is None:
+        listener = _listen(args.socket)
+    elif idle_timeout is None:
+        idle_timeout = IDLE_TIMEOUT
+
+    broker = SessionBroker(revalidate_interval=args.revalidate_interval)
+    broker.serve(listener, idle_timeout=idle_timeout or None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
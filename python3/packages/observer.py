@@ -14,10 +14,53 @@
 """
 Calls the passed script with its original arguments, instrumenting it to make a
 trace of all function calls if at least one *observer.conf file exists in the
-OBSERVER_CONFIG_DIR directory.
+OBSERVER_CONFIG_DIR directory, or to profile them if all.conf sets mode=profile.
 
 If there are no *observer.conf files or something fails, this script runs the
 passed script without any instrumentation.
+
+The optional all.conf file in OBSERVER_CONFIG_DIR configures the tracing of
+all observers:
+
+module_names:          The modules to instrument (default: LVHDSR,XenAPI,SR,SRCommand,util)
+sample_ratio:          The ratio of root calls that are traced (default: 1)
+max_spans_per_second:  The maximum number of spans per second (default: 0, no limit)
+sample_errors:         Trace the untraced calls that raise (default: true)
+max_span_depth:        Do not trace the calls nested deeper than this in traced
+                       calls (default: 0, no limit)
+instrument_include:    If set, instrument only the functions whose
+                       module:qualname matches one of these space-separated
+                       patterns: globs (LVHDSR:LVHDSR.*) or regular
+                       expressions prefixed with re: (re:^SR:SR[.](scan|attach)$)
+instrument_exclude:    Do not instrument the functions matching these patterns
+span_args_max_bytes:   Truncate the captured arguments to this size (default: 1024)
+span_args_allow:       If set, capture only the arguments with these names
+span_args_deny:        Never capture the arguments with these names
+trace_compression:     Compression of the trace files: zstd (needs the zstandard
+                       module) or none (default: none), as read by xs-trace
+trace_file_max_bytes:  Start a new trace file after this size (default: 1048576)
+trace_file_max_seconds: Start a new trace file after this time (default: 0, never)
+trace_dir_max_bytes:   Delete the oldest trace files of the process above this
+                       total (default: 104857600)
+trace_queue_size:      The batches of spans queued for writing or sending to a
+                       Unix socket, more are dropped (default: 1024)
+setup_spans:           Trace the setup of observer.py and the instrumentation of
+                       the modules (default: false)
+mode:                  trace, or profile to count the calls of the instrumented
+                       functions and their durations instead of tracing them
+                       (this does not need an *observer.conf file)
+profile_dir:           Where profile mode writes <script>-<pid>.ndjson
+                       (default: /var/log/dt/profile)
+profile_interval:      Seconds between the writes of the profile (default: 60)
+
+Besides xs_exporter_bugtool_endpoint and xs_exporter_zipkin_endpoints, an
+*observer.conf can set xs_exporter_unix_socket to the path of a Unix socket
+of a collector, to which the spans are sent in batches in the binary encoding
+of encode_spans().
+
+The parsed config files are cached in the OBSERVER_CONFIG_CACHE file (default:
+/run/observer/config.cache, empty for no cache) until they are modified.
+OpenTelemetry is imported and the exporters are created with the first span.
 """
 
 import time
@@ -31,18 +74,21 @@ observer_mono_start = time.monotonic()
 def current_otel_time():
     return observer_ts_start + to_otel_timestamp(time.monotonic() - observer_mono_start)
 
-import configparser
 import functools
 import inspect
 import logging
+import marshal
 import os
 import runpy
+import socket
+import struct
 import sys
+import threading
 import traceback
 import types
 from datetime import datetime, timezone
 from logging.handlers import SysLogHandler
-from typing import List, Sequence
+from typing import Any, Dict, List, Sequence
 
 # The OpenTelemetry library may generate exceptions we aren't expecting: This code
 # must not fail or it will cause the pass-through script to fail when at worst
@@ -55,6 +101,7 @@ from typing import List, Sequence
 
 DEBUG_ENABLED = os.getenv("XAPI_TEST")
 DEFAULT_MODULES = "LVHDSR,XenAPI,SR,SRCommand,util"
+CONFIG_CACHE = "/run/observer/config.cache"
 FORMAT = "observer.py: %(message)s"
 handler = SysLogHandler(facility="local5", address="/dev/log")
 logging.basicConfig(format=FORMAT, handlers=[handler])
@@ -80,20 +127,785 @@ def _get_configs_list(config_dir):
         return []
 
 
+# The parsed config files: path -> ((mtime_ns, size), header, config)
+_config_snapshot = None
+
+
+def _load_config_snapshot():
+    """Return the snapshot of the parsed config files of the last run"""
+    path = os.getenv("OBSERVER_CONFIG_CACHE", CONFIG_CACHE)
+    try:
+        with open(path, "rb") as cache_file:
+            snapshot = marshal.load(cache_file)
+        if isinstance(snapshot, dict):
+            return snapshot
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return {}
+
+
+def _save_config_snapshot(snapshot):
+    path = os.getenv("OBSERVER_CONFIG_CACHE", CONFIG_CACHE)
+    if not path:
+        return
+    # Without logging: It is not an error if the cache cannot be written
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(f"{path}.{os.getpid()}", "wb") as cache_file:
+            marshal.dump(snapshot, cache_file)
+        os.rename(f"{path}.{os.getpid()}", path)
+    except OSError:
+        pass
+
+
 def read_config(config_path, header):
-    """Read a config file and return a dictionary of key-value pairs."""
+    """Read a config file and return a dictionary of key-value pairs.
 
-    parser = configparser.ConfigParser(interpolation=None)
-    with open(config_path, encoding="utf-8") as config_file:
-        try:
-            parser.read_string(f"[{header}]\n{config_file.read()}")
-        except configparser.ParsingError as e:
-            debug("read_config(): invalid config file %s: %s", config_path, e)
-            return {}
+    The parsed config is cached in the OBSERVER_CONFIG_CACHE file for the
+    next runs, as long as the modification time and size of the file stay the
+    same."""
+    global _config_snapshot  # pylint: disable=global-statement
 
-    config = {k: v.strip("'") for k, v in dict(parser[header]).items()}
+    try:
+        stat = os.stat(config_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        version = None
+    if version and _config_snapshot is None:
+        _config_snapshot = _load_config_snapshot()
+    cached = _config_snapshot.get(config_path) if version else None
+    if cached and cached[0] == version and cached[1] == header:
+        config = cached[2]
+    else:
+        import configparser
+
+        parser = configparser.ConfigParser(interpolation=None)
+        with open(config_path, encoding="utf-8") as config_file:
+            try:
+                parser.read_string(f"[{header}]\n{config_file.read()}")
+            except configparser.ParsingError as e:
+                debug("read_config(): invalid config file %s: %s", config_path, e)
+                return {}
+
+        config = {k: v.strip("'") for k, v in dict(parser[header]).items()}
+        if version:
+            _config_snapshot[config_path] = (version, header, config)
+            _save_config_snapshot(_config_snapshot)
     debug("%s: %s", config_path, config)
-    return config
+    return dict(config)
+
+
+def _config_bool(value):
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class InstrumentFilter:
+    """
+    Selects the functions to instrument by their "module:qualname".
+
+    The patterns are globs, or regular expressions if prefixed with "re:".
+    In all.conf, they are separated by whitespace, which a module:qualname
+    never contains, while regular expressions can contain commas (a{1,3}).
+    A function is instrumented if it matches an include pattern (or there
+    are none) and does not match an exclude pattern.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+
+    @staticmethod
+    def _compile(patterns):
+        import fnmatch
+        import re
+
+        regexes = [
+            pattern[len("re:"):] if pattern.startswith("re:") else fnmatch.translate(pattern)
+            for pattern in patterns
+        ]
+        return re.compile("|".join(f"(?:{regex})" for regex in regexes)) if regexes else None
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the InstrumentFilter configured in the all.conf config"""
+
+        def patterns(key):
+            return config.get(key, "").split()
+
+        return cls(patterns("instrument_include"), patterns("instrument_exclude"))
+
+    def __call__(self, name):
+        """Return whether to instrument the function with the module:qualname"""
+        if self.include and not self.include.match(name):
+            return False
+        return not (self.exclude and self.exclude.match(name))
+
+
+class Sampler:
+    """
+    Head-based sampling of the traced calls.
+
+    The decision is taken when a traced call is entered outside of any other
+    traced call of the thread (the root of a trace): it is sampled with the
+    probability ratio. The calls nested in an unsampled call are not sampled.
+    In addition, at most max_spans_per_second spans are recorded per second
+    (0 for no limit), and the calls nested deeper than max_depth traced calls
+    are not sampled (0 for no limit). With sample_errors, an unsampled call
+    that raises an exception still gets a span, recording the exception.
+
+    The knobs are read from all.conf: sample_ratio, max_spans_per_second,
+    max_span_depth and sample_errors.
+    """
+
+    def __init__(self, ratio=1.0, max_spans_per_second=0, sample_errors=True,
+                 clock=time.monotonic, rand=None, max_depth=0):
+        self.ratio = ratio
+        self.max_spans_per_second = max_spans_per_second
+        self.max_depth = max_depth
+        self.sample_errors = sample_errors
+        self._clock = clock
+        if rand is None and ratio < 1:
+            import random
+
+            rand = random.random
+        self._random = rand
+        self._local = threading.local()
+        self._second = None
+        self._spans_in_second = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the Sampler configured in the all.conf config, or None if
+        all calls are to be traced"""
+        try:
+            ratio = float(config.get("sample_ratio", 1))
+            max_spans_per_second = int(config.get("max_spans_per_second", 0))
+            max_depth = int(config.get("max_span_depth", 0))
+        except ValueError as err:
+            syslog.error("invalid sampling configuration, tracing all calls: %s", err)
+            return None
+        if ratio >= 1 and max_spans_per_second <= 0 and max_depth <= 0:
+            return None
+        sample_errors = _config_bool(config.get("sample_errors", "true"))
+        return cls(ratio, max_spans_per_second, sample_errors, max_depth=max_depth)
+
+    def enter(self):
+        """Enter a traced call and return whether a span is to be recorded.
+        Each enter() must be followed by an exit() when the call returns."""
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        if depth and local.unsampled_at is not None:
+            return False
+        if self.max_depth > 0 and depth >= self.max_depth:
+            local.unsampled_at = depth
+            return False
+        sampled = (
+            depth > 0 or self.ratio >= 1 or self._random() < self.ratio
+        ) and self._within_budget()
+        local.unsampled_at = None if sampled else depth
+        return sampled
+
+    def exit(self):
+        """Exit the traced call entered last"""
+        local = self._local
+        local.depth -= 1
+        if local.unsampled_at == local.depth:
+            local.unsampled_at = None
+
+    def _within_budget(self):
+        if self.max_spans_per_second <= 0:
+            return True
+        second = int(self._clock())
+        if second != self._second:
+            self._second = second
+            self._spans_in_second = 0
+        if self._spans_in_second >= self.max_spans_per_second:
+            return False
+        self._spans_in_second += 1
+        return True
+
+
+class ArgumentCapture:
+    """
+    Captures the arguments of traced calls as span attributes.
+
+    The parameters of each function are looked up once and cached. Arguments
+    are converted to strings truncated to max_bytes, without converting all
+    of a large container. If allow is not empty, only the arguments with
+    these names are captured, and the arguments with names in deny never are.
+    """
+
+    def __init__(self, max_bytes=1024, allow=(), deny=()):
+        import reprlib
+
+        self.max_bytes = max_bytes
+        self.allow = frozenset(allow)
+        self.deny = frozenset(deny)
+        self._repr = reprlib.Repr()
+        self._repr.maxstring = self._repr.maxother = max_bytes or 1 << 30
+        self._repr.maxdict = self._repr.maxlist = self._repr.maxtuple = 32
+        self._repr.maxset = self._repr.maxfrozenset = 32
+        self._parameters = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the ArgumentCapture configured in the all.conf config"""
+
+        def names(key):
+            return [name.strip() for name in config.get(key, "").split(",") if name.strip()]
+
+        try:
+            max_bytes = int(config.get("span_args_max_bytes", 1024))
+        except ValueError as err:
+            syslog.error("invalid span_args_max_bytes, using 1024: %s", err)
+            max_bytes = 1024
+        return cls(max_bytes, names("span_args_allow"), names("span_args_deny"))
+
+    def _parameters_of(self, wrapped):
+        """Return (positional names, all names, *args name, **kwargs name,
+        defaults) of the parameters of wrapped, without self for methods"""
+        key = (getattr(wrapped, "__func__", wrapped), inspect.ismethod(wrapped))
+        parameters = self._parameters.get(key)
+        if parameters is None:
+            positional, names, varargs, varkw, defaults = [], set(), None, None, {}
+            for param in inspect.signature(wrapped).parameters.values():
+                if param.kind == param.VAR_POSITIONAL:
+                    varargs = param.name
+                elif param.kind == param.VAR_KEYWORD:
+                    varkw = param.name
+                else:
+                    names.add(param.name)
+                    if param.kind != param.KEYWORD_ONLY:
+                        positional.append(param.name)
+                if param.default is not param.empty:
+                    defaults[param.name] = param.default
+            parameters = (positional, names, varargs, varkw, defaults)
+            self._parameters[key] = parameters
+        return parameters
+
+    def arguments(self, wrapped, args, kwargs):
+        """Return a dict of the span attributes of the arguments of a call"""
+        positional, names, varargs, varkw, defaults = self._parameters_of(wrapped)
+        arguments = dict(zip(positional, args))
+        if varargs and len(args) > len(positional):
+            arguments[varargs] = args[len(positional):]
+        extra = {}
+        for name, value in kwargs.items():
+            if name in names:
+                arguments[name] = value
+            else:
+                extra[name] = value
+        if varkw and extra:
+            arguments[varkw] = extra
+        else:
+            arguments.update(extra)
+        for name, value in defaults.items():
+            arguments.setdefault(name, value)
+        return {
+            f"xs.span.arg.{name}": self.text(value)
+            for name, value in arguments.items()
+            if name not in self.deny and (not self.allow or name in self.allow)
+        }
+
+    def text(self, value):
+        """Return str(value), truncated to max_bytes of UTF-8"""
+        if isinstance(value, (dict, list, tuple, set, frozenset, bytes)):
+            text = self._repr.repr(value)
+        else:
+            text = str(value)
+        if self.max_bytes and len(text) > self.max_bytes // 4:
+            data = text[: self.max_bytes + 1].encode("utf-8", "replace")
+            if len(data) > self.max_bytes:
+                text = data[: self.max_bytes].decode("utf-8", "ignore") + "..."
+        return text
+
+
+class SegmentWriter:
+    """
+    Writes ndjson lines to trace files from a background thread.
+
+    write() only queues the line, so that the traced program never waits for
+    the disk: If the queue is full, the line is dropped and counted in
+    dropped. The file is kept open and a new file (named by filename_callback)
+    is started when it reaches max_file_bytes on disk or is max_file_seconds
+    old. The oldest trace files written by this writer are then deleted to
+    keep their total size below max_dir_bytes (the files of other processes
+    in the directory are left to scripts/xapi-tracing-log-trim.sh).
+
+    The files are compressed with zstd (.ndjson.zst) or not at all (.ndjson),
+    the formats that xs-trace reads.
+    """
+
+    SUFFIXES = {"zstd": ".zst", "none": ""}
+
+    def __init__(self, filename_callback, compression="none", max_file_bytes=1 << 20,
+                 max_file_seconds=0, max_dir_bytes=100 << 20, queue_size=1024,
+                 clock=time.monotonic):
+        import queue
+
+        if compression not in self.SUFFIXES:
+            syslog.error("invalid trace_compression %s, not compressing", compression)
+            compression = "none"
+        if compression == "zstd":
+            try:
+                import zstandard  # type: ignore[import-not-found] # pylint: disable=unused-import
+            except ImportError:
+                syslog.error("trace_compression zstd needs zstandard, not compressing")
+                compression = "none"
+        self.filename_callback = filename_callback
+        self.compression = compression
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        self.max_dir_bytes = max_dir_bytes
+        self.dropped = 0
+        self.filename = None
+        self._clock = clock
+        self._queue = queue.Queue(queue_size)
+        self._full = queue.Full
+        self._thread = None
+        self._file = None
+        self._stream = None
+        self._opened = 0.0
+        # The (filename, size) of the closed trace files, oldest first
+        self._segments = []
+
+    @classmethod
+    def from_config(cls, filename_callback, config):
+        """Return the SegmentWriter configured in the all.conf config"""
+        knobs = {}
+        for key, knob in (
+            ("trace_file_max_bytes", "max_file_bytes"),
+            ("trace_file_max_seconds", "max_file_seconds"),
+            ("trace_dir_max_bytes", "max_dir_bytes"),
+            ("trace_queue_size", "queue_size"),
+        ):
+            try:
+                if key in config:
+                    knobs[knob] = int(config[key])
+            except ValueError as err:
+                syslog.error("invalid %s, using the default: %s", key, err)
+        compression = config.get("trace_compression", "none").strip().lower()
+        return cls(filename_callback, compression, **knobs)
+
+    def write(self, line):
+        """Queue the line for writing, return False if it was dropped"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="observer-trace-writer", daemon=True
+            )
+            self._thread.start()
+        try:
+            self._queue.put_nowait(line)
+            return True
+        except self._full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=10):
+        """Write the queued lines and close the file"""
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except self._full:
+                # Do not block the exit of the program: the thread is a daemon
+                debug("trace file queue full at exit, %d lines not written",
+                      self._queue.qsize())
+            else:
+                self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            try:
+                self._write(line)
+            except Exception as err:
+                debug("Failed to write the trace file %s: %s", self.filename, err)
+                self._close_file()
+        self._close_file()
+
+    def _write(self, line):
+        if self._stream is None:
+            self._open_file()
+        self._stream.write(f"{line}\n".encode("utf-8"))
+        if self._file.tell() >= self.max_file_bytes or (
+            self.max_file_seconds and self._clock() - self._opened >= self.max_file_seconds
+        ):
+            self._close_file()
+            self._trim_segments()
+
+    def _open_file(self):
+        self.filename = self.filename_callback() + self.SUFFIXES[self.compression]
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        self._file = open(self.filename, "ab")  # pylint: disable=consider-using-with
+        if self.compression == "zstd":
+            import zstandard  # type: ignore[import-not-found]
+
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file)
+        else:
+            self._stream = self._file
+        self._opened = self._clock()
+
+    def _close_file(self):
+        try:
+            if self._stream is not None and self._stream is not self._file:
+                self._stream.close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                try:
+                    self._segments.append((self.filename, os.path.getsize(self.filename)))
+                except OSError:
+                    pass
+            self._stream = self._file = None
+
+    def _trim_segments(self):
+        """Delete the oldest trace files of this writer above max_dir_bytes"""
+        total = sum(size for _, size in self._segments)
+        while total > self.max_dir_bytes and self._segments:
+            filename, size = self._segments.pop(0)
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass  # Already deleted by xapi-tracing-log-trim.sh
+            total -= size
+
+
+class _NoSpan:
+    """A context manager that does nothing, for Python 3.6"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+class Profile:
+    """
+    Aggregates the calls of the instrumented functions in profile mode.
+
+    Instead of recording spans, the calls are counted per function with their
+    total and maximum duration and a histogram of their durations: bucket 0
+    counts the calls shorter than 1us and bucket i the calls from 2^(i-1) to
+    2^i us, the last bucket the longer calls. The summary is written to
+    profile_dir/<script>-<pid>.ndjson every interval seconds and at exit.
+    """
+
+    BUCKETS = 25
+
+    def __init__(self, path, interval=60.0, clock=time.perf_counter):
+        self.path = path
+        self.interval = interval
+        self._clock = clock
+        # function -> [name, count, total, max, buckets]
+        self._functions = {}
+        # The instrumented functions can be called from several threads
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the Profile configured in the all.conf config"""
+        profile_dir = config.get("profile_dir", "/var/log/dt/profile")
+        script = os.path.basename(sys.argv[1]) if len(sys.argv) > 1 else "observer"
+        try:
+            interval = float(config.get("profile_interval", 60))
+        except ValueError as err:
+            syslog.error("invalid profile_interval, using 60: %s", err)
+            interval = 60.0
+        return cls(f"{profile_dir}/{script}-{os.getpid()}.ndjson", interval)
+
+    def call(self, wrapped, args, kwargs):
+        """Call wrapped and record the duration of the call"""
+        start = self._clock()
+        try:
+            return wrapped(*args, **kwargs)
+        finally:
+            self.record(wrapped, self._clock() - start)
+
+    def record(self, wrapped, seconds):
+        """Record a call of wrapped that took seconds"""
+        key = getattr(wrapped, "__func__", wrapped)
+        bucket = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        with self._lock:
+            stats = self._functions.get(key)
+            if stats is None:
+                module_name = getattr(wrapped, "__module__", "")
+                qual_name = getattr(wrapped, "__qualname__", "")
+                name = f"{module_name}:{qual_name}" if module_name or qual_name else str(wrapped)
+                stats = self._functions[key] = [name, 0, 0.0, 0.0, [0] * self.BUCKETS]
+            stats[1] += 1
+            stats[2] += seconds
+            if seconds > stats[3]:
+                stats[3] = seconds
+            stats[4][bucket] += 1
+
+    def summary(self):
+        """Return the statistics of the functions, the most expensive first"""
+        with self._lock:
+            functions = [
+                {
+                    "function": name,
+                    "count": count,
+                    "total_seconds": total,
+                    "max_seconds": maximum,
+                    "latency_buckets": list(buckets),
+                }
+                for name, count, total, maximum, buckets in self._functions.values()
+            ]
+        return sorted(functions, key=lambda function: -function["total_seconds"])
+
+    def write(self):
+        """Replace the profile file with the current summary"""
+        import json
+
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "w", encoding="utf-8") as profile_file:
+                for function in self.summary():
+                    profile_file.write(json.dumps(function) + "\n")
+            os.rename(f"{self.path}.tmp", self.path)
+        except OSError as err:
+            syslog.error("Failed to write the profile %s: %s", self.path, err)
+
+    def start(self):
+        """Write the summary every interval seconds and at exit"""
+        import atexit
+
+        atexit.register(self.write)
+        if self.interval > 0:
+            thread = threading.Thread(target=self._run, name="observer-profile", daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+
+# The Profile of the program in profile mode, see _init_tracing()
+profile = None
+
+
+# The encoding of the batches of spans sent to Unix sockets, in network order:
+# batch:      magic, payload size (after the header), number of spans,
+#             followed by the service name and the spans
+# span:       trace_id, span_id, parent span_id (0 if none), start and end
+#             time (ns since the epoch), kind, status code, number of
+#             attributes, number of events, followed by the name, the status
+#             description (long string), the attributes and the events
+# event:      time (ns since the epoch), number of attributes, followed by
+#             the name and the attributes (recorded exceptions are events
+#             named "exception" with exception.* attributes)
+# attribute:  name (short string), value (long string, str() of the value)
+# strings:    length (H for short strings, I for long strings) + UTF-8 bytes
+BATCH_MAGIC = b"XST2"
+BATCH_HEADER = struct.Struct("!4sII")
+SPAN_HEADER = struct.Struct("!16s8s8sQQBBHH")
+EVENT_HEADER = struct.Struct("!QH")
+
+
+def _pack_str(text, length_format="!H"):
+    data = str(text).encode("utf-8", "replace")
+    if length_format == "!H":
+        data = data[:0xFFFF]
+    return struct.pack(length_format, len(data)) + data
+
+
+def _unpack_str(data, offset, length_format="!H"):
+    (length,) = struct.unpack_from(length_format, data, offset)
+    offset += struct.calcsize(length_format)
+    return data[offset : offset + length].decode("utf-8", "replace"), offset + length
+
+
+def _pack_attributes(parts, attributes):
+    for key, value in attributes.items():
+        parts.append(_pack_str(key))
+        parts.append(_pack_str(value, "!I"))
+
+
+def _unpack_attributes(data, offset, count):
+    attributes = {}
+    for _ in range(count):
+        key, offset = _unpack_str(data, offset)
+        attributes[key], offset = _unpack_str(data, offset, "!I")
+    return attributes, offset
+
+
+def encode_spans(spans, service_name):
+    """Encode the finished (OpenTelemetry ReadableSpan) spans as a batch"""
+    parts = [_pack_str(service_name)]
+    for span in spans:
+        attributes = span.attributes or {}
+        events = span.events or ()
+        parent = span.parent.span_id if span.parent else 0
+        parts.append(
+            SPAN_HEADER.pack(
+                span.context.trace_id.to_bytes(16, "big"),
+                span.context.span_id.to_bytes(8, "big"),
+                parent.to_bytes(8, "big"),
+                span.start_time or 0,
+                span.end_time or 0,
+                span.kind.value,
+                span.status.status_code.value,
+                len(attributes),
+                len(events),
+            )
+        )
+        parts.append(_pack_str(span.name))
+        parts.append(_pack_str(span.status.description or "", "!I"))
+        _pack_attributes(parts, attributes)
+        for event in events:
+            event_attributes = event.attributes or {}
+            parts.append(EVENT_HEADER.pack(event.timestamp or 0, len(event_attributes)))
+            parts.append(_pack_str(event.name))
+            _pack_attributes(parts, event_attributes)
+    payload = b"".join(parts)
+    return BATCH_HEADER.pack(BATCH_MAGIC, len(payload), len(spans)) + payload
+
+
+def decode_spans(batch: bytes) -> List[Dict[str, Any]]:
+    """Decode a batch of encode_spans() to a list of dicts"""
+    magic, size, count = BATCH_HEADER.unpack_from(batch)
+    if magic != BATCH_MAGIC or len(batch) != BATCH_HEADER.size + size:
+        raise ValueError("invalid batch of spans")
+    service_name, offset = _unpack_str(batch, BATCH_HEADER.size)
+    spans = []
+    for _ in range(count):
+        trace_id, span_id, parent_id, start, end, kind, status, attributes, events = (
+            SPAN_HEADER.unpack_from(batch, offset)
+        )
+        name, offset = _unpack_str(batch, offset + SPAN_HEADER.size)
+        description, offset = _unpack_str(batch, offset, "!I")
+        span = {
+            "service_name": service_name,
+            "name": name,
+            "trace_id": trace_id.hex(),
+            "span_id": span_id.hex(),
+            "parent_id": parent_id.hex() if any(parent_id) else None,
+            "start_time": start,
+            "end_time": end,
+            "kind": kind,
+            "status_code": status,
+            "status_description": description,
+            "events": [],
+        }
+        span["attributes"], offset = _unpack_attributes(batch, offset, attributes)
+        for _ in range(events):
+            timestamp, event_attributes = EVENT_HEADER.unpack_from(batch, offset)
+            event_name, offset = _unpack_str(batch, offset + EVENT_HEADER.size)
+            event = {"name": event_name, "timestamp": timestamp}
+            event["attributes"], offset = _unpack_attributes(batch, offset, event_attributes)
+            span["events"].append(event)
+        spans.append(span)
+    return spans
+
+
+class SpanSender:
+    """
+    Sends batches of encoded spans to a Unix stream socket from a background
+    thread.
+
+    send() only queues the batch, so that the traced program never waits
+    for the collector: If the queue is full, or the collector is not
+    available when the batch is to be sent, the batch is dropped and counted
+    in dropped. The connection is kept open and made again, at most once per
+    reconnect_interval, when it fails. A collector that does not receive a
+    batch within send_timeout is treated like a failed connection.
+    """
+
+    def __init__(self, path, queue_size=1024, reconnect_interval=1.0, clock=time.monotonic,
+                 send_timeout=1.0):
+        import queue
+
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+        self.send_timeout = send_timeout
+        self.dropped = 0
+        self._clock = clock
+        self._queue = queue.Queue(queue_size)
+        self._full = queue.Full
+        self._thread = None
+        self._socket = None
+        self._connect_time = None
+
+    @classmethod
+    def from_config(cls, path, config):
+        """Return the SpanSender to path configured in the all.conf config"""
+        try:
+            return cls(path, int(config.get("trace_queue_size", 1024)))
+        except ValueError as err:
+            syslog.error("invalid trace_queue_size, using the default: %s", err)
+            return cls(path)
+
+    def send(self, batch):
+        """Queue the batch for sending, return False if it was dropped"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="observer-span-sender", daemon=True
+            )
+            self._thread.start()
+        try:
+            self._queue.put_nowait(batch)
+            return True
+        except self._full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=10):
+        """Send the queued batches and close the connection"""
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except self._full:
+                # Do not block the exit of the program: the thread is a daemon
+                debug("span sender queue full at exit, %d batches not sent",
+                      self._queue.qsize())
+            else:
+                self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if not self._connected():
+                self.dropped += 1
+                continue
+            try:
+                self._socket.sendall(batch)
+            except OSError as err:
+                debug("Failed to send spans to %s: %s", self.path, err)
+                self.dropped += 1
+                self._disconnect()
+        self._disconnect()
+
+    def _connected(self):
+        if self._socket is not None:
+            return True
+        now = self._clock()
+        if self._connect_time is not None and now - self._connect_time < self.reconnect_interval:
+            return False
+        self._connect_time = now
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.send_timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as err:
+            debug("Cannot connect to the span collector %s: %s", self.path, err)
+            sock.close()
+            return False
+        self._socket = sock
+        return True
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
 
 
 def _span_noop(wrapped=None, span_name_prefix=""):
@@ -112,7 +924,10 @@ def _init_tracing(configs: List[str], config_dir: str):
     """
     Initialise tracing with the given configuration files.
 
-    If configs is empty, return the noop span and patch_module functions.
+    If configs is empty and all.conf does not set mode=profile, return the noop
+    span and patch_module functions.
+    In profile mode, return the functions instrumenting the calls for the
+    profile, without importing OpenTelemetry.
     If configs are passed:
     - Import the OpenTelemetry packages
     - Read the configuration file
@@ -120,8 +935,22 @@ def _init_tracing(configs: List[str], config_dir: str):
     - Trace the script
     - Return the span and patch_module functions for tracing the program
     """
-    if not configs:
+    global profile  # pylint: disable=global-statement
+
+    if not configs and not os.path.exists(f"{config_dir}/all.conf"):
+        return _span_noop, _patch_module_noop
+
+    try:
+        config_dict = read_config(f"{config_dir}/all.conf", header="default")
+    except FileNotFoundError:
+        config_dict = {}
+    profile = None
+    if config_dict.get("mode", "trace").strip().lower() == "profile":
+        profile = Profile.from_config(config_dict)
+    elif not configs:
         return _span_noop, _patch_module_noop
+    module_names = config_dict.get("module_names", DEFAULT_MODULES).split(",")
+    debug("module_names: %s", module_names)
 
     try:
         from warnings import simplefilter
@@ -129,68 +958,31 @@ def _init_tracing(configs: List[str], config_dir: str):
         # On 3.10-3.12, the import of wrapt might trigger warnings, filter them:
         simplefilter(action="ignore", category=DeprecationWarning)
 
-        import_ts_start = current_otel_time()
-
         import wrapt # type: ignore[import-untyped]
+    except ImportError as err:
+        syslog.error("missing opentelemetry dependencies: %s", err)
+        return _span_noop, _patch_module_noop
+
+    otelvars = "opentelemetry-python.readthedocs.io/en/latest/sdk/environment_variables.html"
+    observer_config_dicts = [read_config(path, header=otelvars) for path in configs]
+
+    # The tracers are created with the first span, see get_tracers()
+    tracers = None
+    tracers_lock = threading.Lock()
+    import_ts = []
+
+    def create_tracer_from_config(config, file_exporter, unix_socket_exporter):
+        """Create a tracer from the config of an observer."""
         from opentelemetry import context, trace
         from opentelemetry.baggage.propagation import W3CBaggagePropagator
         from opentelemetry.exporter.zipkin.json import ZipkinExporter
         from opentelemetry.sdk.resources import Resource
         from opentelemetry.sdk.trace import TracerProvider
-        from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExportResult
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
         from opentelemetry.trace.propagation.tracecontext import (
             TraceContextTextMapPropagator,
         )
 
-        import_ts_end = current_otel_time()
-    except ImportError as err:
-        syslog.error("missing opentelemetry dependencies: %s", err)
-        return _span_noop, _patch_module_noop
-
-    try:
-        config_dict = read_config(f"{config_dir}/all.conf", header="default")
-    except FileNotFoundError:
-        config_dict = {}
-    module_names = config_dict.get("module_names", DEFAULT_MODULES).split(",")
-    debug("module_names: %s", module_names)
-
-    # pylint: disable=too-few-public-methods
-    class FileZipkinExporter(ZipkinExporter):
-        """Class to export spans to a file in Zipkin format."""
-
-        def __init__(self, *args, **kwargs):
-            self.bugtool_filename_callback = kwargs.pop("filename_callback")
-            self.bugtool_filename = self.bugtool_filename_callback()
-            self.trace_log_dir = kwargs.pop("trace_log_dir")
-            debug("bugtool filename=%s", self.bugtool_filename)
-            self.bytes_written = 0
-            super().__init__(*args, **kwargs)
-
-        def export(self, spans: Sequence[trace.Span]) -> SpanExportResult:
-            """Export the given spans to the file endpoint."""
-
-            data = self.encoder.serialize(spans, self.local_node)
-            datastr = str(data)
-            debug("data.type=%s,data.len=%s", type(data), len(datastr))
-            debug("data=%s", datastr)
-            os.makedirs(name=self.trace_log_dir, exist_ok=True)
-
-            with open(self.bugtool_filename, "a", encoding="utf-8") as bugtool_file:
-                bugtool_file.write(f"{datastr}\n")  # ndjson
-            self.bytes_written += len(data)
-
-            # Create new file if it gets > 1MB
-            if self.bytes_written > 1024 * 1024:
-                self.bugtool_filename = self.bugtool_filename_callback()
-                self.bytes_written = 0
-
-            return SpanExportResult.SUCCESS
-
-    def create_tracer_from_config(path):
-        """Create a tracer from a config file."""
-
-        otelvars = "opentelemetry-python.readthedocs.io/en/latest/sdk/environment_variables.html"
-        config = read_config(path, header=otelvars)
         config_otel_resource_attrs = config.get("otel_resource_attributes", "")
 
         if config_otel_resource_attrs:
@@ -248,10 +1040,7 @@ def _init_tracing(configs: List[str], config_dir: str):
         # Add a span processor for each endpoint defined in the config
         if trace_log_dir:
             processor_file_zipkin = BatchSpanProcessor(
-                FileZipkinExporter(
-                    filename_callback=bugtool_filenamer,
-                    trace_log_dir=trace_log_dir
-                )
+                file_exporter(filename_callback=bugtool_filenamer)
             )
             provider.add_span_processor(processor_file_zipkin)
         for zipkin_endpoint in otel_exporter_zipkin_endpoints:
@@ -259,12 +1048,88 @@ def _init_tracing(configs: List[str], config_dir: str):
                 ZipkinExporter(endpoint=zipkin_endpoint)
             )
             provider.add_span_processor(processor_zipkin)
+        unix_socket = config.get("xs_exporter_unix_socket")
+        if unix_socket:
+            provider.add_span_processor(
+                BatchSpanProcessor(unix_socket_exporter(unix_socket))
+            )
 
         trace.set_tracer_provider(provider)
         return trace.get_tracer(__name__)
 
-    tracers = list(map(create_tracer_from_config, configs))
-    debug("tracers=%s", tracers)
+    def create_tracers():
+        """Import OpenTelemetry and create the tracers of the configs"""
+        import_ts_start = current_otel_time()
+
+        from opentelemetry import trace
+        from opentelemetry.exporter.zipkin.json import ZipkinExporter
+        from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+        import_ts[:] = [import_ts_start, current_otel_time()]
+
+        class FileZipkinExporter(ZipkinExporter):
+            """Class to export spans to compressed files in Zipkin format."""
+
+            def __init__(self, *args, **kwargs):
+                self.writer = SegmentWriter.from_config(kwargs.pop("filename_callback"), config_dict)
+                super().__init__(*args, **kwargs)
+
+            def export(self, spans: Sequence[trace.Span]) -> SpanExportResult:
+                """Queue the given spans for writing to the file endpoint."""
+
+                datastr = str(self.encoder.serialize(spans, self.local_node))
+                debug("data.len=%s", len(datastr))
+                if not self.writer.write(datastr):  # ndjson
+                    debug("trace file queue full, %d batches dropped", self.writer.dropped)
+                    return SpanExportResult.FAILURE
+                return SpanExportResult.SUCCESS
+
+            def shutdown(self) -> None:
+                self.writer.close()
+                super().shutdown()
+
+        class UnixSocketExporter(SpanExporter):
+            """Class to send spans to a collector on a Unix socket."""
+
+            def __init__(self, path):
+                self.sender = SpanSender.from_config(path, config_dict)
+
+            def export(self, spans: Sequence[trace.Span]) -> SpanExportResult:
+                """Queue the given spans for sending to the collector."""
+
+                service_name = spans[0].resource.attributes.get("service.name", "") if spans else ""
+                if not self.sender.send(encode_spans(spans, service_name)):
+                    debug("span sender queue full, %d batches dropped", self.sender.dropped)
+                    return SpanExportResult.FAILURE
+                return SpanExportResult.SUCCESS
+
+            def shutdown(self) -> None:
+                self.sender.close()
+
+        created_tracers = [
+            create_tracer_from_config(config, FileZipkinExporter, UnixSocketExporter)
+            for config in observer_config_dicts
+        ]
+        debug("tracers=%s", created_tracers)
+        return created_tracers
+
+    def get_tracers():
+        """Return the tracers, creating them on the first call"""
+        nonlocal tracers
+        if tracers is None:
+            with tracers_lock:
+                if tracers is None:
+                    try:
+                        tracers = create_tracers()
+                    except Exception as err:
+                        syslog.error("Cannot create the tracers, not tracing: %s", err)
+                        tracers = []
+        return tracers
+
+    sampler = Sampler.from_config(config_dict)
+    instrument_filter = InstrumentFilter.from_config(config_dict)
+    argument_capture = ArgumentCapture.from_config(config_dict)
+    setup_spans = _config_bool(config_dict.get("setup_spans", "false"))
 
     def span_of_tracers(wrapped=None, span_name_prefix="", parent_context=None):
         """
@@ -291,59 +1156,99 @@ def _init_tracing(configs: List[str], config_dir: str):
         if wrapped is None:  # handle decorators with parameters
             return functools.partial(span_of_tracers, span_name_prefix=span_name_prefix, parent_context=parent_context)
 
-        @wrapt.decorator
-        def instrument_function(wrapped, _, args, kwargs):
-            """Decorator that creates a trace around a function."""
-            if not tracers:
-                return wrapped(*args, **kwargs)
-
+        def span_name_of(wrapped):
             module_name = wrapped.__module__ if hasattr(wrapped, "__module__") else ""
             qual_name = wrapped.__qualname__ if hasattr(wrapped, "__qualname__") else ""
 
             if not module_name and not qual_name:
-                span_name = str(wrapped)
-            else:
-                prefix = f"{span_name_prefix}:" if span_name_prefix else ""
-                span_name = f"{prefix}{module_name}:{qual_name}"
+                return str(wrapped)
+            prefix = f"{span_name_prefix}:" if span_name_prefix else ""
+            return f"{prefix}{module_name}:{qual_name}"
+
+        def call_unsampled(wrapped, args, kwargs):
+            """Call wrapped without a span, unless it raises an exception"""
+            start_time = current_otel_time()
+            try:
+                return wrapped(*args, **kwargs)
+            except Exception as exc:
+                # Record the exception once, where it is raised
+                if sampler.sample_errors and not getattr(exc, "_observer_span", False):
+                    from opentelemetry.trace import Status, StatusCode
+
+                    error_span = tracers[0].start_span(
+                        span_name_of(wrapped), start_time=start_time
+                    )
+                    error_span.record_exception(exc)
+                    error_span.set_status(Status(StatusCode.ERROR, str(exc)))
+                    error_span.end()
+                    try:
+                        exc._observer_span = True
+                    except AttributeError:
+                        pass
+                raise
+            finally:
+                sampler.exit()
 
+        @wrapt.decorator
+        def instrument_function(wrapped, _, args, kwargs):
+            """Decorator that creates a trace around a function."""
+            if profile is not None:
+                return profile.call(wrapped, args, kwargs)
+            if not get_tracers():
+                return wrapped(*args, **kwargs)
+            if sampler is None:
+                return call_traced(wrapped, args, kwargs)
+            if not sampler.enter():
+                return call_unsampled(wrapped, args, kwargs)
+            try:
+                return call_traced(wrapped, args, kwargs)
+            finally:
+                sampler.exit()
+
+        def call_traced(wrapped, args, kwargs):
+            """Call wrapped in a span of the first tracer"""
             tracer = tracers[0]
-            with tracer.start_as_current_span(span_name) as aspan:
-                if inspect.isclass(wrapped):
+            with tracer.start_as_current_span(span_name_of(wrapped)) as aspan:
+                if not aspan.is_recording():
+                    pass
+                elif inspect.isclass(wrapped):
                     # class or classmethod
-                    aspan.set_attribute("xs.span.args.str", str(args))
-                    aspan.set_attribute("xs.span.kwargs.str", str(kwargs))
+                    aspan.set_attribute("xs.span.args.str", argument_capture.text(args))
+                    aspan.set_attribute("xs.span.kwargs.str", argument_capture.text(kwargs))
                 elif isinstance(wrapped, wrapt.PartialCallableObjectProxy):
                     pass
                 elif isinstance(wrapped, (types.FunctionType, types.MethodType)):
                     # function, staticmethod or instancemethod
-                    bound_args = inspect.signature(wrapped).bind(*args, **kwargs)
-                    bound_args.apply_defaults()
-                    for k, v in bound_args.arguments.items():
-                        aspan.set_attribute(f"xs.span.arg.{k}", str(v))
+                    aspan.set_attributes(argument_capture.arguments(wrapped, args, kwargs))
 
                 # must be inside "aspan" to produce nested trace
                 result = wrapped(*args, **kwargs)
             return result
 
+        def setup_span(name, **kwargs):
+            """Return a span to track the instrumentation, if enabled"""
+            if profile is not None or not setup_spans:
+                return _NoSpan()
+            return get_tracers()[0].start_as_current_span(name, **kwargs)
+
         def autoinstrument_class(aclass):
             """Auto-instrument a class."""
 
-            t = tracers[0]
             class_name = f"{aclass.__module__}:{aclass.__qualname__}"
 
-            with t.start_as_current_span(f"auto_instrumentation.add_class: {class_name}"):
+            with setup_span(f"auto_instrumentation.add_class: {class_name}"):
                 for method_name, method in aclass.__dict__.items():
                     if not callable(getattr(aclass, method_name)):
                         continue
 
-                    with t.start_as_current_span(
-                        f"class.instrument:{class_name}.{method_name}"
-                    ):
+                    with setup_span(f"class.instrument:{class_name}.{method_name}"):
                         # Avoid RecursionError:
                         # 'maximum recursion depth exceeded in comparison'
                         # in the XenAPI module (triggered by XMLRPC calls in it):
                         if method_name in ["__getattr__", "__call__", "__init__"]:
                             continue
+                        if not instrument_filter(f"{class_name}.{method_name}"):
+                            continue
                         try:
                             setattr(aclass, method_name, instrument_function(method))
                         except Exception:
@@ -355,7 +1260,7 @@ def _init_tracing(configs: List[str], config_dir: str):
         def autoinstrument_module(amodule):
             """Autoinstrument the classes and functions in a module."""
 
-            with tracers[0].start_as_current_span(f"auto_instrumentation.add_module: {amodule}", context=parent_context):
+            with setup_span(f"auto_instrumentation.add_module: {amodule}", context=parent_context):
                 # Instrument the methods of the classes in the module
                 for _, aclass in inspect.getmembers(amodule, inspect.isclass):
                     try:
@@ -365,7 +1270,8 @@ def _init_tracing(configs: List[str], config_dir: str):
 
                 # Instrument the module-level functions of the module
                 for fname, afunction in inspect.getmembers(amodule, inspect.isfunction):
-                    setattr(amodule, fname, instrument_function(afunction))
+                    if instrument_filter(f"{afunction.__module__}:{afunction.__qualname__}"):
+                        setattr(amodule, fname, instrument_function(afunction))
 
         if inspect.ismodule(wrapped):
             autoinstrument_module(wrapped)
@@ -382,11 +1288,19 @@ def _init_tracing(configs: List[str], config_dir: str):
         for m in module_names:
             _patch_module(m, parent_context=parent_context)
 
+    if profile is not None:
+        profile.start()
+    if profile is not None or not setup_spans:
+        _patch_modules(None)
+        return span_of_tracers, _patch_module
+
+    from opentelemetry import trace
+
     # Create spans to track observer.py's setup duration
-    t = tracers[0]
+    t = get_tracers()[0]
     with t.start_as_current_span("observer.py:init_tracing", start_time=observer_ts_start):
-        import_span = t.start_span("observer.py:imports", start_time=import_ts_start)
-        import_span.end(end_time=import_ts_end)
+        import_span = t.start_span("observer.py:imports", start_time=import_ts[0])
+        import_span.end(end_time=import_ts[1])
 
         # Set a parent span in the add_module spans' context so that they are kept together
         with t.start_span("auto_instrumentation") as aspan:
@@ -409,7 +1323,10 @@ try:
     # If tracing is now operational, explicitly set "OTEL_SDK_DISABLED" to "false".
     # In our case, different from the standard, we want the tracing disabled by
     # default, so if the env variable is not set the noop implementation is used.
-    os.environ["OTEL_SDK_DISABLED"] = "false"
+    # Without configs or in profile mode, there is no tracing: Leave it disabled
+    # so that XenAPI does not import OpenTelemetry for nothing.
+    if span is not _span_noop and profile is None:
+        os.environ["OTEL_SDK_DISABLED"] = "false"
 except Exception as exc:
     syslog.error("Exception while setting up tracing, running script untraced: %s", exc)
     span, patch_module = _span_noop, _patch_module_noop
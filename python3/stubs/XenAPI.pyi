@@ -3,6 +3,7 @@ Stub for the XenAPI module: https://xapi-project.github.io/xen-api/overview.html
 """
 
 
+import collections.abc
 import http.client as httplib
 import xmlrpc.client as xmlrpclib
 from _typeshed import Incomplete as Incomplete
@@ -10,6 +11,8 @@ from _typeshed import Incomplete as Incomplete
 translation: Incomplete
 API_VERSION_1_1: str
 API_VERSION_1_2: str
+SESSION_BROKER_SOCKET: str
+SESSION_BROKER_TIMEOUT: float
 
 
 class Failure(Exception):
@@ -30,6 +33,31 @@ class UDSTransport(xmlrpclib.Transport):
     # def make_connection(self, host) -> None: ...
 
 
+class CallStats:
+    LATENCY_BUCKETS: tuple[float, ...]
+
+    def __init__(self, calls_file: Incomplete | None = ...) -> None: ...
+    def record(
+        self,
+        method: str,
+        seconds: float,
+        request_bytes: int,
+        response_bytes: int,
+        retries: int,
+        failed: bool = ...,
+    ) -> None: ...
+    def summary(self) -> dict[str, dict[str, Incomplete]]: ...
+    def dump(self, out) -> None: ...
+
+
+class Record(collections.abc.Mapping[str, Incomplete]):
+    def __init__(self, fields: dict[str, int], values: tuple) -> None: ...
+    def __getitem__(self, name: str) -> Incomplete: ...
+    def __getattr__(self, name: str) -> Incomplete: ...
+    def __iter__(self) -> Incomplete: ...
+    def __len__(self) -> int: ...
+
+
 def notimplemented(name, *args, **kwargs) -> None: ...
 
 
@@ -78,6 +106,9 @@ class Session(xmlrpclib.ServerProxy):
     last_login_params: Incomplete
     API_version: Incomplete
     xenapi: _Dispatcher
+    xenapi_stream: _Dispatcher
+    xenapi_compact: _Dispatcher
+    call_stats: CallStats | None
 
     def __init__(
         self,
@@ -87,10 +118,14 @@ class Session(xmlrpclib.ServerProxy):
         verbose: int = ...,
         allow_none: int = ...,
         ignore_ssl: bool = ...,
+        session_broker: str | None = ...,
     ) -> None: ...
     def xenapi_request(self, methodname, params) -> None: ...
+    def enable_call_stats(self, call_stats: CallStats | None = ...) -> CallStats: ...
+    def xenapi_request_stream(self, methodname, params) -> Incomplete: ...
+    def xenapi_request_compact(self, methodname, params) -> Incomplete: ...
 
     # def __getattr__(self, name) -> None: ...
 
 
-def xapi_local() -> Session: ...
+def xapi_local(session_broker: str | None = ...) -> Session: ...
@@ -0,0 +1,67 @@
+"""helpers for benchmarking the imports of modules with python -X importtime"""
+import os
+import subprocess
+import sys
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+# The (depth, module name, cumulative import time in us) of an import
+Import = Tuple[int, str, int]
+
+
+def run_importtime(
+    *args: str,
+    pythonpath: Iterable[str] = (),
+    env: Optional[Mapping[str, Optional[str]]] = None,
+    cwd: Optional[str] = None,
+) -> List[Import]:
+    """Run python -X importtime with args and return its imports.
+
+    :param args: The arguments of python, e.g. "-c", "import XenAPI"
+    :param pythonpath: Directories to prepend to PYTHONPATH
+    :param env: Environment variables to set, or to remove if None
+    :returns: list of (depth, module name, cumulative import time in us) of
+              the imported modules (including the ones imported during startup)
+    """
+    environ = dict(os.environ)
+    for name, value in (env or {}).items():
+        if value is None:
+            environ.pop(name, None)
+        else:
+            environ[name] = value
+    environ["PYTHONPATH"] = os.pathsep.join(
+        list(pythonpath) + [p for p in [environ.get("PYTHONPATH")] if p]
+    )
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        env=environ,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stderr
+    imports: List[Import] = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((depth, module.strip(), int(cumulative)))
+    return imports
+
+
+def import_times(
+    code: str,
+    pythonpath: Iterable[str] = (),
+    env: Optional[Mapping[str, Optional[str]]] = None,
+) -> Dict[str, int]:
+    """Run code in a new python -X importtime and return a dict of the
+    imported module names to their cumulative import time in us"""
+    imports = run_importtime("-c", code, pythonpath=pythonpath, env=env)
+    return {module: cumulative for _, module, cumulative in imports}
+
+
+def total_import_time(imports: Iterable[Import]) -> int:
+    """Return the total import time in us of the imports of run_importtime()"""
+    return sum(cumulative for depth, _, cumulative in imports if depth == 0)
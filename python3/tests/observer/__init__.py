@@ -29,8 +29,11 @@ def call_observer(*args: str) -> Dict[str, Any]:
     - sets os.environ["OBSERVER_DEBUG"] = "True" to enable debug logging
       to let the tests check the debug messages for checking the reading
       of the configuration files and setting up tracing.
+    - sets os.environ["OBSERVER_CONFIG_CACHE"] = "" to not write the cache of
+      the parsed configuration files to /run.
     """
 
     os.environ["XAPI_TEST"] = "True"  # Enable printing debug messages in observer.py
+    os.environ["OBSERVER_CONFIG_CACHE"] = ""  # Do not cache the configs in /run
     sys.argv = [OBSERVER_PY, *args]
     return runpy.run_path(OBSERVER_PY, run_name="__main__")
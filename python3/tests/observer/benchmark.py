@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Benchmark the overhead of python3/packages/observer.py
+
+Runs synthetic modules through span_of_tracers and _patch_module in each
+configuration of the observer, each in a new process:
+
+- no_configs: no *observer.conf file, observer.py is a noop
+- file:       an observer.conf exporting to compressed trace files
+- zipkin:     an observer.conf exporting to a Zipkin HTTP endpoint, served by
+              a dummy server in this process that discards the spans
+- unix_socket: an observer.conf sending the spans to a Unix socket, served by
+              the collector stand-in of span_collector.py in this process
+
+and reports for each:
+
+- ns_per_call:       the time of a call of an instrumented function, minus the
+                     time of the call of the same function uninstrumented
+- import_overhead_us: the time added to the import of a module of 50 functions
+                     and a class of 50 methods by instrumenting it, as the
+                     module_names of all.conf select the modules to instrument
+- bytes_per_span:    the memory allocated (tracemalloc) per traced call until
+                     its span is exported
+
+Usage (from the root of the repository):
+
+    python3 -m python3.tests.observer.benchmark [--calls N] [--json]
+                                                [--all-conf key=value ...]
+
+--all-conf adds lines to all.conf, to measure e.g. sample_ratio=0.01.
+"""
+
+import argparse
+import http.server
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .span_collector import SpanCollector
+
+CONFIGURATIONS = ("no_configs", "file", "zipkin", "unix_socket")
+IMPORTS = 5  # The number of modules imported for the import overhead
+# The synthetic modules instrumented by the observer through all.conf
+PATCHED_MODULES = [f"synthetic_patched_{i}" for i in range(IMPORTS)]
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+SYNTHETIC_MODULE = """
+class Synthetic:
+{methods}
+
+{functions}
+"""
+
+
+def write_synthetic_module(directory: str, name: str, count: int = 50) -> None:
+    """Write a module with count functions and a class of count methods"""
+    methods = "\n".join(
+        f"    def method_{i}(self, arg, other=None):\n        return arg" for i in range(count)
+    )
+    functions = "\n".join(
+        f"def function_{i}(arg, other=None):\n    return arg" for i in range(count)
+    )
+    with open(f"{directory}/{name}.py", "w", encoding="utf-8") as module:
+        module.write(SYNTHETIC_MODULE.format(methods=methods, functions=functions))
+
+
+def ns_per_call(function: Callable[[int], Any], calls: int) -> float:
+    """Return the average time of function(arg) in ns"""
+    start = time.perf_counter_ns()
+    for i in range(calls):
+        function(i)
+    return (time.perf_counter_ns() - start) / calls
+
+
+def import_us(name: str) -> float:
+    """Return the time of the import of a new module in us"""
+    start = time.perf_counter_ns()
+    __import__(name)
+    return (time.perf_counter_ns() - start) / 1000
+
+
+def measure(calls: int) -> Dict[str, float]:
+    """Measure the observer configured by OBSERVER_CONFIG_DIR in this process"""
+    # Imported untyped: observer.py is excluded from type checking
+    observer: Any = importlib.import_module("python3.packages.observer")
+
+    module_dir = tempfile.mkdtemp()
+    for i in range(IMPORTS):
+        write_synthetic_module(module_dir, f"synthetic_plain_{i}")
+        write_synthetic_module(module_dir, PATCHED_MODULES[i])
+    sys.path.insert(0, module_dir)
+
+    # Import overhead: the same modules, not in module_names and in them,
+    # the fastest of each to exclude the first imports warming up the caches
+    plain_us = min(import_us(f"synthetic_plain_{i}") for i in range(IMPORTS))
+    patched_us = min(import_us(name) for name in PATCHED_MODULES)
+
+    plain: Any = sys.modules["synthetic_plain_0"]
+    instrumented: Callable[[int], Any] = observer.span(plain.function_1)
+    instrumented(0)  # The first span creates the tracers
+    plain_ns = ns_per_call(plain.function_0, calls)
+    instrumented_ns = ns_per_call(instrumented, calls)
+
+    # Memory: the spans are kept until the batch span processors export them
+    spans = min(calls, 1000)
+    traced: Callable[[int], Any] = observer.span(plain.function_2)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(spans):
+        traced(i)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return {
+        "ns_per_call": round(instrumented_ns - plain_ns, 1),
+        "import_overhead_us": round(patched_us - plain_us, 1),
+        "bytes_per_span": round(allocated / spans, 1),
+    }
+
+
+class DiscardingZipkinHandler(http.server.BaseHTTPRequestHandler):
+    """A Zipkin endpoint that accepts and discards the spans"""
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Read and discard the posted spans"""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+
+def run_configuration(
+    configuration: str,
+    calls: int,
+    all_conf: Iterable[str] = (),
+    zipkin_url: Optional[str] = None,
+    unix_socket: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Measure the configuration in a new process and return its results"""
+    with tempfile.TemporaryDirectory() as config_dir:
+        with open(f"{config_dir}/all.conf", "w", encoding="utf-8") as conf:
+            module_names = "module_names=" + ",".join(PATCHED_MODULES)
+            conf.write("\n".join([module_names, *all_conf]) + "\n")
+        if configuration != "no_configs":
+            with open(f"{config_dir}/observer.conf", "w", encoding="utf-8") as conf:
+                if configuration == "file":
+                    conf.write(f"XS_EXPORTER_BUGTOOL_ENDPOINT='{config_dir}/dt'\n")
+                elif configuration == "zipkin":
+                    conf.write(f"XS_EXPORTER_ZIPKIN_ENDPOINTS='{zipkin_url}'\n")
+                else:
+                    conf.write(f"XS_EXPORTER_UNIX_SOCKET='{unix_socket}'\n")
+        env = dict(os.environ, OBSERVER_CONFIG_DIR=config_dir, OBSERVER_CONFIG_CACHE="")
+        env.pop("XAPI_TEST", None)
+        output = subprocess.run(
+            [sys.executable, "-m", "python3.tests.observer.benchmark", "--measure", str(calls)],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.PIPE,
+            check=True,
+            universal_newlines=True,
+        ).stdout
+    results: Dict[str, Any] = json.loads(output.splitlines()[-1])
+    return dict(results, configuration=configuration)
+
+
+def run(
+    calls: int = 100000,
+    all_conf: Iterable[str] = (),
+    configurations: Iterable[str] = CONFIGURATIONS,
+) -> List[Dict[str, Any]]:
+    """Run the benchmark of the configurations, return a list of results"""
+    server = http.server.HTTPServer(("127.0.0.1", 0), DiscardingZipkinHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    zipkin_url = f"http://127.0.0.1:{server.server_address[1]}/api/v2/spans"
+    with tempfile.TemporaryDirectory() as socket_dir:
+        collector = SpanCollector(f"{socket_dir}/collector.sock").start()
+        try:
+            return [
+                run_configuration(configuration, calls, all_conf, zipkin_url, collector.path)
+                for configuration in configurations
+            ]
+        finally:
+            collector.close()
+            server.shutdown()
+            server.server_close()
+
+
+def main() -> int:
+    """Run the benchmark and print the results"""
+    parser = argparse.ArgumentParser(description=(__doc__ or "").strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=100000, help="calls per measurement")
+    parser.add_argument("--json", action="store_true", help="print one JSON line per result")
+    parser.add_argument(
+        "--all-conf", action="append", default=[], metavar="KEY=VALUE",
+        help="a line to add to all.conf",
+    )
+    parser.add_argument("--measure", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure)))
+        return 0
+
+    results = run(args.calls, args.all_conf)
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{result['configuration']:<12} {result['ns_per_call']:>10} ns/call"
+                f" {result['import_overhead_us']:>10} us/import"
+                f" {result['bytes_per_span']:>10} bytes/span"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
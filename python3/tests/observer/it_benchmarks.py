@@ -0,0 +1,28 @@
+"""
+Smoke test of the observer benchmark suite in tests/observer/benchmark.py
+
+Runs the benchmark with a few calls in each configuration to check that it
+works. For the numbers, run it with the default number of calls:
+
+    python3 -m python3.tests.observer.benchmark
+"""
+
+from .benchmark import CONFIGURATIONS, run
+
+
+def it_measures_each_configuration():
+    """
+    Given the benchmark is run with each configuration of the observer,
+    it reports the overhead per call, per import and per span for each.
+    """
+    results = {result["configuration"]: result for result in run(calls=200)}
+
+    assert sorted(results) == sorted(CONFIGURATIONS)
+    for result in results.values():
+        assert isinstance(result["ns_per_call"], float)
+        assert isinstance(result["import_overhead_us"], float)
+        assert isinstance(result["bytes_per_span"], float)
+    # Creating spans costs more than not tracing
+    assert results["file"]["ns_per_call"] > results["no_configs"]["ns_per_call"]
+    assert results["zipkin"]["ns_per_call"] > results["no_configs"]["ns_per_call"]
+    assert results["unix_socket"]["ns_per_call"] > results["no_configs"]["ns_per_call"]
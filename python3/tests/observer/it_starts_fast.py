@@ -0,0 +1,66 @@
+"""
+Benchmark the startup of scripts run by python3/packages/observer.py
+
+The tests run python -X importtime on traced_script.py:
+
+1.  untraced: directly, as a baseline.
+2.  without configs: through observer.py with no *observer.conf file,
+    which must import nothing to trace.
+3.  traced: through observer.py with the observer.conf of this directory.
+
+They print the import time of each case (shown by pytest -s) and check that
+the untraced cases do not import the tracing machinery.
+"""
+
+import tempfile
+from typing import Optional, Set
+
+from ..importtime import run_importtime, total_import_time
+from . import OBSERVER_PY, TRACED_SCRIPT, testdir
+
+PYTHONPATH = [testdir + "/../..", testdir + "/../../examples/XenAPI"]
+TRACING_MODULES = ("opentelemetry", "wrapt", "configparser")
+
+
+def run_traced_script(*observer_py: str, **env: Optional[str]) -> Set[str]:
+    """Run traced_script.py, return its imports and print their total time"""
+    imports = run_importtime(
+        *observer_py,
+        TRACED_SCRIPT,
+        "0",
+        pythonpath=PYTHONPATH,
+        env={"OTEL_SDK_DISABLED": None, "XAPI_TEST": None, **env},
+    )
+    print(f"{' '.join(observer_py) or 'untraced'}: {total_import_time(imports)} us")
+    return {module for _, module, _ in imports}
+
+
+def it_imports_no_tracing_modules_without_configs():
+    """
+    Given that observer.py is started without a configuration file,
+    it imports none of the tracing modules on top of the traced script.
+    """
+    untraced = run_traced_script()
+    without_configs = run_traced_script(
+        OBSERVER_PY, OBSERVER_CONFIG_DIR="nonexisting_config_directory"
+    )
+
+    added = without_configs - untraced
+    assert not [module for module in added if module.startswith(TRACING_MODULES)]
+
+
+def it_reads_the_configs_from_the_cache():
+    """
+    Given that observer.py is started with a configuration file a second time,
+    it takes the parsed configuration from its cache instead of parsing it.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {
+            "OBSERVER_CONFIG_DIR": testdir,
+            "OBSERVER_CONFIG_CACHE": f"{cache_dir}/config.cache",
+        }
+        first_run = run_traced_script(OBSERVER_PY, **env)
+        second_run = run_traced_script(OBSERVER_PY, **env)
+
+    assert "configparser" in first_run
+    assert "configparser" not in second_run
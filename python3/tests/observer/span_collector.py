@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Collector stand-in for the spans which observer.py sends to a Unix socket
+
+Listens on the Unix socket configured as xs_exporter_unix_socket in an
+*observer.conf, decodes the batches of spans (see observer.encode_spans)
+and keeps them, printing them as ndjson when run as a script:
+
+    python3 -m python3.tests.observer.span_collector --socket PATH
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from python3.packages.observer import BATCH_HEADER, decode_spans
+
+# A decoded span, see observer.decode_spans()
+Span = Dict[str, Any]
+
+
+def _recv_exactly(connection: socket.socket, size: int) -> bytes:
+    """Return size bytes received on the connection, or b"" at its end"""
+    data = b""
+    while len(data) < size:
+        received = connection.recv(size - len(data))
+        if not received:
+            return b""
+        data += received
+    return data
+
+
+class SpanCollector:
+    """Receives the batches of spans sent to a Unix socket"""
+
+    def __init__(self, path: str, on_spans: Optional[Callable[[List[Span]], None]] = None):
+        self.path = path
+        self.spans: List[Span] = []
+        self.batches = 0
+        self._on_spans = on_spans
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(16)
+        self._thread: Optional[threading.Thread] = None
+
+    def serve_connection(self, connection: socket.socket) -> None:
+        """Receive the batches sent on the connection until it is closed"""
+        with connection:
+            while True:
+                header = _recv_exactly(connection, BATCH_HEADER.size)
+                if not header:
+                    return
+                _, size, _ = BATCH_HEADER.unpack(header)
+                spans = decode_spans(header + _recv_exactly(connection, size))
+                with self._lock:
+                    self.batches += 1
+                    self.spans.extend(spans)
+                    if self._on_spans:
+                        self._on_spans(spans)
+
+    def serve_forever(self) -> None:
+        """Accept connections until the collector is closed"""
+        while True:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self.serve_connection, args=(connection,), daemon=True
+            ).start()
+
+    def start(self) -> "SpanCollector":
+        """Serve the connections from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Stop accepting connections and remove the socket"""
+        self._listener.shutdown(socket.SHUT_RDWR)
+        self._listener.close()
+        if self._thread:
+            self._thread.join()
+        os.unlink(self.path)
+
+    def __enter__(self) -> "SpanCollector":
+        return self.start()
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+
+def main() -> int:
+    """Print the received spans as ndjson until interrupted"""
+    parser = argparse.ArgumentParser(description=(__doc__ or "").strip().splitlines()[0])
+    parser.add_argument("--socket", required=True, help="The Unix socket to listen on")
+    args = parser.parse_args()
+
+    def print_spans(spans: List[Span]) -> None:
+        for span in spans:
+            print(json.dumps(span), flush=True)
+
+    collector = SpanCollector(args.socket, on_spans=print_spans)
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
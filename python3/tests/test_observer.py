@@ -1,7 +1,12 @@
 """Test python3/packages/observer.py"""
 
+import json
 import os
+import socket
 import sys
+import tempfile
+import threading
+import types
 import unittest
 
 from unittest.mock import MagicMock, mock_open, patch
@@ -153,3 +158,564 @@ class TestObserver(unittest.TestCase):
         simple_method_with_args = span(self.simple_method_with_args)
 
         self.assertEqual(simple_method_with_args(5), 8)
+
+    def test_sampled_out_calls_create_no_span(self):
+        with patch(OBSERVER_OPEN, mock_open(read_data="sample_ratio=0")):
+            span, _ = observer._init_tracing([TEST_OBSERVER_CONF], ".")
+        tracer = sys.modules["opentelemetry"].trace.get_tracer.return_value
+        tracer.reset_mock()
+
+        simple_method_with_args = span(self.simple_method_with_args)
+
+        self.assertEqual(simple_method_with_args(5), 8)
+        tracer.start_as_current_span.assert_not_called()
+        tracer.start_span.assert_not_called()
+
+    def test_errors_of_sampled_out_calls_are_traced_once(self):
+        with patch(OBSERVER_OPEN, mock_open(read_data="sample_ratio=0")):
+            span, _ = observer._init_tracing([TEST_OBSERVER_CONF], ".")
+        tracer = sys.modules["opentelemetry"].trace.get_tracer.return_value
+        tracer.reset_mock()
+
+        @span
+        def inner():
+            raise ValueError("inner")
+
+        @span
+        def outer():
+            return inner()
+
+        with self.assertRaises(ValueError):
+            outer()
+        tracer.start_as_current_span.assert_not_called()
+        tracer.start_span.assert_called_once()
+        self.assertTrue(tracer.start_span.call_args[0][0].endswith("inner"))
+
+    @patch.object(observer.Profile, "start")
+    def test_profile_mode_does_not_use_opentelemetry(self, start):
+        with patch(OBSERVER_OPEN, mock_open(read_data="mode=profile")), patch.dict(
+            sys.modules, {"opentelemetry": None}
+        ):
+            # Without *observer.conf, with the all.conf in tests/observer:
+            span, _ = observer._init_tracing([], os.path.dirname(__file__) + "/observer")
+
+        try:
+            simple_method_with_args = span(self.simple_method_with_args)
+
+            self.assertEqual(simple_method_with_args(5), 8)
+            start.assert_called_once()
+            [summary] = observer.profile.summary()
+            self.assertTrue(summary["function"].endswith("simple_method_with_args"))
+            self.assertEqual(summary["count"], 1)
+        finally:
+            observer.profile = None
+
+    def test_patterns_select_the_instrumented_functions(self):
+        config = "instrument_include=*:InstrumentMe.*\ninstrument_exclude=*.return_int"
+        with patch(OBSERVER_OPEN, mock_open(read_data=config)):
+            span, _ = observer._init_tracing([TEST_OBSERVER_CONF], ".")
+        module = types.ModuleType("instrumented")
+        exec(INSTRUMENTED_MODULE, module.__dict__)  # pylint: disable=exec-used
+
+        span(module)
+
+        self.assertTrue(hasattr(module.InstrumentMe.__dict__["print"], "__wrapped__"))
+        self.assertFalse(hasattr(module.InstrumentMe.__dict__["return_int"], "__wrapped__"))
+        self.assertFalse(hasattr(module.helper, "__wrapped__"))
+
+
+INSTRUMENTED_MODULE = """
+class InstrumentMe:
+    def print(self):
+        pass
+
+    def return_int(self):
+        return 1
+
+def helper():
+    pass
+"""
+
+
+class TestConfigSnapshot(unittest.TestCase):
+    """Test the cache of the parsed config files"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.config = f"{self.tmpdir.name}/all.conf"
+        self.env = patch.dict(
+            os.environ, {"OBSERVER_CONFIG_CACHE": f"{self.tmpdir.name}/cache/config"}
+        )
+        self.env.start()
+        observer._config_snapshot = None
+
+    def tearDown(self):
+        self.env.stop()
+        observer._config_snapshot = None
+        self.tmpdir.cleanup()
+
+    def write_config(self, content):
+        with open(self.config, "w", encoding="utf-8") as config_file:
+            config_file.write(content)
+
+    def test_parsed_config_is_reused_by_the_next_run(self):
+        self.write_config("module_names=SR")
+        self.assertEqual(observer.read_config(self.config, "default"), {"module_names": "SR"})
+        observer._config_snapshot = None  # as in a new process
+
+        with patch.dict(sys.modules, {"configparser": None}):
+            config = observer.read_config(self.config, "default")
+
+        self.assertEqual(config, {"module_names": "SR"})
+
+    def test_changed_config_is_parsed_again(self):
+        self.write_config("module_names=SR")
+        observer.read_config(self.config, "default")
+
+        self.write_config("module_names=LVHDSR")
+
+        self.assertEqual(
+            observer.read_config(self.config, "default"), {"module_names": "LVHDSR"}
+        )
+
+
+class TestInstrumentFilter(unittest.TestCase):
+    """Test the selection of the functions to instrument by patterns"""
+
+    def test_everything_is_instrumented_by_default(self):
+        self.assertTrue(observer.InstrumentFilter.from_config({})("util:pread"))
+
+    def test_globs_and_regular_expressions(self):
+        instrument = observer.InstrumentFilter(
+            include=["LVHDSR:*", "re:^SR:SR[.](scan|attach)$"],
+            exclude=["*._*", "util:*"],
+        )
+
+        self.assertTrue(instrument("LVHDSR:LVHDSR.scan"))
+        self.assertTrue(instrument("SR:SR.attach"))
+        self.assertFalse(instrument("SR:SR.detach"))
+        self.assertFalse(instrument("LVHDSR:LVHDSR._refresh"))
+        self.assertFalse(instrument("util:pread"))
+
+    def test_config_patterns_are_separated_by_whitespace(self):
+        config = {
+            "instrument_include": "re:^SR:SR[.]s{1,2}.*$  LVHDSR:*\n  util:pread",
+        }
+
+        instrument = observer.InstrumentFilter.from_config(config)
+
+        self.assertTrue(instrument("SR:SR.scan"))
+        self.assertTrue(instrument("LVHDSR:LVHDSR.attach"))
+        self.assertTrue(instrument("util:pread"))
+        self.assertFalse(instrument("SR:SR.attach"))
+
+
+class TestProfile(unittest.TestCase):
+    """Test the aggregation of the calls in profile mode"""
+
+    def test_calls_are_aggregated_per_function(self):
+        clock = iter([0.0, 0.0000005, 1.0, 1.003, 2.0, 12.0])
+        profile = observer.Profile("unused", clock=lambda: next(clock))
+
+        for _ in range(2):
+            profile.call(TestObserver().simple_method, (), {})
+        profile.call(function_with_all_kinds_of_parameters, (1,), {"c": 3})
+
+        first, second = profile.summary()
+        self.assertTrue(first["function"].endswith("function_with_all_kinds_of_parameters"))
+        self.assertEqual(first["max_seconds"], 10.0)
+        self.assertEqual(first["latency_buckets"][-1], 1)
+        self.assertEqual(second["count"], 2)
+        self.assertEqual(second["latency_buckets"][0], 1)
+        self.assertEqual(second["latency_buckets"][12], 1)  # 3000us
+
+    def test_calls_from_threads_are_all_counted(self):
+        profile = observer.Profile("unused")
+
+        def record():
+            for _ in range(10000):
+                profile.record(function_with_all_kinds_of_parameters, 0.001)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        [function] = profile.summary()
+        self.assertEqual(function["count"], 40000)
+        self.assertEqual(sum(function["latency_buckets"]), 40000)
+
+    def test_summary_is_written_as_ndjson(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile = observer.Profile(f"{tmpdir}/profile/script-1.ndjson")
+            profile.record(function_with_all_kinds_of_parameters, 0.5)
+
+            profile.write()
+
+            with open(f"{tmpdir}/profile/script-1.ndjson", encoding="utf-8") as lines:
+                [line] = [json.loads(line) for line in lines]
+        self.assertEqual(line["count"], 1)
+        self.assertEqual(line["total_seconds"], 0.5)
+
+
+class TestSampler(unittest.TestCase):
+    """Test the head-based sampling of observer.Sampler"""
+
+    def test_not_configured(self):
+        self.assertIsNone(observer.Sampler.from_config({}))
+        self.assertIsNone(observer.Sampler.from_config({"sample_ratio": "x"}))
+
+    def test_from_config(self):
+        sampler = observer.Sampler.from_config(
+            {"sample_ratio": "0.5", "max_spans_per_second": "10", "sample_errors": "no"}
+        )
+
+        assert sampler
+        self.assertEqual(sampler.ratio, 0.5)
+        self.assertEqual(sampler.max_spans_per_second, 10)
+        self.assertFalse(sampler.sample_errors)
+
+    def test_nested_calls_follow_the_root(self):
+        decisions = iter([0.9, 0.1])
+        sampler = observer.Sampler(ratio=0.5, rand=lambda: next(decisions))
+
+        self.assertFalse(sampler.enter())
+        self.assertFalse(sampler.enter())
+        sampler.exit()
+        sampler.exit()
+        self.assertTrue(sampler.enter())
+        self.assertTrue(sampler.enter())
+        sampler.exit()
+        sampler.exit()
+
+    def test_max_span_depth(self):
+        sampler = observer.Sampler.from_config({"max_span_depth": "2"})
+
+        assert sampler
+        self.assertEqual([sampler.enter() for _ in range(4)], [True, True, False, False])
+        for _ in range(4):
+            sampler.exit()
+        self.assertTrue(sampler.enter())
+
+    def test_spans_per_second_budget(self):
+        now = [100.0]
+        sampler = observer.Sampler(max_spans_per_second=2, clock=lambda: now[0])
+
+        self.assertTrue(sampler.enter())  # root
+        self.assertTrue(sampler.enter())  # child
+        self.assertFalse(sampler.enter())  # over budget, and its children:
+        self.assertFalse(sampler.enter())
+        sampler.exit()
+        sampler.exit()
+        sampler.exit()
+        sampler.exit()
+        now[0] = 101.0
+        self.assertTrue(sampler.enter())
+        sampler.exit()
+
+
+def function_with_all_kinds_of_parameters(a, b=2, *args, c, d=4, **kwargs):
+    """A function to capture the arguments of"""
+    return a, b, args, c, d, kwargs
+
+
+class TestArgumentCapture(unittest.TestCase):
+    """Test the capture of the arguments of traced calls as span attributes"""
+
+    def test_arguments_are_captured_like_bound_with_defaults(self):
+        capture = observer.ArgumentCapture()
+
+        attributes = capture.arguments(
+            function_with_all_kinds_of_parameters, (1, 2, 3), {"c": 5, "e": 6}
+        )
+
+        self.assertEqual(
+            attributes,
+            {
+                "xs.span.arg.a": "1",
+                "xs.span.arg.b": "2",
+                "xs.span.arg.args": "(3,)",
+                "xs.span.arg.c": "5",
+                "xs.span.arg.d": "4",
+                "xs.span.arg.kwargs": "{'e': 6}",
+            },
+        )
+
+    def test_methods_are_captured_without_self(self):
+        capture = observer.ArgumentCapture()
+
+        attributes = capture.arguments(TestObserver().simple_method_with_args, (1,), {})
+
+        self.assertEqual(attributes, {"xs.span.arg.a": "1", "xs.span.arg.b": "3"})
+
+    def test_parameters_are_cached(self):
+        capture = observer.ArgumentCapture()
+        capture.arguments(function_with_all_kinds_of_parameters, (1,), {"c": 1})
+
+        with patch("inspect.signature") as signature:
+            capture.arguments(function_with_all_kinds_of_parameters, (1,), {"c": 1})
+        signature.assert_not_called()
+
+    def test_arguments_are_truncated(self):
+        capture = observer.ArgumentCapture(max_bytes=16)
+
+        self.assertEqual(capture.text("x" * 100), "x" * 16 + "...")
+        self.assertEqual(capture.text("é" * 10), "é" * 8 + "...")
+        self.assertLessEqual(len(capture.text(list(range(100000)))), 16 * 33 + 8)
+        self.assertEqual(capture.text("short"), "short")
+
+    def test_allow_and_deny_lists(self):
+        config = {"span_args_allow": "a, b", "span_args_deny": "b"}
+        capture = observer.ArgumentCapture.from_config(config)
+
+        with patch.object(capture, "text", side_effect=str) as text:
+            attributes = capture.arguments(
+                function_with_all_kinds_of_parameters, (1, "large"), {"c": 1}
+            )
+
+        self.assertEqual(attributes, {"xs.span.arg.a": "1"})
+        text.assert_called_once_with(1)
+
+
+class TestSegmentWriter(unittest.TestCase):
+    """Test the background writer of the compressed trace files"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.files = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def filename(self):
+        self.files += 1
+        return f"{self.tmpdir.name}/dt/test-{self.files}.ndjson"
+
+    def read_lines(self):
+        lines = []
+        for number in range(1, self.files + 1):
+            with open(f"{self.tmpdir.name}/dt/test-{number}.ndjson") as trace:
+                lines.append(trace.read().splitlines())
+        return lines
+
+    def test_lines_are_written(self):
+        writer = observer.SegmentWriter(self.filename)
+
+        self.assertTrue(writer.write('[{"id": 1}]'))
+        self.assertTrue(writer.write('[{"id": 2}]'))
+        writer.close()
+
+        self.assertEqual(self.read_lines(), [['[{"id": 1}]', '[{"id": 2}]']])
+
+    def test_files_are_rotated_by_size(self):
+        writer = observer.SegmentWriter(self.filename, max_file_bytes=1)
+
+        for line in ("1", "2", "3"):
+            writer.write(line)
+        writer.close()
+
+        self.assertEqual(self.read_lines(), [["1"], ["2"], ["3"]])
+
+    def test_files_are_rotated_by_time(self):
+        # The times of opening file 1, writing 1, writing 2, opening file 2, ...
+        times = iter([0, 10, 70, 80, 90])
+        writer = observer.SegmentWriter(
+            self.filename, max_file_seconds=60, clock=lambda: next(times)
+        )
+
+        for line in ("1", "2", "3"):
+            writer.write(line)
+        writer.close()
+
+        self.assertEqual(self.read_lines(), [["1", "2"], ["3"]])
+
+    def test_oldest_files_are_deleted_above_the_limit(self):
+        os.makedirs(f"{self.tmpdir.name}/dt")
+        # A trace file of another process
+        with open(f"{self.tmpdir.name}/dt/other.ndjson", "w") as other:
+            other.write("other\n")
+        writer = observer.SegmentWriter(self.filename, max_file_bytes=1, max_dir_bytes=4)
+
+        for line in ("1", "2", "3", "4"):
+            writer.write(line)
+        writer.close()
+
+        self.assertEqual(
+            sorted(os.listdir(f"{self.tmpdir.name}/dt")),
+            ["other.ndjson", "test-3.ndjson", "test-4.ndjson"],
+        )
+
+    def test_lines_are_dropped_when_the_queue_is_full(self):
+        writer = observer.SegmentWriter(self.filename, queue_size=2)
+
+        with patch("threading.Thread"):
+            results = [writer.write(line) for line in ("1", "2", "3")]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(writer.dropped, 1)
+
+    def test_close_does_not_block_when_the_queue_is_full(self):
+        writer = observer.SegmentWriter(self.filename, queue_size=1)
+
+        with patch("threading.Thread") as thread:
+            writer.write("1")
+            writer.close(timeout=0)
+
+        thread.return_value.join.assert_not_called()
+
+    def test_zstd_without_zstandard_is_not_compressed(self):
+        with patch.dict(sys.modules, {"zstandard": None}):
+            writer = observer.SegmentWriter(self.filename, compression="zstd")
+
+        self.assertEqual(writer.compression, "none")
+
+    def test_gzip_is_not_supported(self):
+        self.assertEqual(observer.SegmentWriter(self.filename, "gzip").compression, "none")
+
+    def test_from_config(self):
+        config = {"trace_compression": "zstd", "trace_file_max_bytes": "10"}
+
+        with patch.dict(sys.modules, {"zstandard": MagicMock()}):
+            writer = observer.SegmentWriter.from_config(self.filename, config)
+
+        self.assertEqual((writer.compression, writer.max_file_bytes), ("zstd", 10))
+        writer = observer.SegmentWriter.from_config(self.filename, {})
+        self.assertEqual(writer.compression, "none")
+
+
+def fake_span(name, span_id, parent_id=None, events=(), description=None, **attributes):
+    """Return an object with the attributes of an OpenTelemetry ReadableSpan"""
+    return types.SimpleNamespace(
+        name=name,
+        context=types.SimpleNamespace(trace_id=0x1234, span_id=span_id),
+        parent=types.SimpleNamespace(span_id=parent_id) if parent_id else None,
+        start_time=1000,
+        end_time=2000,
+        kind=types.SimpleNamespace(value=0),
+        status=types.SimpleNamespace(
+            status_code=types.SimpleNamespace(value=2), description=description
+        ),
+        attributes=attributes,
+        events=events,
+    )
+
+
+class TestSpanSender(unittest.TestCase):
+    """Test the binary encoding and the sender of spans to a Unix socket"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = f"{self.tmpdir.name}/collector.sock"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_encoded_spans_are_decoded(self):
+        spans = [fake_span("parent", 1), fake_span("child", 2, 1, arg="é", n=3)]
+
+        decoded = observer.decode_spans(observer.encode_spans(spans, "sm"))
+
+        self.assertEqual([span["name"] for span in decoded], ["parent", "child"])
+        self.assertEqual(decoded[1]["service_name"], "sm")
+        self.assertEqual(decoded[1]["trace_id"], f"{0x1234:032x}")
+        self.assertEqual(decoded[1]["span_id"], f"{2:016x}")
+        self.assertEqual(decoded[1]["parent_id"], f"{1:016x}")
+        self.assertIsNone(decoded[0]["parent_id"])
+        self.assertEqual((decoded[1]["start_time"], decoded[1]["end_time"]), (1000, 2000))
+        self.assertEqual(decoded[1]["status_code"], 2)
+        self.assertEqual(decoded[1]["attributes"], {"arg": "é", "n": "3"})
+        self.assertEqual((decoded[1]["status_description"], decoded[1]["events"]), ("", []))
+
+    def test_events_and_status_description_are_encoded(self):
+        exception = types.SimpleNamespace(
+            name="exception",
+            timestamp=1500,
+            attributes={"exception.type": "ValueError", "exception.message": "bad"},
+        )
+        spans = [fake_span("span", 1, events=[exception], description="ValueError: bad")]
+
+        [decoded] = observer.decode_spans(observer.encode_spans(spans, "sm"))
+
+        self.assertEqual(decoded["status_description"], "ValueError: bad")
+        self.assertEqual(
+            decoded["events"],
+            [
+                {
+                    "name": "exception",
+                    "timestamp": 1500,
+                    "attributes": {"exception.type": "ValueError", "exception.message": "bad"},
+                }
+            ],
+        )
+
+    def test_invalid_batches_are_rejected(self):
+        batch = observer.encode_spans([fake_span("span", 1)], "sm")
+
+        with self.assertRaises(ValueError):
+            observer.decode_spans(batch[:-1])
+        with self.assertRaises(ValueError):
+            observer.decode_spans(b"XXXX" + batch[4:])
+
+    def test_batches_are_sent_to_the_collector(self):
+        # pylint: disable-next=import-outside-toplevel
+        from python3.tests.observer.span_collector import SpanCollector
+
+        with SpanCollector(self.path) as collector:
+            sender = observer.SpanSender(self.path)
+            for span_id in (1, 2):
+                sender.send(observer.encode_spans([fake_span("span", span_id)], "sm"))
+            sender.close()
+            # The collector has received the batches when the sender closed
+            # its connection, but may not have decoded them yet
+            for _ in range(100):
+                if collector.batches == 2:
+                    break
+                observer.time.sleep(0.01)
+
+        self.assertEqual([span["span_id"] for span in collector.spans], [f"{1:016x}", f"{2:016x}"])
+        self.assertEqual(sender.dropped, 0)
+
+    def test_batches_are_dropped_without_collector(self):
+        sender = observer.SpanSender(self.path, clock=lambda: 0)
+
+        self.assertTrue(sender.send(b"batch"))
+        sender.close()
+
+        self.assertEqual(sender.dropped, 1)
+
+    def test_batches_are_dropped_when_the_collector_does_not_receive(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        # A collector which accepts the connection but never receives
+        sender = observer.SpanSender(self.path, send_timeout=0.01)
+
+        with listener:
+            self.assertTrue(sender.send(b"x" * (16 << 20)))
+            sender.close()
+
+        self.assertEqual(sender.dropped, 1)
+
+    def test_close_does_not_block_when_the_queue_is_full(self):
+        sender = observer.SpanSender(self.path, queue_size=1)
+
+        with patch("threading.Thread") as thread:
+            sender.send(b"batch")
+            sender.close(timeout=0)
+
+        thread.return_value.join.assert_not_called()
+
+    def test_batches_are_dropped_when_the_queue_is_full(self):
+        sender = observer.SpanSender(self.path, queue_size=2)
+
+        with patch("threading.Thread"):
+            results = [sender.send(batch) for batch in (b"1", b"2", b"3")]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(sender.dropped, 1)
+
+    def test_from_config(self):
+        sender = observer.SpanSender.from_config(self.path, {"trace_queue_size": "5"})
+
+        self.assertEqual(sender._queue.maxsize, 5)
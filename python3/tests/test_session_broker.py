@@ -0,0 +1,96 @@
+"""Test python3/libexec/session-broker.py"""
+
+import struct
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+from python3.tests.import_helper import import_file_as_module
+
+# Keep the XenAPI mock of other test modules, which is used by later tests
+with patch.dict(sys.modules, {"XenAPI": MagicMock()}):
+    session_broker = import_file_as_module("python3/libexec/session-broker.py")
+
+
+def peer(uid):
+    """Return a mocked client connection from a process of the given uid"""
+    connection = MagicMock()
+    connection.getsockopt.return_value = struct.pack("3i", 1234, uid, uid)
+    connection.recv.side_effect = [b"__dom0__mail_alarm\tmail-alarm\n"]
+    return connection
+
+
+# pylint: disable=missing-function-docstring
+class TestSessionBroker(unittest.TestCase):
+    """Test the SessionBroker class of session-broker.py"""
+
+    def setUp(self):
+        self.now = 100.0
+        self.session = MagicMock()
+        self.session.handle = "OpaqueRef:shared"
+        self.factory = MagicMock(return_value=self.session)
+        self.broker = session_broker.SessionBroker(
+            session_factory=self.factory,
+            revalidate_interval=30,
+            clock=lambda: self.now,
+        )
+
+    def test_session_is_reused(self):
+        self.assertEqual(self.broker.get_session("root", "test"), "OpaqueRef:shared")
+        self.now += 10
+        self.assertEqual(self.broker.get_session("root", "test"), "OpaqueRef:shared")
+
+        self.factory.assert_called_once_with(session_broker="")
+        self.session.xenapi.login_with_password.assert_called_once_with(
+            "root", "", "1.0", "test"
+        )
+        self.session.xenapi.pool.get_all.assert_not_called()
+
+    def test_old_session_is_revalidated(self):
+        self.broker.get_session("root", "test")
+        self.now += 30
+
+        self.assertEqual(self.broker.get_session("root", "test"), "OpaqueRef:shared")
+        self.session.xenapi.pool.get_all.assert_called_once_with()
+
+    def test_failed_validation_logs_in_again(self):
+        self.broker.get_session("root", "test")
+        self.now += 30
+        self.session.xenapi.pool.get_all.side_effect = OSError("xapi restarted")
+
+        self.assertIsNone(self.broker.get_session("root", "test"))
+        self.assertEqual(self.broker.get_session("root", "test"), "OpaqueRef:shared")
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_root_gets_the_session(self):
+        connection = peer(uid=0)
+
+        self.broker.handle(connection)
+
+        connection.sendall.assert_called_once_with(b"OpaqueRef:shared\n")
+        self.session.xenapi.login_with_password.assert_called_once_with(
+            "__dom0__mail_alarm", "", "1.0", "mail-alarm"
+        )
+        connection.close.assert_called_once_with()
+
+    def test_other_users_are_refused(self):
+        connection = peer(uid=1000)
+
+        self.broker.handle(connection)
+
+        connection.sendall.assert_not_called()
+        self.factory.assert_not_called()
+        connection.close.assert_called_once_with()
+
+    def test_logout_on_exit(self):
+        self.broker.get_session("root", "test")
+        self.broker.logout()
+
+        self.session.xenapi.session.logout.assert_called_once_with()
+
+    def test_sessions_are_kept_per_user_and_originator(self):
+        self.broker.get_session("root", "test")
+        self.broker.get_session("root", "other")
+        self.broker.get_session("root", "test")
+
+        self.assertEqual(self.factory.call_count, 2)
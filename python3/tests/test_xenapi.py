@@ -0,0 +1,444 @@
+"""Test python3/examples/XenAPI/XenAPI.py"""
+
+import copy
+import gzip
+import io
+import json
+import os
+import pickle
+import socket
+import tempfile
+import threading
+import unittest
+import uuid
+import xmlrpc.client as xmlrpclib
+from unittest.mock import Mock, patch
+
+from python3.examples.XenAPI import XenAPI
+
+from .importtime import import_times
+
+XENAPI_DIR = os.path.dirname(XenAPI.__file__)
+
+
+def xenapi_response(value=None, error=None):
+    """Return the XML-RPC response body that xapi sends for value or error"""
+    if error:
+        result = {"Status": "Failure", "ErrorDescription": error}
+    else:
+        result = {"Status": "Success", "Value": value}
+    return xmlrpclib.dumps((result,), methodresponse=True).encode()
+
+
+class FakeResponse(io.BytesIO):
+    """A http.client.HTTPResponse stand-in returning the given body"""
+
+    status = 200
+    reason = "OK"
+    headers = {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return []
+
+
+class FakeTransport(xmlrpclib.Transport):
+    """A Transport that answers the requests with the queued response bodies"""
+
+    def __init__(self, *bodies):
+        super().__init__()
+        self.bodies = list(bodies)
+        self.requests = []
+        self.response = None
+        self.closed = 0
+
+    def send_request(self, host, handler, request_body, debug):
+        self.requests.append(xmlrpclib.loads(request_body))
+        self.response = FakeResponse(self.bodies.pop(0))
+        connection = Mock()
+        connection.getresponse.return_value = self.response
+        return connection
+
+    def close(self):
+        self.closed += 1
+        super().close()
+
+
+def logged_in_session(*bodies):
+    """Return a Session that is logged in and will receive the given bodies"""
+    transport = FakeTransport(xenapi_response("OpaqueRef:session"), *bodies)
+    session = XenAPI.Session("http://localhost/", transport=transport)
+    session.xenapi.login_with_password("root", "", "1.0", "test_xenapi")
+    return session, transport
+
+
+RECORDS = {
+    "OpaqueRef:vm%d" % i: {"uuid": "uuid-%d" % i, "VBDs": ["OpaqueRef:vbd%d" % i]}
+    for i in range(5)
+}
+
+
+# pylint: disable=missing-function-docstring
+class TestStreamingResults(unittest.TestCase):
+    """Test Session.xenapi_stream, which decodes results incrementally"""
+
+    def test_struct_members_are_yielded_as_pairs(self):
+        session, transport = logged_in_session(xenapi_response(RECORDS))
+
+        records = session.xenapi_stream.VM.get_all_records()
+
+        self.assertEqual(records.kind, "struct")
+        self.assertEqual(list(records), list(RECORDS.items()))
+        self.assertEqual(
+            transport.requests[-1], (("OpaqueRef:session",), "VM.get_all_records")
+        )
+        self.assertEqual(transport.closed, 0)
+
+    def test_array_elements_are_yielded(self):
+        session, _ = logged_in_session(xenapi_response(sorted(RECORDS)))
+
+        self.assertEqual(list(session.xenapi_stream.VM.get_all()), sorted(RECORDS))
+
+    def test_scalar_is_yielded_once(self):
+        session, _ = logged_in_session(xenapi_response("vm0"))
+
+        self.assertEqual(list(session.xenapi_stream.VM.get_name_label("x")), ["vm0"])
+
+    @patch.object(XenAPI._ResultStream, "chunk_size", 64)
+    def test_items_are_yielded_before_the_response_is_read(self):
+        body = xenapi_response(RECORDS)
+        session, transport = logged_in_session(body)
+
+        records = iter(session.xenapi_stream.VM.get_all_records())
+
+        self.assertEqual(next(records), ("OpaqueRef:vm0", RECORDS["OpaqueRef:vm0"]))
+        self.assertLess(transport.response.tell(), len(body))
+
+    @patch.object(XenAPI._ResultStream, "chunk_size", 64)
+    def test_abandoned_stream_closes_the_connection(self):
+        session, transport = logged_in_session(xenapi_response(RECORDS))
+
+        records = iter(session.xenapi_stream.VM.get_all_records())
+        next(records)
+        records.close()
+
+        self.assertEqual(transport.closed, 1)
+
+    def test_unread_stream_closes_the_connection(self):
+        session, transport = logged_in_session(xenapi_response(RECORDS))
+
+        with session.xenapi_stream.VM.get_all_records() as records:
+            self.assertEqual(records.kind, "struct")
+
+        self.assertEqual(transport.closed, 1)
+        with self.assertRaises(ValueError):
+            list(records)
+
+    def test_read_stream_keeps_the_connection(self):
+        session, transport = logged_in_session(xenapi_response(RECORDS))
+
+        with session.xenapi_stream.VM.get_all_records() as records:
+            self.assertEqual(dict(records), RECORDS)
+
+        self.assertEqual(transport.closed, 0)
+
+    @patch.object(XenAPI._ResultStream, "chunk_size", 64)
+    def test_gzip_response_is_decompressed_incrementally(self):
+        records = {
+            "OpaqueRef:%d" % i: {"uuid": str(uuid.UUID(int=i * 7919**9))}
+            for i in range(200)
+        }
+        body = gzip.compress(xenapi_response(records))
+        session, transport = logged_in_session(body)
+
+        with patch.object(FakeResponse, "headers", {"Content-Encoding": "gzip"}):
+            stream = iter(session.xenapi_stream.VM.get_all_records())
+            self.assertEqual(next(stream), ("OpaqueRef:0", records["OpaqueRef:0"]))
+            self.assertLess(transport.response.tell(), len(body))
+            self.assertEqual(len(dict(stream)), 199)
+
+    def test_failure_is_raised(self):
+        session, _ = logged_in_session(xenapi_response(error=["HANDLE_INVALID", "VM"]))
+
+        with self.assertRaises(XenAPI.Failure) as context:
+            session.xenapi_stream.VM.get_all_records()
+        self.assertEqual(context.exception.details, ["HANDLE_INVALID", "VM"])
+
+    def test_invalid_session_logs_in_again(self):
+        session, transport = logged_in_session(
+            xenapi_response(error=["SESSION_INVALID", "OpaqueRef:session"]),
+            xenapi_response("OpaqueRef:session2"),
+            xenapi_response(RECORDS),
+        )
+
+        self.assertEqual(dict(session.xenapi_stream.VM.get_all_records()), RECORDS)
+        self.assertEqual(
+            transport.requests[-1], (("OpaqueRef:session2",), "VM.get_all_records")
+        )
+
+
+class TestCompactRecords(unittest.TestCase):
+    """Test Session.xenapi_compact, which returns records as Record objects"""
+
+    def test_get_all_records_returns_records(self):
+        session, _ = logged_in_session(xenapi_response(RECORDS))
+
+        records = session.xenapi_compact.VM.get_all_records()
+
+        self.assertEqual(records, RECORDS)
+        record = records["OpaqueRef:vm1"]
+        self.assertIsInstance(record, XenAPI.Record)
+        self.assertEqual(record["uuid"], "uuid-1")
+        self.assertEqual(record.get("missing", "default"), "default")
+        self.assertEqual(record.VBDs, ["OpaqueRef:vbd1"])
+        self.assertEqual(dict(record), RECORDS["OpaqueRef:vm1"])
+        with self.assertRaises(AttributeError):
+            record.missing  # pylint: disable=pointless-statement
+        with self.assertRaises(AttributeError):
+            record.__dict__  # pylint: disable=pointless-statement
+
+    def test_fields_and_refs_are_shared(self):
+        session, _ = logged_in_session(xenapi_response(RECORDS))
+
+        first, second = list(session.xenapi_compact.VM.get_all_records().values())[:2]
+
+        self.assertIs(first._fields, second._fields)
+        ref = XenAPI._intern_ref("OpaqueRef:" + "vbd0")
+        self.assertIs(first.VBDs[0], ref)
+
+    def test_records_can_be_copied_and_pickled(self):
+        session, _ = logged_in_session(xenapi_response(RECORDS))
+        record = session.xenapi_compact.VM.get_all_records()["OpaqueRef:vm1"]
+
+        for clone in (
+            copy.copy(record),
+            copy.deepcopy(record),
+            pickle.loads(pickle.dumps(record)),
+        ):
+            self.assertIsInstance(clone, XenAPI.Record)
+            self.assertEqual(clone, record)
+            self.assertEqual(clone.uuid, "uuid-1")
+            self.assertIs(clone._fields, record._fields)
+
+    def test_get_record_returns_a_record(self):
+        session, _ = logged_in_session(xenapi_response(RECORDS["OpaqueRef:vm0"]))
+
+        record = session.xenapi_compact.VM.get_record("OpaqueRef:vm0")
+
+        self.assertEqual(record.uuid, "uuid-0")
+
+    def test_other_results_are_unchanged(self):
+        session, _ = logged_in_session(
+            xenapi_response(sorted(RECORDS)),
+            xenapi_response({"key": "value"}),
+            xenapi_response("name"),
+        )
+
+        self.assertEqual(session.xenapi_compact.VM.get_all(), sorted(RECORDS))
+        self.assertEqual(
+            session.xenapi_compact.VM.get_other_config("x"), {"key": "value"}
+        )
+        self.assertEqual(session.xenapi_compact.VM.get_name_label("x"), "name")
+
+
+class TestCallStats(unittest.TestCase):
+    """Test the per-method statistics of Session.enable_call_stats()"""
+
+    def test_calls_are_not_recorded_by_default(self):
+        session, _ = logged_in_session(xenapi_response(sorted(RECORDS)))
+
+        session.xenapi.VM.get_all()
+
+        self.assertIsNone(session.call_stats)
+
+    def test_calls_are_recorded_per_method(self):
+        response = xenapi_response(sorted(RECORDS))
+        session, _ = logged_in_session(
+            response, response, xenapi_response(error=["HANDLE_INVALID", "VM"])
+        )
+        stats = session.enable_call_stats()
+
+        session.xenapi.VM.get_all()
+        session.xenapi.VM.get_all()
+        with self.assertRaises(XenAPI.Failure):
+            session.xenapi.VM.get_record("OpaqueRef:vm9")
+
+        summary = stats.summary()
+        self.assertEqual(sorted(summary), ["VM.get_all", "VM.get_record"])
+        get_all = summary["VM.get_all"]
+        self.assertEqual((get_all["count"], get_all["failed"]), (2, 0))
+        self.assertEqual(get_all["response_bytes"], 2 * len(response))
+        self.assertGreater(get_all["request_bytes"], 0)
+        self.assertEqual(sum(get_all["latency_buckets"]), 2)
+        self.assertEqual(summary["VM.get_record"]["failed"], 1)
+
+    def test_relogin_is_counted_as_retry(self):
+        session, _ = logged_in_session(
+            xenapi_response(error=["SESSION_INVALID", "OpaqueRef:session"]),
+            xenapi_response("OpaqueRef:session2"),
+            xenapi_response(sorted(RECORDS)),
+        )
+        stats = session.enable_call_stats()
+
+        session.xenapi.VM.get_all()
+
+        summary = stats.summary()
+        self.assertEqual(summary["VM.get_all"]["retries"], 1)
+        # The bytes of the login are not added to those of the retried call
+        login = summary["session.login_with_password"]
+        self.assertEqual(login["count"], 1)
+        self.assertEqual(
+            login["response_bytes"], len(xenapi_response("OpaqueRef:session2"))
+        )
+        self.assertEqual(
+            summary["VM.get_all"]["response_bytes"],
+            len(xenapi_response(error=["SESSION_INVALID", "OpaqueRef:session"]))
+            + len(xenapi_response(sorted(RECORDS))),
+        )
+
+    def test_latency_histogram_buckets(self):
+        stats = XenAPI.CallStats()
+
+        for seconds in (0.0005, 0.003, 100):
+            stats.record("VM.start", seconds, 10, 20, 0)
+
+        buckets = stats.summary()["VM.start"]["latency_buckets"]
+        self.assertEqual((buckets[0], buckets[2], buckets[-1]), (1, 1, 1))
+
+    def test_dump_and_calls_file_write_ndjson(self):
+        calls = io.StringIO()
+        stats = XenAPI.CallStats(calls_file=calls)
+        stats.record("VM.start", 2.0, 10, 20, 0)
+        stats.record("VM.get_all", 0.5, 10, 20, 1, failed=True)
+
+        out = io.StringIO()
+        stats.dump(out)
+
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line["method"] for line in lines], ["VM.start", "VM.get_all"])
+        self.assertEqual(lines[1]["retries"], 1)
+        calls = [json.loads(line) for line in calls.getvalue().splitlines()]
+        self.assertEqual(calls[1]["failed"], True)
+
+
+class TestImportTime(unittest.TestCase):
+    """Benchmark python -X importtime -c "import XenAPI" in a new process"""
+
+    def test_optional_modules_are_not_imported(self):
+        times = import_times(
+            "import XenAPI", [XENAPI_DIR], {"OTEL_SDK_DISABLED": "false"}
+        )
+
+        lazy = ("gettext", "opentelemetry", "json")
+        self.assertEqual([m for m in times if m.startswith(lazy)], [])
+
+    def test_tracecontext_is_probed_on_first_request(self):
+        transport = XenAPI.UDSTransport()
+        with patch.object(XenAPI, "_otel", None), patch.dict(
+            os.environ, {"OTEL_SDK_DISABLED": "true", "TRACEPARENT": "00-1-2-01"}
+        ):
+            transport.with_tracecontext()
+            self.assertIs(XenAPI._otel, False)
+        self.assertEqual(transport._extra_headers, [("traceparent", "00-1-2-01")])
+
+    def test_translation_is_loaded_on_first_use(self):
+        self.assertEqual(XenAPI.translation.gettext("VM"), "VM")
+
+
+class TestSessionBroker(unittest.TestCase):
+    """Test that Session takes the shared session from a session broker"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.tmpdir.name, "broker")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(1)
+        self.requests = []
+
+    def tearDown(self):
+        self.listener.close()
+        self.tmpdir.cleanup()
+
+    def serve(self, reply):
+        """Answer one connection to the broker socket with reply"""
+        self.listener.settimeout(10)
+
+        def answer():
+            connection, _ = self.listener.accept()
+            with connection:
+                self.requests.append(connection.recv(1024))
+                connection.sendall(reply)
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        return thread
+
+    def session(self, *bodies):
+        transport = FakeTransport(*bodies)
+        return XenAPI.Session("http://localhost/", transport, session_broker=self.path)
+
+    def test_login_and_logout_do_not_call_xapi(self):
+        session = self.session(xenapi_response(sorted(RECORDS)))
+        broker = self.serve(b"OpaqueRef:shared\n")
+
+        session.xenapi.login_with_password("root", "", "1.0", "test_xenapi")
+        broker.join()
+        session.xenapi.VM.get_all()
+        session.xenapi.session.logout()
+
+        transport = session._ServerProxy__transport
+        self.assertEqual(transport.requests, [(("OpaqueRef:shared",), "VM.get_all")])
+        self.assertEqual(self.requests, [b"root\ttest_xenapi\n"])
+
+    def test_invalid_shared_session_falls_back_to_login(self):
+        session = self.session(
+            xenapi_response(error=["SESSION_INVALID", "OpaqueRef:shared"]),
+            xenapi_response("OpaqueRef:own"),
+            xenapi_response(sorted(RECORDS)),
+            xenapi_response(""),
+        )
+        broker = self.serve(b"OpaqueRef:shared\n")
+
+        session.xenapi.login_with_password("root", "", "1.0", "test_xenapi")
+        broker.join()
+        self.assertEqual(session.xenapi.VM.get_all(), sorted(RECORDS))
+        session.xenapi.session.logout()
+
+        transport = session._ServerProxy__transport
+        self.assertEqual(
+            [method for _, method in transport.requests],
+            [
+                "VM.get_all",
+                "session.login_with_password",
+                "VM.get_all",
+                "session.logout",
+            ],
+        )
+
+    def test_unavailable_broker_falls_back_to_login(self):
+        self.listener.close()
+        session = self.session(xenapi_response("OpaqueRef:own"))
+
+        session.xenapi.login_with_password("root", "", "1.0", "test_xenapi")
+
+        self.assertEqual(session.handle, "OpaqueRef:own")
+
+    def test_broker_without_session_falls_back_to_login(self):
+        session = self.session(xenapi_response("OpaqueRef:own"))
+        broker = self.serve(b"\n")
+
+        session.xenapi.login_with_password("root", "", "1.0", "test_xenapi")
+        broker.join()
+
+        self.assertEqual(session.handle, "OpaqueRef:own")
+
+    def test_login_with_password_is_not_brokered(self):
+        session = self.session(xenapi_response("OpaqueRef:own"))
+
+        session.xenapi.login_with_password("root", "secret", "1.0", "test_xenapi")
+
+        self.assertEqual(session.handle, "OpaqueRef:own")
+        self.assertEqual(self.requests, [])